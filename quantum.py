@@ -1,6 +1,31 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import operator
+import os
+import platform
+import re
+import shutil
+import signal
+import struct
 import subprocess
 import sys
-from typing import TextIO, Tuple, List
+import tempfile
+import time
+import traceback
+from array import array
+from typing import Callable, Iterable, Iterator, Optional, TextIO, Tuple, List
+
+try:
+    import numpy
+except ImportError:
+    # Optional, only `simulate_lanes` needs it
+    numpy = None
 
 iota_counter = 0
 
@@ -17,6 +42,11 @@ def enum(reset=False) -> int:
 
 MEMORY_ALLOCATION = 640_000
 
+# Compilation targets
+TARGET_ARM64_MACOS = 'arm64-macos'
+TARGET_X86_64_LINUX = 'x86_64-linux'
+TARGETS = [TARGET_ARM64_MACOS, TARGET_X86_64_LINUX]
+
 OP_PUSH = enum(True)
 OP_ADD = enum()
 OP_SUB = enum()
@@ -45,11 +75,66 @@ OP_LOAD = enum()
 OP_SAVE = enum()
 OP_SYSCALL1 = enum()
 OP_SYSCALL3 = enum()
+OP_LOAD16 = enum()
+OP_LOAD32 = enum()
+OP_LOAD64 = enum()
+OP_SAVE16 = enum()
+OP_SAVE32 = enum()
+OP_SAVE64 = enum()
+OP_MEMCPY = enum()
+OP_MEMSET = enum()
+# Superinstructions, produced only by `optimize_program`
+OP_MEM_OFFSET = enum()
+OP_ADD_CONST = enum()
+OP_ADD_MEM = enum()
+OP_LOAD_MEM = enum()
+OP_CLONE_LOAD_MEM = enum()
+OP_CMP_IF = enum()
+OP_CMP_DO = enum()
 COUNT_OPS = enum()
 
+# Comparison operations, with the python equivalent used by the simulator and the condition codes used by the compiler
+COMPARISONS = {
+    OP_EQ: (operator.eq, 'eq', 'ne'),
+    OP_GT: (operator.gt, 'gt', 'le'),
+    OP_GE: (operator.ge, 'ge', 'lt'),
+    OP_LT: (operator.lt, 'lt', 'ge'),
+    OP_LE: (operator.le, 'le', 'gt'),
+}
+
+# Sizes in bytes of the multi-byte memory operations, the values are little-endian. 16 and 32-bit loads are zero
+# extended, 64-bit loads are signed like the registers of the compiled program
+WIDE_LOADS = {OP_LOAD16: 2, OP_LOAD32: 4, OP_LOAD64: 8}
+WIDE_SAVES = {OP_SAVE16: 2, OP_SAVE32: 4, OP_SAVE64: 8}
+
+# Names of the operations used in diagnostics
+OP_NAMES = {
+    OP_PUSH: 'push', OP_ADD: '+', OP_SUB: '-', OP_DUMP: 'dump', OP_DROP: 'drop', OP_SWAP: 'swap', OP_OVER: 'over',
+    OP_CLONE: 'clone', OP_CLONE2: 'clone2', OP_EQ: '=', OP_GT: '>', OP_GE: '>=', OP_LT: '<', OP_LE: '<=',
+    OP_BOR: 'bor', OP_BAND: 'band', OP_SHR: 'shr', OP_SHL: 'shl', OP_IF: 'if', OP_ELSE: 'else', OP_END: 'end',
+    OP_WHILE: 'while', OP_DO: 'do', OP_MEM: 'mem', OP_LOAD: 'load', OP_SAVE: 'save', OP_SYSCALL1: 'syscall1',
+    OP_SYSCALL3: 'syscall3', OP_LOAD16: 'load16', OP_LOAD32: 'load32', OP_LOAD64: 'load64', OP_SAVE16: 'save16',
+    OP_SAVE32: 'save32', OP_SAVE64: 'save64', OP_MEMCPY: 'memcpy', OP_MEMSET: 'memset', OP_MEM_OFFSET: 'mem +',
+    OP_ADD_CONST: '+', OP_ADD_MEM: 'mem + +', OP_LOAD_MEM: 'mem + load', OP_CLONE_LOAD_MEM: 'clone mem + load',
+    OP_CMP_IF: 'if', OP_CMP_DO: 'do',
+}
+
+# Number of values every operation takes from the stack and pushes back
+STACK_EFFECTS = {
+    OP_PUSH: (0, 1), OP_ADD: (2, 1), OP_SUB: (2, 1), OP_DUMP: (1, 0), OP_DROP: (1, 0), OP_SWAP: (2, 2),
+    OP_OVER: (2, 3), OP_CLONE: (1, 2), OP_CLONE2: (2, 4), OP_EQ: (2, 1), OP_GT: (2, 1), OP_GE: (2, 1), OP_LT: (2, 1),
+    OP_LE: (2, 1), OP_BOR: (2, 1), OP_BAND: (2, 1), OP_SHR: (2, 1), OP_SHL: (2, 1), OP_IF: (1, 0), OP_ELSE: (0, 0),
+    OP_END: (0, 0), OP_WHILE: (0, 0), OP_DO: (1, 0), OP_MEM: (0, 1), OP_LOAD: (1, 1), OP_SAVE: (2, 0),
+    OP_SYSCALL1: (2, 0), OP_SYSCALL3: (4, 0), OP_LOAD16: (1, 1), OP_LOAD32: (1, 1), OP_LOAD64: (1, 1),
+    OP_SAVE16: (2, 0), OP_SAVE32: (2, 0), OP_SAVE64: (2, 0), OP_MEMCPY: (3, 0), OP_MEMSET: (3, 0),
+    OP_MEM_OFFSET: (0, 1), OP_ADD_CONST: (1, 1), OP_ADD_MEM: (1, 1), OP_LOAD_MEM: (1, 1), OP_CLONE_LOAD_MEM: (1, 2),
+    OP_CMP_IF: (2, 0), OP_CMP_DO: (2, 0),
+}
+
 
 class Token:
     """ Token class to represent a token in the program, with the file path, row, column, and value """
+    __slots__ = ('file_path', 'row', 'col', 'value')
 
     def __init__(self, file_path: str, row: int, col: int, value: str):
         self.file_path = file_path
@@ -64,8 +149,74 @@ class Token:
         return self.file_path, self.row, self.col
 
 
+class StackEffectError(Exception):
+    """ Error found by `check_stack_effects`, with the location of the operation causing it """
+
+    def __init__(self, loc: Tuple[str, int, int], message: str):
+        super().__init__(f"{format_location(loc)}: {message}")
+        self.loc = loc
+
+
+def format_location(loc: Tuple[str, int, int]) -> str:
+    return f"{loc[0]}:{loc[1]}:{loc[2]}"
+
+
+class MemoryAccessError(Exception):
+    """ Access outside of the memory of the program, raised by `CheckedMemory`. The simulators prefix the message with
+    the location of the operation """
+
+
+class ProgramExit(SystemExit):
+    """ Exit of the program through the `exit` syscall. It is a `SystemExit`, so unless it is caught, e.g. by
+    `Interpreter`, the process exits with the code of the program """
+
+
+class BudgetExceeded(Exception):
+    """ The program ran out of the instructions or the time `Interpreter` allows it """
+
+
+class ProgramEnd(Exception):
+    """ Raised by the handler `Interpreter` places past the last operation, ends the slice being run """
+
+
+class CheckedMemory(mmap.mmap):
+    """ Memory that checks the bounds of every access made by indexing or slicing. Plain `mmap` memory accepts negative
+    addresses counted from the end, this one reports them as errors like the addresses past the end """
+    __slots__ = ()
+
+    def check(self, address: int, count: int = 1) -> None:
+        if address < 0 or count < 0 or address + count > len(self):
+            raise MemoryAccessError(f'memory access out of bounds at address {address}'
+                                    f'{f" for {count} bytes" if count != 1 else ""}, memory size is {len(self)}')
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            self.check(key.start, key.stop - key.start)
+        else:
+            self.check(key)
+        return mmap.mmap.__getitem__(self, key)
+
+    def __setitem__(self, key, value) -> None:
+        if isinstance(key, slice):
+            self.check(key.start, key.stop - key.start)
+        else:
+            self.check(key)
+        mmap.mmap.__setitem__(self, key, value)
+
+
+def allocate_memory(size: int = MEMORY_ALLOCATION, checked: bool = False, fileno: int = -1) -> mmap.mmap:
+    """ Memory of the simulators, an anonymous mapping: the pages the program never touches are never committed. With
+    `fileno` it is a private copy-on-write mapping of the file instead, its pages are read when first touched and the
+    writes of the program never reach the file """
+    memory_class = CheckedMemory if checked else mmap.mmap
+    if fileno == -1:
+        return memory_class(-1, size)
+    return memory_class(fileno, size, access=mmap.ACCESS_COPY)
+
+
 class Operation:
     """ Operation class to represent an operation in the program """
+    __slots__ = ('type', 'loc', 'value', 'jump')
 
     def __init__(self, op_type: int, loc: Tuple[str, int, int], value: int = None, jump: int = None):
         self.type = op_type
@@ -74,569 +225,4353 @@ class Operation:
         self.jump = jump
 
 
-def simulate_program(prg: List[Operation]) -> None:
-    assert COUNT_OPS == 28, 'Exhaustive handling of operands in `simulate_program`'
+# Operations that carry an operand in `Operation.value`
+OPERAND_OPS = [OP_PUSH, OP_MEM_OFFSET, OP_ADD_CONST, OP_ADD_MEM, OP_LOAD_MEM, OP_CLONE_LOAD_MEM, OP_CMP_IF, OP_CMP_DO]
+
+
+class Program:
+    """ Compact representation of a program: parallel columns of operation types, operands and jumps (-1 for none),
+    with the source locations in columns of rows and columns plus a side table of interned file paths. Operands that
+    don't fit into 64 bits are kept in `wide_values`. `sources` lists the files the program was built from, the main
+    one first, with their stamps and hashes. Indexing returns an `Operation` built from the columns """
+    __slots__ = ('types', 'values', 'jumps', 'files', 'loc_files', 'loc_rows', 'loc_cols', 'wide_values', 'sources')
+
+    def __init__(self):
+        self.types = array('q')
+        self.values = array('q')
+        self.jumps = array('q')
+        self.files = []
+        self.loc_files = array('i')
+        self.loc_rows = array('i')
+        self.loc_cols = array('i')
+        self.wide_values = {}
+        self.sources = []
+
+    @classmethod
+    def from_operations(cls, prg: Iterable[Operation]) -> 'Program':
+        program = cls()
+        file_ids = {}
+        for op in prg:
+            op_index = len(program.types)
+            program.types.append(op.type)
+            value = op.value if op.value is not None else 0
+            if -0x8000000000000000 <= value < 0x8000000000000000:
+                program.values.append(value)
+            else:
+                program.values.append(0)
+                program.wide_values[op_index] = value
+            program.jumps.append(op.jump if op.jump is not None else -1)
+            file_path, row, col = op.loc
+            if file_path not in file_ids:
+                file_ids[file_path] = len(program.files)
+                program.files.append(file_path)
+            program.loc_files.append(file_ids[file_path])
+            program.loc_rows.append(row)
+            program.loc_cols.append(col)
+        return program
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def __getitem__(self, op_index: int) -> Operation:
+        if not 0 <= op_index < len(self.types):
+            raise IndexError('program index out of range')
+        op_type = self.types[op_index]
+        jump = self.jumps[op_index]
+        return Operation(op_type, self.loc(op_index), value=self.value(op_index), jump=jump if jump >= 0 else None)
+
+    def __iter__(self) -> Iterator[Operation]:
+        for op_index in range(len(self.types)):
+            yield self[op_index]
+
+    def value(self, op_index: int) -> Optional[int]:
+        if self.types[op_index] not in OPERAND_OPS:
+            return None
+        if op_index in self.wide_values:
+            return self.wide_values[op_index]
+        return self.values[op_index]
+
+    def loc(self, op_index: int) -> Tuple[str, int, int]:
+        return self.files[self.loc_files[op_index]], self.loc_rows[op_index], self.loc_cols[op_index]
+
+
+def memory_copy(memory: mmap.mmap, dst: int, src: int, count: int) -> None:
+    """ Copies `count` bytes from `src` to `dst`, the ranges may overlap """
+    if count > 0:
+        memory[dst: dst + count] = memory[src: src + count]
+
+
+def memory_fill(memory: mmap.mmap, dst: int, value: int, count: int) -> None:
+    """ Fills `count` bytes at `dst` with the low byte of `value` """
+    if count > 0:
+        memory[dst: dst + count] = bytes((value & 0xFF,)) * count
+
+
+def simulate_program_reference(prg: Program, memory: Optional[mmap.mmap] = None) -> None:
+    """ Reference simulator, dispatches every instruction through a single chain of comparisons. It reads the columns
+    of the program directly, without building an `Operation` for every instruction """
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `simulate_program_reference`'
+    types = prg.types.tolist()
+    values = [prg.value(op_index) for op_index in range(len(prg))]
+    jumps = [jump if jump >= 0 else None for jump in prg.jumps]
     stack = []
-    memory = bytearray(MEMORY_ALLOCATION)
+    memory = memory if memory is not None else allocate_memory()
     op_index = 0
-    while op_index < len(prg):
-        op = prg[op_index]
-        if op.type == OP_PUSH:
-            stack.append(op.value)
-            op_index += 1
-        elif op.type == OP_ADD:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1 + val_2)
-            op_index += 1
-        elif op.type == OP_SUB:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1 - val_2)
-            op_index += 1
-        elif op.type == OP_DUMP:
-            val_1 = stack.pop()
-            print(val_1)
-            op_index += 1
-        elif op.type == OP_DROP:
-            stack.pop()
-            op_index += 1
-        elif op.type == OP_SWAP:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_2)
-            stack.append(val_1)
-            op_index += 1
-        elif op.type == OP_OVER:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1)
-            stack.append(val_2)
-            stack.append(val_1)
-            op_index += 1
-        elif op.type == OP_CLONE:
-            val_1 = stack.pop()
-            stack.append(val_1)
-            stack.append(val_1)
-            op_index += 1
-        elif op.type == OP_CLONE2:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1)
-            stack.append(val_2)
-            stack.append(val_1)
-            stack.append(val_2)
-            op_index += 1
-        elif op.type == OP_EQ:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(int(val_1 == val_2))
-            op_index += 1
-        elif op.type == OP_GT:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(int(val_1 > val_2))
-            op_index += 1
-        elif op.type == OP_GE:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(int(val_1 >= val_2))
-            op_index += 1
-        elif op.type == OP_LT:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(int(val_1 < val_2))
-            op_index += 1
-        elif op.type == OP_LE:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(int(val_1 <= val_2))
-            op_index += 1
-        elif op.type == OP_BOR:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1 | val_2)
-            op_index += 1
-        elif op.type == OP_BAND:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1 & val_2)
-            op_index += 1
-        elif op.type == OP_SHR:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1 >> val_2)
-            op_index += 1
-        elif op.type == OP_SHL:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            stack.append(val_1 << val_2)
-            op_index += 1
-        elif op.type == OP_IF:
-            assert op.jump is not None, "`end` is not referenced in `if` block"
-            val_1 = stack.pop()
-            if val_1 == 0:
-                op_index = op.jump
-            else:
+    try:
+        while op_index < len(types):
+            op_type = types[op_index]
+            if op_type == OP_PUSH:
+                stack.append(values[op_index])
                 op_index += 1
-        elif op.type == OP_ELSE:
-            assert op.jump is not None, "`end` is not referenced in `else` block"
-            op_index = op.jump
-        elif op.type == OP_WHILE:
-            op_index += 1
-        elif op.type == OP_DO:
-            assert op.jump is not None, "`end` is not referenced in `while-do` block"
-            val_1 = stack.pop()
-            if val_1 == 0:
-                op_index = op.jump
-            else:
+            elif op_type == OP_ADD:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1 + val_2)
                 op_index += 1
-        elif op.type == OP_END:
-            assert op.jump is not None, "`end` doesn't have reference to the next instruction to jump"
-            op_index = op.jump
-        elif op.type == OP_MEM:
-            stack.append(0)
-            op_index += 1
-        elif op.type == OP_LOAD:
-            val_1 = stack.pop()
-            stack.append(memory[val_1])
-            op_index += 1
-        elif op.type == OP_SAVE:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            memory[val_1] = val_2 & 0xFF
-            op_index += 1
-        elif op.type == OP_SYSCALL1:
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            # 1 is exit syscall
-            if val_2 == 1:
-                exit(val_1)
-            else:
-                assert False, f'Unhandled syscall: {val_2}'
-        elif op.type == OP_SYSCALL3:
-            val_4 = stack.pop()
-            val_3 = stack.pop()
-            val_2 = stack.pop()
-            val_1 = stack.pop()
-            # 4 is write syscall
-            if val_4 == 4:
-                s = memory[val_2: val_2 + val_3].decode('utf-8')
-                if val_1 == 1:
-                    print(s, end='')
-                elif val_1 == 2:
-                    print(s, end='', file=sys.stderr)
+            elif op_type == OP_SUB:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1 - val_2)
+                op_index += 1
+            elif op_type == OP_DUMP:
+                val_1 = stack.pop()
+                print(val_1)
+                op_index += 1
+            elif op_type == OP_DROP:
+                stack.pop()
+                op_index += 1
+            elif op_type == OP_SWAP:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_2)
+                stack.append(val_1)
+                op_index += 1
+            elif op_type == OP_OVER:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1)
+                stack.append(val_2)
+                stack.append(val_1)
+                op_index += 1
+            elif op_type == OP_CLONE:
+                val_1 = stack.pop()
+                stack.append(val_1)
+                stack.append(val_1)
+                op_index += 1
+            elif op_type == OP_CLONE2:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1)
+                stack.append(val_2)
+                stack.append(val_1)
+                stack.append(val_2)
+                op_index += 1
+            elif op_type == OP_EQ:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(int(val_1 == val_2))
+                op_index += 1
+            elif op_type == OP_GT:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(int(val_1 > val_2))
+                op_index += 1
+            elif op_type == OP_GE:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(int(val_1 >= val_2))
+                op_index += 1
+            elif op_type == OP_LT:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(int(val_1 < val_2))
+                op_index += 1
+            elif op_type == OP_LE:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(int(val_1 <= val_2))
+                op_index += 1
+            elif op_type == OP_BOR:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1 | val_2)
+                op_index += 1
+            elif op_type == OP_BAND:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1 & val_2)
+                op_index += 1
+            elif op_type == OP_SHR:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1 >> val_2)
+                op_index += 1
+            elif op_type == OP_SHL:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                stack.append(val_1 << val_2)
+                op_index += 1
+            elif op_type == OP_IF:
+                assert jumps[op_index] is not None, "`end` is not referenced in `if` block"
+                val_1 = stack.pop()
+                if val_1 == 0:
+                    op_index = jumps[op_index]
+                else:
+                    op_index += 1
+            elif op_type == OP_ELSE:
+                assert jumps[op_index] is not None, "`end` is not referenced in `else` block"
+                op_index = jumps[op_index]
+            elif op_type == OP_WHILE:
+                op_index += 1
+            elif op_type == OP_DO:
+                assert jumps[op_index] is not None, "`end` is not referenced in `while-do` block"
+                val_1 = stack.pop()
+                if val_1 == 0:
+                    op_index = jumps[op_index]
+                else:
+                    op_index += 1
+            elif op_type == OP_END:
+                assert jumps[op_index] is not None, "`end` doesn't have reference to the next instruction to jump"
+                op_index = jumps[op_index]
+            elif op_type == OP_MEM:
+                stack.append(0)
+                op_index += 1
+            elif op_type == OP_LOAD:
+                val_1 = stack.pop()
+                stack.append(memory[val_1])
+                op_index += 1
+            elif op_type == OP_SAVE:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                memory[val_1] = val_2 & 0xFF
+                op_index += 1
+            elif op_type in WIDE_LOADS:
+                size = WIDE_LOADS[op_type]
+                val_1 = stack.pop()
+                stack.append(int.from_bytes(memory[val_1: val_1 + size], 'little', signed=size == 8))
+                op_index += 1
+            elif op_type in WIDE_SAVES:
+                size = WIDE_SAVES[op_type]
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                memory[val_1: val_1 + size] = (val_2 & ((1 << 8 * size) - 1)).to_bytes(size, 'little')
+                op_index += 1
+            elif op_type in [OP_MEMCPY, OP_MEMSET]:
+                val_3 = stack.pop()
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                (memory_copy if op_type == OP_MEMCPY else memory_fill)(memory, val_1, val_2, val_3)
+                op_index += 1
+            elif op_type == OP_SYSCALL1:
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                # 1 is exit syscall
+                if val_2 == 1:
+                    raise ProgramExit(val_1)
+                else:
+                    assert False, f'Unhandled syscall: {val_2}'
+            elif op_type == OP_SYSCALL3:
+                val_4 = stack.pop()
+                val_3 = stack.pop()
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                # 4 is write syscall
+                if val_4 == 4:
+                    s = memory[val_2: val_2 + val_3].decode('utf-8')
+                    if val_1 == 1:
+                        print(s, end='')
+                    elif val_1 == 2:
+                        print(s, end='', file=sys.stderr)
+                    else:
+                        assert False, f'Unknown file description: {val_1}'
+                else:
+                    assert False, f'Unhandled syscall: {val_4}'
+                op_index += 1
+            elif op_type == OP_MEM_OFFSET:
+                stack.append(values[op_index])
+                op_index += 1
+            elif op_type in [OP_ADD_CONST, OP_ADD_MEM]:
+                val_1 = stack.pop()
+                stack.append(val_1 + values[op_index])
+                op_index += 1
+            elif op_type == OP_LOAD_MEM:
+                val_1 = stack.pop()
+                stack.append(memory[val_1 + values[op_index]])
+                op_index += 1
+            elif op_type == OP_CLONE_LOAD_MEM:
+                val_1 = stack.pop()
+                stack.append(val_1)
+                stack.append(memory[val_1 + values[op_index]])
+                op_index += 1
+            elif op_type in [OP_CMP_IF, OP_CMP_DO]:
+                assert jumps[op_index] is not None, "`end` is not referenced in `if` or `while-do` block"
+                val_2 = stack.pop()
+                val_1 = stack.pop()
+                if COMPARISONS[values[op_index]][0](val_1, val_2):
+                    op_index += 1
                 else:
-                    assert False, f'Unknown file description: {val_1}'
+                    op_index = jumps[op_index]
             else:
-                assert False, f'Unhandled syscall: {val_4}'
-            op_index += 1
-        else:
-            assert False, f'Unhandled instruction: {op.type}'
+                assert False, f'Unhandled instruction: {op_type}'
+    except MemoryAccessError as err:
+        raise MemoryAccessError(f'{format_location(prg.loc(op_index))}: {err}') from None
 
 
-def setup_macros_and_functions(out: TextIO) -> None:
-    """ Initial macros and functions setup """
+# Size in bytes the output of the simulators is buffered up to, see `OutputBuffer`
+OUTPUT_BUFFER_SIZE = 1 << 16
 
-    # Macros for pushing and popping from the stack
-    out.write('.macro push Xn:req\n')
-    out.write('   str \\Xn, [sp, #-16]!\n')
-    out.write('.endm\n')
-    out.write('.macro pop Xn:req\n')
-    out.write('   ldr \\Xn, [sp], #16\n')
-    out.write('.endm\n')
 
-    # Dump function
-    # Pops and prints value in x0
-    out.write('dump:\n')
-    out.write('   stp x29, x30, [sp, -48]!\n')
-    out.write('   mov x7, -3689348814741910324\n')
-    out.write('   mov w3, 10\n')
-    out.write('   mov x29, sp\n')
-    out.write('   add x1, sp, 16\n')
-    out.write('   mov x2, 1\n')
-    out.write('   movk x7, 0xcccd, lsl 0\n')
-    out.write('   strb w3, [sp, 47]\n')
-    out.write('.L2:\n')
-    out.write('   umulh x4, x0, x7\n')
-    out.write('   sub x5, x1, x2\n')
-    out.write('   mov x6, x0\n')
-    out.write('   add x2, x2, 1\n')
-    out.write('   lsr x4, x4, 3\n')
-    out.write('   add x3, x4, x4, lsl 2\n')
-    out.write('   sub x3, x0, x3, lsl 1\n')
-    out.write('   mov x0, x4\n')
-    out.write('   add w3, w3, 48\n')
-    out.write('   strb w3, [x5, 31]\n')
-    out.write('   cmp x6, 9\n')
-    out.write('   bhi .L2\n')
-    out.write('   sub x1, x1, x2\n')
-    out.write('   mov w0, 1\n')
-    out.write('   add x1, x1, 32\n')
-    out.write('   mov x16, 4\n')
-    out.write('   svc #0\n')
-    out.write('   ldp x29, x30, [sp], 48\n')
-    out.write('   ret\n')
+class OutputBuffer:
+    """ Output of the simulators. The bytes written to stdout and stderr are collected without decoding and written to
+    the binary layer of the streams once `size` bytes are pending, before switching to the other stream and on
+    `flush`. With `size` 0 every write goes out immediately. The streams are looked up at flush time, so redirecting
+    `sys.stdout` redirects the output too. `stdout` and `stderr` replace the streams with sinks of their own, any
+    object with a `write` method taking bytes """
+    __slots__ = ('size', 'pending', 'fd', 'stdout', 'stderr')
 
+    def __init__(self, size: int = OUTPUT_BUFFER_SIZE, stdout=None, stderr=None):
+        self.size = size
+        self.pending = bytearray()
+        self.fd = 1
+        self.stdout = stdout
+        self.stderr = stderr
 
-def compile_program(prg: List[Operation], file_path: str) -> None:
-    with open(file_path, 'w') as out:
-        out.write('.global _main\n')
-        out.write('.align 2\n')
+    def write(self, fd: int, data) -> None:
+        assert fd in [1, 2], f'Unknown file description: {fd}'
+        if fd != self.fd:
+            self.flush()
+            self.fd = fd
+        self.pending += data
+        if len(self.pending) >= self.size:
+            self.flush()
 
-        # Setup macros
-        setup_macros_and_functions(out)
+    def dump(self, value: int) -> None:
+        if self.fd != 1:
+            self.flush()
+            self.fd = 1
+        self.pending += b'%d\n' % value
+        if len(self.pending) >= self.size:
+            self.flush()
 
-        out.write('_main:\n')
-        assert COUNT_OPS == 28, 'Exhaustive handling of operands in `compile_program`'
-        for op_index in range(len(prg)):
-            op = prg[op_index]
-            out.write(f'label_{op_index}:\n')
-            if op.type == OP_PUSH:
-                # Pushes the value to the stack
-                out.write(f'   ;; -- push {op.value} --\n')
-                out.write(f'   mov x0, #{op.value}\n')
-                out.write('   push x0\n')
-            elif op.type == OP_ADD:
-                # Pops the top two values on the stack and pushes the result
-                out.write('   ;; -- add --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   add x0, x0, x1\n')
-                out.write('   push x0\n')
-            elif op.type == OP_SUB:
-                # Subtracts the top value from the second value on the stack and pushes the result
-                out.write('   ;; -- sub --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   sub x0, x1, x0\n')
-                out.write('   push x0\n')
-            elif op.type == OP_DUMP:
-                # Pops and prints the value at the top of the stack
-                out.write('   ;; -- dump --\n')
-                out.write('   pop x0\n')
-                out.write('   bl dump\n')
-            elif op.type == OP_DROP:
-                # Pops the value at the top of the stack
-                out.write('   ;; -- drop --\n')
-                out.write('   pop x0\n')
-            elif op.type == OP_SWAP:
-                # Pops the top two values on the stack and pushes them back in reverse order
-                out.write('   ;; -- swap --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   push x0\n')
-                out.write('   push x1\n')
-            elif op.type == OP_OVER:
-                # Pops the top two values on the stack and pushes back in order of second, top, second
-                out.write('   ;; -- over --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   push x1\n')
-                out.write('   push x0\n')
-                out.write('   push x1\n')
-            elif op.type == OP_CLONE:
-                # Pops the value at the top of the stack and pushes it back 2 times
-                out.write('   ;; -- clone --\n')
-                out.write('   pop x0\n')
-                out.write('   push x0\n')
-                out.write('   push x0\n')
-            elif op.type == OP_CLONE2:
-                # Pops the top two values on the stack and pushes them back 2 times in same order
-                out.write('   ; -- clone2 --\n')
-                out.write('   pop x1\n')
-                out.write('   pop x0\n')
-                out.write('   push x0\n')
-                out.write('   push x1\n')
-                out.write('   push x0\n')
-                out.write('   push x1\n')
-            elif op.type == OP_EQ:
-                # Pops the top two values on the stack and pushes the result of the EQUAL comparison
-                out.write('   ;; -- eq --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   cmp x0, x1\n')
-                out.write('   cset x0, eq\n')
-                out.write('   push x0\n')
-            elif op.type == OP_GT:
-                # Pops the top two values on the stack and pushes the result of the GREATER THAN comparison
-                out.write('   ;; -- eq --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   cmp x1, x0\n')
-                out.write('   cset x0, gt\n')
-                out.write('   push x0\n')
-            elif op.type == OP_GE:
-                # Pops the top two values on the stack and pushes the result of the GREATER OR EQUAL comparison
-                out.write('   ;; -- eq --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   cmp x1, x0\n')
-                out.write('   cset x0, ge\n')
-                out.write('   push x0\n')
-            elif op.type == OP_LT:
-                # Pops the top two values on the stack and pushes the result of the LOWER THAN comparison
-                out.write('   ;; -- eq --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   cmp x1, x0\n')
-                out.write('   cset x0, lt\n')
-                out.write('   push x0\n')
-            elif op.type == OP_LE:
-                # Pops the top two values on the stack and pushes the result of the LOWER OR EQUAL comparison
-                out.write('   ;; -- eq --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   cmp x1, x0\n')
-                out.write('   cset x0, le\n')
-                out.write('   push x0\n')
-            elif op.type == OP_BOR:
-                # Pops the top two values on the stack and pushes the result of the BITWISE OR operation
-                out.write('   ;; -- bor --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   orr x0, x0, x1\n')
-                out.write('   push x0\n')
-            elif op.type == OP_BAND:
-                # Pops the top two values on the stack and pushes the result of the BITWISE AND operation
-                out.write('   ;; -- band --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   and x0, x0, x1\n')
-                out.write('   push x0\n')
-            elif op.type == OP_SHR:
-                # Pops the top two values on the stack and pushes the result of the SHIFT RIGHT operation
-                out.write('   ;; -- shr --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   lsr x0, x1, x0\n')
-                out.write('   push x0\n')
-            elif op.type == OP_SHL:
-                # Pops the top two values on the stack and pushes the result of the SHIFT LEFT operation
-                out.write('   ;; -- shl --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   lsl x0, x1, x0\n')
-                out.write('   push x0\n')
-            elif op.type == OP_IF:
-                # Pops the top value on the stack and jumps to the END of the IF block if it is 0
-                assert op.jump is not None, "`end` is not referenced in `if` block"
-                out.write('   ;; -- if --\n')
-                out.write('   pop x0\n')
-                out.write(f'   cbz x0, label_{op.jump}\n')
-            elif op.type == OP_ELSE:
-                # Jumps in case IF block was executed, marks the start of the ELSE block
-                assert op.jump is not None, "`end` is not referenced in `else` block"
-                out.write(f'   b label_{op.jump}\n')
-                out.write('   ;; -- else --\n')
-            elif op.type == OP_WHILE:
-                # Marks the start of the WHILE block
-                out.write('   ;; -- while --\n')
-            elif op.type == OP_DO:
-                # Pops the top value on the stack and jumps to the END of the WHILE block if it is 0
-                assert op.jump is not None, "`end` is not referenced in `while-do` block"
-                out.write('   ;; -- do --\n')
-                out.write('   pop x0\n')
-                out.write(f'   cbz x0, label_{op.jump}\n')
-            elif op.type == OP_END:
-                # Marks the end of an IF or ELSE block
-                assert op.jump is not None, "`end` doesn't have reference to the next instruction to jump"
-                out.write('   ;; -- end --\n')
-                out.write(f'   b label_{op.jump}\n')
-            elif op.type == OP_MEM:
-                # Pushes the memory address to the stack
-                out.write('   ;; -- mem --\n')
-                out.write('   adrp x0, mem@PAGE\n')
-                out.write('   add x0, x0, mem@PAGEOFF\n')
-                out.write('   push x0\n')
-            elif op.type == OP_LOAD:
-                # Pops the top value on the stack and pushes the value at that memory address
-                out.write('   ;; -- load --\n')
-                out.write('   pop x0\n')
-                out.write('   ldrb w1, [x0]\n')
-                out.write('   push x1\n')
-            elif op.type == OP_SAVE:
-                # Pops the top two values on the stack and saves the top value to the memory address of the second value
-                out.write('   ;; -- save --\n')
-                out.write('   pop x0\n')
-                out.write('   pop x1\n')
-                out.write('   strb w0, [x1]\n')
-            elif op.type == OP_SYSCALL1:
-                # Pops the top two values on the stack and makes a syscall with the top value as the syscall number and
-                # the second value as the argument
-                out.write('   ;; -- syscall1 --\n')
-                out.write('   pop x16\n')
-                out.write('   pop x0\n')
-                out.write('   svc #0\n')
-            elif op.type == OP_SYSCALL3:
-                # Pops the top four values on the stack and makes a syscall with the top value as the syscall number and
-                # the next three values as the arguments
-                out.write('   ;; -- syscall3 --\n')
-                out.write('   pop x16\n')
-                out.write('   pop x2\n')
-                out.write('   pop x1\n')
-                out.write('   pop x0\n')
-                out.write('   svc #0\n')
-            else:
-                assert False, f'Unhandled instruction {op.type}'
-        out.write(f'label_{op_index + 1}:\n')
-        out.write('   mov x0, #0\n')
-        out.write('   mov x16, #1\n')
-        out.write('   svc #0\n')
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        sink = self.stdout if self.fd == 1 else self.stderr
+        if sink is not None:
+            sink.write(bytes(self.pending))
+            self.pending.clear()
+            return
+        stream = sys.stdout if self.fd == 1 else sys.stderr
+        stream.flush()
+        if hasattr(stream, 'buffer'):
+            stream.buffer.write(self.pending)
+            stream.buffer.flush()
+        else:
+            stream.write(self.pending.decode('utf-8', errors='replace'))
+            stream.flush()
+        self.pending.clear()
 
-        # Allocate memory
-        out.write('.section __DATA, __BSS\n')
-        out.write(f'mem: .skip {MEMORY_ALLOCATION}\n')
 
+def simulate_syscall1(output: OutputBuffer, number: int, arg: int) -> None:
+    """ Simulates a syscall with one argument """
+    # 1 is exit syscall
+    if number == 1:
+        output.flush()
+        raise ProgramExit(arg)
+    else:
+        assert False, f'Unhandled syscall: {number}'
 
-# Find the end of the token value
-def value_end(line: str):
-    end = 0
-    while end + 1 < len(line) and not line[end + 1].isspace():
-        end += 1
-    return end
 
+def simulate_syscall3(output: OutputBuffer, memory: bytearray, number: int, arg1: int, arg2: int, arg3: int) -> None:
+    """ Simulates a syscall with three arguments """
+    # 4 is write syscall
+    if number == 4:
+        if isinstance(memory, CheckedMemory):
+            memory.check(arg2, arg3)
+        with memoryview(memory) as view:
+            output.write(arg1, view[arg2: arg2 + arg3])
+    else:
+        assert False, f'Unhandled syscall: {number}'
 
-# Lexical analysis of a line, finding each token
-def lex_line(line: str) -> Tuple[int, str]:
-    col_start = 0
-    while col_start < len(line):
-        if line[col_start].isspace():
-            col_start += 1
-        else:
-            end = col_start + value_end(line[col_start:]) + 1
-            yield col_start, line[col_start: end]
-            col_start = end
 
+# Mask and sign bit of the values of the `--int64` simulation
+INT64_MASK = 0xFFFFFFFFFFFFFFFF
+INT64_SIGN = 0x8000000000000000
 
-# Lexical analysis of a file, returns a list of tuples containing the Token
-def lex_file(file_path: str) -> List[Token]:
-    with open(file_path, 'r') as f:
-        return [Token(file_path, row, col, word)
-                for (row, line) in enumerate(f.readlines())
-                for (col, word) in lex_line(line.split("#")[0])  # Skip comments
-                ]
 
+def wrap_int64(value: int) -> int:
+    """ Two's-complement 64-bit value of the low 64 bits of `value` """
+    return ((value + INT64_SIGN) & INT64_MASK) - INT64_SIGN
 
-def construct_blocks(prg: List[Operation]) -> List[Operation]:
-    stack = []
-    assert COUNT_OPS == 28, ('Exhaustive handling of operands in `construct_blocks`. Note, not all operations need to '
-                             'be implemented here. Only those that form blocks')
-    for op_index in range(len(prg)):
-        op = prg[op_index]
-        if op.type == OP_IF:
-            stack.append(op_index)
-        elif op.type == OP_ELSE:
-            assert stack, '`else` can be used only with with `if` blocks'
-            block_start = stack.pop()
-            assert prg[block_start].type == OP_IF, '`else` can be used only with with `if` blocks'
-            prg[block_start].jump = op_index + 1
-            stack.append(op_index)
-        elif op.type == OP_WHILE:
-            stack.append(op_index)
-        elif op.type == OP_DO:
-            block_while = stack.pop()
-            prg[op_index].jump = block_while
-            stack.append(op_index)
-        elif op.type == OP_END:
-            assert stack, 'Unnecessary `end` operation'
-            block_start = stack.pop()
-            if prg[block_start].type in [OP_IF, OP_ELSE]:
-                prg[block_start].jump = op_index
-                prg[op_index].jump = op_index + 1
-            elif prg[block_start].type == OP_DO:
-                assert prg[block_start].jump is not None, '`while` is not referenced in `do` block'
-                prg[op_index].jump = prg[block_start].jump
-                prg[block_start].jump = op_index + 1
-            else:
-                assert False, '`end` can be used only with with `if`, `else`, `while-do` blocks'
-    return prg
 
+def fits_int64(*values: int) -> bool:
+    """ Whether all the values are in the range of 64-bit integers """
+    return all(-INT64_SIGN <= value < INT64_SIGN for value in values)
 
-def convert_to_op(token: Token) -> Operation:
-    assert COUNT_OPS == 28, 'Exhaustive handling of operands in `convert_to_op`'
-
-    if token.value == '+':
-        return Operation(OP_ADD, token.get_location())
-    elif token.value == '-':
-        return Operation(OP_SUB, token.get_location())
-    elif token.value == 'dump':
-        return Operation(OP_DUMP, token.get_location())
-    elif token.value == 'drop':
-        return Operation(OP_DROP, token.get_location())
-    elif token.value == 'swap':
-        return Operation(OP_SWAP, token.get_location())
-    elif token.value == 'over':
-        return Operation(OP_OVER, token.get_location())
-    elif token.value == 'clone':
-        return Operation(OP_CLONE, token.get_location())
-    elif token.value == 'clone2':
-        return Operation(OP_CLONE2, token.get_location())
-    elif token.value == '=':
-        return Operation(OP_EQ, token.get_location())
-    elif token.value == '>':
-        return Operation(OP_GT, token.get_location())
-    elif token.value == '>=':
-        return Operation(OP_GE, token.get_location())
-    elif token.value == '<':
-        return Operation(OP_LT, token.get_location())
-    elif token.value == '<=':
-        return Operation(OP_LE, token.get_location())
-    elif token.value == 'bor':
-        return Operation(OP_BOR, token.get_location())
-    elif token.value == 'band':
-        return Operation(OP_BAND, token.get_location())
-    elif token.value == 'shr':
-        return Operation(OP_SHR, token.get_location())
-    elif token.value == 'shl':
-        return Operation(OP_SHL, token.get_location())
-    elif token.value == 'if':
-        return Operation(OP_IF, token.get_location())
-    elif token.value == 'else':
-        return Operation(OP_ELSE, token.get_location())
-    elif token.value == 'end':
-        return Operation(OP_END, token.get_location())
-    elif token.value == 'while':
-        return Operation(OP_WHILE, token.get_location())
-    elif token.value == 'do':
-        return Operation(OP_DO, token.get_location())
-    elif token.value == 'mem':
-        return Operation(OP_MEM, token.get_location())
-    elif token.value == 'load':
-        return Operation(OP_LOAD, token.get_location())
-    elif token.value == 'save':
-        return Operation(OP_SAVE, token.get_location())
-    elif token.value == 'syscall1':
-        return Operation(OP_SYSCALL1, token.get_location())
-    elif token.value == 'syscall3':
-        return Operation(OP_SYSCALL3, token.get_location())
+
+# Operations whose result can leave the 64-bit range, with their wrapping python equivalent for the `--int64`
+# simulation. Shift amounts are taken modulo 64 and `shr` is a logical shift, like `lsl`/`lsr` and `shl`/`shr` of the
+# compiled program
+INT64_OPERATIONS = {
+    OP_ADD: lambda a, b: wrap_int64(a + b),
+    OP_SUB: lambda a, b: wrap_int64(a - b),
+    OP_SHL: lambda a, b: wrap_int64(a << (b & 63)),
+    OP_SHR: lambda a, b: wrap_int64((a & INT64_MASK) >> (b & 63)),
+    OP_ADD_CONST: lambda a, b: wrap_int64(a + b),
+    OP_ADD_MEM: lambda a, b: wrap_int64(a + b),
+}
+
+
+def decode_operation_int64(op: Operation, op_index: int, depth: Optional[int], stack: array) -> Callable[[], int]:
+    """ Builds the handler of an operation of `INT64_OPERATIONS` for the typed stack of the `--int64` simulation, which
+    only holds 64-bit values. `depth` is the static depth of the stack before the operation, `None` for the growing
+    stack """
+    function = INT64_OPERATIONS[op.type]
+    nxt = op_index + 1
+    if op.type in [OP_ADD_CONST, OP_ADD_MEM]:
+        value = op.value
+        top = -1 if depth is None else depth - 1
+
+        def handler():
+            stack[top] = function(stack[top], value)
+            return nxt
+    elif depth is None:
+        pop = stack.pop
+
+        def handler():
+            val_2 = pop()
+            stack[-1] = function(stack[-1], val_2)
+            return nxt
     else:
-        try:
-            return Operation(OP_PUSH, token.get_location(), value=int(token.value))
-        except ValueError as err:
-            print(f"{token}: {err}")
-            exit(1)
+        top = depth - 1
+        second = depth - 2
 
+        def handler():
+            stack[second] = function(stack[second], stack[top])
+            return nxt
+    return handler
 
-def load_program(path: str) -> List:
-    return construct_blocks([convert_to_op(token) for token in lex_file(path)])
 
+def decode_operation(op: Operation, op_index: int, stack: List[int], memory: bytearray,
+                     output: OutputBuffer, int64: bool = False) -> Callable[[], int]:
+    """ Builds a handler bound to the operands of `op`, the handler executes it and returns the index of the next one.
+    With `int64` the stack is an `array('q')` and the values wrap around at 64 bits """
+    if int64 and op.type in OPERAND_OPS:
+        op = Operation(op.type, op.loc, value=wrap_int64(op.value), jump=op.jump)
+    if int64 and op.type in INT64_OPERATIONS:
+        return decode_operation_int64(op, op_index, None, stack)
+    push = stack.append
+    pop = stack.pop
+    nxt = op_index + 1
+    jump = op.jump
+    if op.type == OP_PUSH:
+        value = op.value
 
-def usage(prg: str) -> None:
-    print(f"Usage: {prg} <SUBCOMMAND> [ARGS]")
-    print("SUBCOMMANDS:")
-    print("   sim <file>     Simulate the program")
-    print("   com <file>     Compile the program")
+        def handler():
+            push(value)
+            return nxt
+    elif op.type == OP_ADD:
+        def handler():
+            val_2 = pop()
+            stack[-1] += val_2
+            return nxt
+    elif op.type == OP_SUB:
+        def handler():
+            val_2 = pop()
+            stack[-1] -= val_2
+            return nxt
+    elif op.type == OP_DUMP:
+        dump = output.dump
 
+        def handler():
+            dump(pop())
+            return nxt
+    elif op.type == OP_DROP:
+        def handler():
+            pop()
+            return nxt
+    elif op.type == OP_SWAP:
+        def handler():
+            stack[-1], stack[-2] = stack[-2], stack[-1]
+            return nxt
+    elif op.type == OP_OVER:
+        def handler():
+            push(stack[-2])
+            return nxt
+    elif op.type == OP_CLONE:
+        def handler():
+            push(stack[-1])
+            return nxt
+    elif op.type == OP_CLONE2:
+        def handler():
+            stack.extend(stack[-2:])
+            return nxt
+    elif op.type == OP_EQ:
+        def handler():
+            val_2 = pop()
+            stack[-1] = int(stack[-1] == val_2)
+            return nxt
+    elif op.type == OP_GT:
+        def handler():
+            val_2 = pop()
+            stack[-1] = int(stack[-1] > val_2)
+            return nxt
+    elif op.type == OP_GE:
+        def handler():
+            val_2 = pop()
+            stack[-1] = int(stack[-1] >= val_2)
+            return nxt
+    elif op.type == OP_LT:
+        def handler():
+            val_2 = pop()
+            stack[-1] = int(stack[-1] < val_2)
+            return nxt
+    elif op.type == OP_LE:
+        def handler():
+            val_2 = pop()
+            stack[-1] = int(stack[-1] <= val_2)
+            return nxt
+    elif op.type == OP_BOR:
+        def handler():
+            val_2 = pop()
+            stack[-1] |= val_2
+            return nxt
+    elif op.type == OP_BAND:
+        def handler():
+            val_2 = pop()
+            stack[-1] &= val_2
+            return nxt
+    elif op.type == OP_SHR:
+        def handler():
+            val_2 = pop()
+            stack[-1] >>= val_2
+            return nxt
+    elif op.type == OP_SHL:
+        def handler():
+            val_2 = pop()
+            stack[-1] <<= val_2
+            return nxt
+    elif op.type in [OP_IF, OP_DO]:
+        assert jump is not None, "`end` is not referenced in `if` or `while-do` block"
 
-def call_cmd(cmd: List[str]) -> None:
-    print(cmd)
-    subprocess.call(cmd)
+        def handler():
+            return nxt if pop() else jump
+    elif op.type in [OP_ELSE, OP_END]:
+        assert jump is not None, "`else` or `end` doesn't have reference to the next instruction to jump"
 
+        def handler():
+            return jump
+    elif op.type == OP_WHILE:
+        def handler():
+            return nxt
+    elif op.type == OP_MEM:
+        def handler():
+            push(0)
+            return nxt
+    elif op.type == OP_LOAD:
+        def handler():
+            stack[-1] = memory[stack[-1]]
+            return nxt
+    elif op.type == OP_SAVE:
+        def handler():
+            val_2 = pop()
+            memory[pop()] = val_2 & 0xFF
+            return nxt
+    elif op.type in WIDE_LOADS:
+        size = WIDE_LOADS[op.type]
+        signed = size == 8
 
-if __name__ == '__main__':
-    argv = sys.argv
-    program_name, *argv = argv
+        def handler():
+            address = stack[-1]
+            stack[-1] = int.from_bytes(memory[address: address + size], 'little', signed=signed)
+            return nxt
+    elif op.type in WIDE_SAVES:
+        size = WIDE_SAVES[op.type]
+        mask = (1 << 8 * size) - 1
+
+        def handler():
+            val_2 = pop()
+            address = pop()
+            memory[address: address + size] = (val_2 & mask).to_bytes(size, 'little')
+            return nxt
+    elif op.type in [OP_MEMCPY, OP_MEMSET]:
+        bulk = memory_copy if op.type == OP_MEMCPY else memory_fill
+
+        def handler():
+            val_3 = pop()
+            val_2 = pop()
+            bulk(memory, pop(), val_2, val_3)
+            return nxt
+    elif op.type == OP_SYSCALL1:
+        def handler():
+            val_2 = pop()
+            simulate_syscall1(output, val_2, pop())
+            return nxt
+    elif op.type == OP_SYSCALL3:
+        def handler():
+            val_4 = pop()
+            val_3 = pop()
+            val_2 = pop()
+            simulate_syscall3(output, memory, val_4, pop(), val_2, val_3)
+            return nxt
+    elif op.type == OP_MEM_OFFSET:
+        value = op.value
+
+        def handler():
+            push(value)
+            return nxt
+    elif op.type in [OP_ADD_CONST, OP_ADD_MEM]:
+        value = op.value
+
+        def handler():
+            stack[-1] += value
+            return nxt
+    elif op.type == OP_LOAD_MEM:
+        value = op.value
+
+        def handler():
+            stack[-1] = memory[stack[-1] + value]
+            return nxt
+    elif op.type == OP_CLONE_LOAD_MEM:
+        value = op.value
+
+        def handler():
+            push(memory[stack[-1] + value])
+            return nxt
+    elif op.type in [OP_CMP_IF, OP_CMP_DO]:
+        assert jump is not None, "`end` is not referenced in `if` or `while-do` block"
+        compare = COMPARISONS[op.value][0]
+
+        def handler():
+            val_2 = pop()
+            return nxt if compare(pop(), val_2) else jump
+    else:
+        assert False, f'Unhandled instruction: {op.type}'
+    return handler
+
+
+def decode_program(prg: List[Operation], stack: List[int], memory: bytearray,
+                   output: OutputBuffer, int64: bool = False) -> List[Callable[[], int]]:
+    """ Decodes the program once into a table of handlers, indexed the same way as the operations """
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `decode_operation`'
+    return [decode_operation(prg[op_index], op_index, stack, memory, output, int64) for op_index in range(len(prg))]
+
+
+def simulate_program(prg: List[Operation], output: Optional[OutputBuffer] = None,
+                     memory: Optional[mmap.mmap] = None, int64: bool = False) -> None:
+    """ Threaded-code simulator, every instruction is dispatched directly to its pre-bound handler. With `int64` the
+    values are kept in an `array('q')` and wrap around at 64 bits like in the compiled program """
+    stack = array('q') if int64 else []
+    memory = memory if memory is not None else allocate_memory()
+    output = output if output is not None else OutputBuffer()
+    code = decode_program(prg, stack, memory, output, int64)
+    end = len(code)
+    op_index = 0
+    try:
+        while op_index < end:
+            op_index = code[op_index]()
+    except MemoryAccessError as err:
+        raise MemoryAccessError(f'{format_location(prg[op_index].loc)}: {err}') from None
+    finally:
+        output.flush()
+
+
+# Number of rows in the hot-spot tables printed by `simulate_program_profiled`
+PROFILE_TOP = 20
+
+
+def block_frames(prg: List[Operation]) -> List[str]:
+    """ Names of the blocks enclosing every operation, joined with `;` as in collapsed stacks """
+    frames = []
+    stack = ['main']
+    for op in prg:
+        if op.type == OP_WHILE:
+            stack.append(f'while {format_location(op.loc)}')
+        elif op.type in [OP_ELSE, OP_END] and len(stack) > 1:
+            stack.pop()
+        frames.append(';'.join(stack))
+        if op.type in [OP_IF, OP_CMP_IF]:
+            stack.append(f'if {format_location(op.loc)}')
+        elif op.type == OP_ELSE:
+            stack.append(f'else {format_location(op.loc)}')
+    return frames
+
+
+def write_profile_report(prg: List[Operation], counts: List[int], times: List[int], out: TextIO) -> None:
+    """ Prints the hot spots by operation type and by source location, and the iterations of every `while` loop """
+    total = sum(times) or 1
+    by_type, by_loc = {}, {}
+    for op_index, op in enumerate(prg):
+        if not counts[op_index]:
+            continue
+        for table, key in [(by_type, OP_NAMES[op.type]), (by_loc, format_location(op.loc))]:
+            count, elapsed = table.get(key, (0, 0))
+            table[key] = count + counts[op_index], elapsed + times[op_index]
+    print(f"[PROFILE] {sum(counts)} operations executed in {sum(times) / 1e6:.2f}ms", file=out)
+    for title, table in [('operation', by_type), ('location', by_loc)]:
+        print(f"{title:<32}{'count':>12}{'time':>12}{'%':>8}", file=out)
+        for key, (count, elapsed) in sorted(table.items(), key=lambda item: -item[1][1])[:PROFILE_TOP]:
+            print(f"{key:<32}{count:>12}{elapsed / 1e6:>10.2f}ms{elapsed * 100 / total:>8.1f}", file=out)
+    print(f"{'while loop':<32}{'iterations':>12}", file=out)
+    for op_index, op in enumerate(prg):
+        if op.type in [OP_DO, OP_CMP_DO]:
+            # The `end` closing the loop jumps back to its `while`
+            loop_start = prg[op.jump - 1].jump
+            iterations = counts[op.jump - 1]
+            print(f"{format_location(prg[loop_start].loc):<32}{iterations:>12}", file=out)
+
+
+def write_collapsed_stacks(prg: List[Operation], times: List[int], file_path: str) -> None:
+    """ Writes the time spent in every operation in nanoseconds as collapsed stacks, the input of flamegraph tools """
+    samples = {}
+    for op_index, (frame, op) in enumerate(zip(block_frames(prg), prg)):
+        if times[op_index]:
+            key = f'{frame};{OP_NAMES[op.type]} {format_location(op.loc)}'
+            samples[key] = samples.get(key, 0) + times[op_index]
+    with open(file_path, 'w') as out:
+        for key, elapsed in samples.items():
+            out.write(f'{key} {elapsed}\n')
+
+
+def simulate_program_profiled(prg: List[Operation], collapsed_path: Optional[str] = None,
+                              output: Optional[OutputBuffer] = None, memory: Optional[mmap.mmap] = None,
+                              int64: bool = False) -> None:
+    """ Threaded-code simulator that counts and times every executed operation. It is a separate loop, so the
+    simulators used without profiling pay nothing for it. The report goes to stderr, also when the program exits """
+    stack = array('q') if int64 else []
+    memory = memory if memory is not None else allocate_memory()
+    output = output if output is not None else OutputBuffer()
+    code = decode_program(prg, stack, memory, output, int64)
+    counts = [0] * len(code)
+    times = [0] * len(code)
+    clock = time.perf_counter_ns
+    end = len(code)
+    op_index = 0
+    try:
+        while op_index < end:
+            start = clock()
+            next_index = code[op_index]()
+            times[op_index] += clock() - start
+            counts[op_index] += 1
+            op_index = next_index
+    except MemoryAccessError as err:
+        raise MemoryAccessError(f'{format_location(prg[op_index].loc)}: {err}') from None
+    finally:
+        # The operation that raised, e.g. the `exit` syscall, has run too
+        if op_index < end:
+            counts[op_index] += 1
+        output.flush()
+        write_profile_report(prg, counts, times, sys.stderr)
+        if collapsed_path is not None:
+            write_collapsed_stacks(prg, times, collapsed_path)
+
+
+def decode_operation_static(op: Operation, op_index: int, depth: Optional[int], stack: List[int],
+                            memory: bytearray, output: OutputBuffer, int64: bool = False) -> Callable[[], int]:
+    """ Builds a handler like `decode_operation`, but for a fixed-size stack: the depth of the stack before the
+    operation is known statically, so the handler accesses its slots directly instead of pushing and popping """
+    nxt = op_index + 1
+    jump = op.jump
+    if depth is None:
+        def handler():
+            assert False, f'{format_location(op.loc)}: unreachable operation was executed'
+        return handler
+    if int64 and op.type in OPERAND_OPS:
+        op = Operation(op.type, op.loc, value=wrap_int64(op.value), jump=op.jump)
+    if int64 and op.type in INT64_OPERATIONS:
+        return decode_operation_int64(op, op_index, depth, stack)
+    top = depth - 1
+    second = depth - 2
+    if op.type in [OP_PUSH, OP_MEM_OFFSET]:
+        value = op.value
+
+        def handler():
+            stack[depth] = value
+            return nxt
+    elif op.type == OP_ADD:
+        def handler():
+            stack[second] += stack[top]
+            return nxt
+    elif op.type == OP_SUB:
+        def handler():
+            stack[second] -= stack[top]
+            return nxt
+    elif op.type == OP_DUMP:
+        dump = output.dump
+
+        def handler():
+            dump(stack[top])
+            return nxt
+    elif op.type in [OP_DROP, OP_WHILE]:
+        def handler():
+            return nxt
+    elif op.type == OP_SWAP:
+        def handler():
+            stack[second], stack[top] = stack[top], stack[second]
+            return nxt
+    elif op.type == OP_OVER:
+        def handler():
+            stack[depth] = stack[second]
+            return nxt
+    elif op.type == OP_CLONE:
+        def handler():
+            stack[depth] = stack[top]
+            return nxt
+    elif op.type == OP_CLONE2:
+        def handler():
+            stack[depth] = stack[second]
+            stack[depth + 1] = stack[top]
+            return nxt
+    elif op.type in COMPARISONS:
+        compare = COMPARISONS[op.type][0]
+
+        def handler():
+            stack[second] = int(compare(stack[second], stack[top]))
+            return nxt
+    elif op.type == OP_BOR:
+        def handler():
+            stack[second] |= stack[top]
+            return nxt
+    elif op.type == OP_BAND:
+        def handler():
+            stack[second] &= stack[top]
+            return nxt
+    elif op.type == OP_SHR:
+        def handler():
+            stack[second] >>= stack[top]
+            return nxt
+    elif op.type == OP_SHL:
+        def handler():
+            stack[second] <<= stack[top]
+            return nxt
+    elif op.type in [OP_IF, OP_DO]:
+        def handler():
+            return nxt if stack[top] else jump
+    elif op.type in [OP_ELSE, OP_END]:
+        def handler():
+            return jump
+    elif op.type == OP_MEM:
+        def handler():
+            stack[depth] = 0
+            return nxt
+    elif op.type == OP_LOAD:
+        def handler():
+            stack[top] = memory[stack[top]]
+            return nxt
+    elif op.type == OP_SAVE:
+        def handler():
+            memory[stack[second]] = stack[top] & 0xFF
+            return nxt
+    elif op.type in WIDE_LOADS:
+        size = WIDE_LOADS[op.type]
+        signed = size == 8
+
+        def handler():
+            address = stack[top]
+            stack[top] = int.from_bytes(memory[address: address + size], 'little', signed=signed)
+            return nxt
+    elif op.type in WIDE_SAVES:
+        size = WIDE_SAVES[op.type]
+        mask = (1 << 8 * size) - 1
+
+        def handler():
+            address = stack[second]
+            memory[address: address + size] = (stack[top] & mask).to_bytes(size, 'little')
+            return nxt
+    elif op.type in [OP_MEMCPY, OP_MEMSET]:
+        bulk = memory_copy if op.type == OP_MEMCPY else memory_fill
+
+        def handler():
+            bulk(memory, stack[depth - 3], stack[second], stack[top])
+            return nxt
+    elif op.type == OP_SYSCALL1:
+        def handler():
+            simulate_syscall1(output, stack[top], stack[second])
+            return nxt
+    elif op.type == OP_SYSCALL3:
+        def handler():
+            simulate_syscall3(output, memory, stack[top], stack[depth - 4], stack[depth - 3], stack[second])
+            return nxt
+    elif op.type in [OP_ADD_CONST, OP_ADD_MEM]:
+        value = op.value
+
+        def handler():
+            stack[top] += value
+            return nxt
+    elif op.type == OP_LOAD_MEM:
+        value = op.value
+
+        def handler():
+            stack[top] = memory[stack[top] + value]
+            return nxt
+    elif op.type == OP_CLONE_LOAD_MEM:
+        value = op.value
+
+        def handler():
+            stack[depth] = memory[stack[top] + value]
+            return nxt
+    elif op.type in [OP_CMP_IF, OP_CMP_DO]:
+        compare = COMPARISONS[op.value][0]
+
+        def handler():
+            return nxt if compare(stack[second], stack[top]) else jump
+    else:
+        assert False, f'Unhandled instruction: {op.type}'
+    return handler
+
+
+def decode_program_static(prg: List[Operation], depths: List[Optional[int]], stack: List[int], memory: bytearray,
+                          output: OutputBuffer, int64: bool = False) -> List[Callable[[], int]]:
+    """ Decodes the program verified by `check_stack_effects` into a table of handlers working on fixed stack slots """
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `decode_operation_static`'
+    return [decode_operation_static(prg[op_index], op_index, depths[op_index], stack, memory, output, int64)
+            for op_index in range(len(prg))]
+
+
+def simulate_program_static(prg: List[Operation], depths: List[Optional[int]], max_depth: int,
+                            output: Optional[OutputBuffer] = None, memory: Optional[mmap.mmap] = None,
+                            int64: bool = False) -> None:
+    """ Threaded-code simulator for programs verified by `check_stack_effects`, the stack is preallocated with the
+    maximum depth and every handler knows the slots it works on """
+    stack = array('q', [0]) * max_depth if int64 else [0] * max_depth
+    memory = memory if memory is not None else allocate_memory()
+    output = output if output is not None else OutputBuffer()
+    code = decode_program_static(prg, depths, stack, memory, output, int64)
+    end = len(code)
+    op_index = 0
+    try:
+        while op_index < end:
+            op_index = code[op_index]()
+    except MemoryAccessError as err:
+        raise MemoryAccessError(f'{format_location(prg[op_index].loc)}: {err}') from None
+    finally:
+        output.flush()
+
+
+# Number of instructions `Interpreter` runs between the checks of its budgets
+BUDGET_CHECK_INTERVAL = 1 << 12
+
+
+class Interpreter:
+    """ Simulator for embedding: the program is decoded once and can be run many times. Every run starts with zeroed
+    memory, which is reused instead of allocated again, writes the output to the given sinks and returns the exit code
+    of the program instead of leaving the process. `max_steps` and `timeout` (in seconds of wall time since the start
+    of the run) limit every run, a run going over them raises `BudgetExceeded`. The budgets are checked between the
+    slices of instructions, at least every `BUDGET_CHECK_INTERVAL` instructions, so the timeout may be overrun by that
+    many instructions.
+
+    A run can also be driven slice by slice: `start` prepares it and `resume` continues it for a number of
+    instructions. The whole state of the run, `op_index`, `stack` and `memory`, lives in the object in between """
+
+    def __init__(self, prg: List[Operation], mem_size: int = MEMORY_ALLOCATION, checked: bool = False,
+                 output_buffer: int = OUTPUT_BUFFER_SIZE, max_steps: Optional[int] = None,
+                 timeout: Optional[float] = None, int64: bool = False, memory: Optional[mmap.mmap] = None):
+        self.prg = prg
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.memory = memory if memory is not None else allocate_memory(mem_size, checked)
+        # Only the anonymous memory allocated here can have its pages dropped by `reset`
+        self.owns_memory = memory is None
+        self.output = OutputBuffer(output_buffer)
+        try:
+            depths, max_depth, _ = check_stack_effects(prg)
+        except StackEffectError:
+            # The slots of the verified programs are always written before they are read, only a growing stack needs
+            # to be emptied between the runs
+            self.static = False
+            self.stack = array('q') if int64 else []
+            self.code = decode_program(prg, self.stack, self.memory, self.output, int64)
+        else:
+            self.static = True
+            self.stack = array('q', [0]) * max_depth if int64 else [0] * max_depth
+            self.code = decode_program_static(prg, depths, self.stack, self.memory, self.output, int64)
+        self.end = len(self.code)
+        # The end of the program raises, so the loop can run whole slices of instructions without checking for it
+        self.code.append(self.end_reached)
+        self.op_index = self.end
+        self.steps = 0
+        self.deadline = None
+        self.exit_code = None
+        # Memory given by the caller may hold anything, it is zeroed before the first run too
+        self.dirty = not self.owns_memory
+
+    @staticmethod
+    def end_reached() -> int:
+        raise ProgramEnd()
+
+    @classmethod
+    def from_file(cls, path: str, optimize: bool = True, use_cache: bool = True, **kwargs) -> 'Interpreter':
+        program = load_program_cached(path, optimize, use_cache)
+        return cls(optimize_control_flow(program) if optimize else program, **kwargs)
+
+    def reset(self) -> None:
+        """ Zeroes the memory and empties the stack and the output buffer """
+        if self.dirty:
+            memory = self.memory
+            if self.owns_memory and hasattr(mmap, 'MADV_REMOVE'):
+                # Drops the pages of the shared anonymous mapping, they read as zeroes again and cost nothing
+                memory.madvise(mmap.MADV_REMOVE)
+            else:
+                memory.seek(0)
+                memory.write(bytes(len(memory)))
+                memory.seek(0)
+            self.dirty = False
+        if not self.static:
+            del self.stack[:]
+        self.output.pending.clear()
+        self.output.fd = 1
+
+    def start(self, stdout=None, stderr=None) -> None:
+        """ Prepares a run of the program from the start. The sinks take bytes, the output is discarded without them """
+        self.reset()
+        self.dirty = True
+        self.output.stdout = stdout if stdout is not None else io.BytesIO()
+        self.output.stderr = stderr if stderr is not None else io.BytesIO()
+        self.op_index = 0
+        self.steps = 0
+        self.deadline = time.perf_counter() + self.timeout if self.timeout is not None else None
+        self.exit_code = None
+
+    def resume(self, count: int) -> bool:
+        """ Continues the run for up to `count` instructions. Returns whether the program has finished, its exit code
+        is in `exit_code` then, 0 if it doesn't call the `exit` syscall """
+        op_index = self.op_index
+        end = self.end
+        if op_index == end:
+            return True
+        if self.max_steps is not None:
+            if self.steps >= self.max_steps:
+                self.output.flush()
+                raise BudgetExceeded(f'{format_location(self.prg[op_index].loc)}: '
+                                     f'instruction budget of {self.max_steps} is exhausted')
+            count = min(count, self.max_steps - self.steps)
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            self.output.flush()
+            raise BudgetExceeded(f'{format_location(self.prg[op_index].loc)}: '
+                                 f'time budget of {self.timeout}s is exhausted')
+        code = self.code
+        # The iterations left tell how many instructions ran when the slice ends early
+        iterations = itertools.repeat(None, count)
+        try:
+            for _ in iterations:
+                op_index = code[op_index]()
+        except ProgramEnd:
+            # The iteration reaching the end of the program ran no instruction
+            self.op_index = end
+            self.steps += count - operator.length_hint(iterations) - 1
+            self.exit_code = 0
+            self.output.flush()
+            return True
+        except ProgramExit as err:
+            self.op_index = end
+            self.steps += count - operator.length_hint(iterations)
+            self.exit_code = err.code
+            return True
+        except MemoryAccessError as err:
+            self.op_index = end
+            self.steps += count - operator.length_hint(iterations)
+            self.output.flush()
+            raise MemoryAccessError(f'{format_location(self.prg[op_index].loc)}: {err}') from None
+        self.op_index = op_index
+        self.steps += count
+        if op_index == end:
+            self.exit_code = 0
+            self.output.flush()
+            return True
+        return False
+
+    def run(self, stdout=None, stderr=None) -> int:
+        """ Runs the program from the start to its end and returns its exit code """
+        self.start(stdout, stderr)
+        while not self.resume(BUDGET_CHECK_INTERVAL):
+            pass
+        return self.exit_code
+
+
+# Number of instructions `Scheduler` runs a program for before switching to the next one
+SCHEDULER_SLICE = 1000
+
+
+class Scheduler:
+    """ Runs many `Interpreter`s concurrently on one asyncio event loop. Every program runs for a slice of
+    `slice_size` instructions and yields to the others, the ready programs take turns in a round robin. With
+    `max_running` at most that many programs run at once, the others wait for their turn in order of arrival.
+
+    The output of a program is flushed to its sinks at the end of every slice. Sinks with a `drain` coroutine, like
+    `asyncio.StreamWriter`, are awaited after that, so a slow reader holds back only its own program """
+
+    def __init__(self, slice_size: int = SCHEDULER_SLICE, max_running: Optional[int] = None):
+        assert slice_size > 0, 'Slice must contain at least one instruction'
+        self.slice_size = slice_size
+        self.running = asyncio.Semaphore(max_running) if max_running is not None else None
+
+    async def run(self, vm: Interpreter, stdout=None, stderr=None) -> int:
+        """ Runs the program from the start to its end and returns its exit code """
+        if self.running is None:
+            return await self.run_slices(vm, stdout, stderr)
+        async with self.running:
+            return await self.run_slices(vm, stdout, stderr)
+
+    async def run_slices(self, vm: Interpreter, stdout, stderr) -> int:
+        vm.start(stdout, stderr)
+        drains = [sink.drain for sink in [stdout, stderr] if hasattr(sink, 'drain')]
+        while not vm.resume(self.slice_size):
+            vm.output.flush()
+            for drain in drains:
+                await drain()
+            # Lets every other ready program run its slice before this one continues
+            await asyncio.sleep(0)
+        for drain in drains:
+            await drain()
+        return vm.exit_code
+
+    async def run_all(self, vms: Iterable[Interpreter]) -> List[int]:
+        """ Runs the programs concurrently, discarding their output, and returns their exit codes in order """
+        return await asyncio.gather(*[self.run(vm) for vm in vms])
+
+
+SNAPSHOT_MAGIC = b'QTS\0'
+SNAPSHOT_VERSION = 1
+# Magic, version, number of operations, `-O1`, `--int64`, index of the next operation, steps, digest of the program
+SNAPSHOT_HEADER = struct.Struct('<4sIIBBQQ32s')
+SNAPSHOT_PAGE = mmap.PAGESIZE
+SNAPSHOT_IMAGE_SUFFIX = '.pages'
+# Seconds between the snapshots written by `simulate_checkpointed`
+CHECKPOINT_INTERVAL = 60.0
+
+
+def program_digest(prg: List[Operation]) -> bytes:
+    """ Hash of the decoded operations, a snapshot can be resumed only by exactly the same program """
+    return hashlib.sha256(repr([(op.type, op.value, op.jump) for op in prg]).encode('ascii')).digest()
+
+
+class Checkpoint:
+    """ Snapshots of a run of `Interpreter`. A snapshot is two files: `<path>.pages` is the memory image, the raw pages
+    at their offsets, so a resumed run maps it as its memory and reads only the pages it touches, and `path` holds the
+    state of the run together with a log of the pages changed since the previous snapshot. Only those pages are
+    written: first into the log, which atomically replaces the previous one, then into the image. A snapshot
+    interrupted at any point leaves a consistent one behind, the log is replayed into the image on load """
+
+    def __init__(self, path: str, program_path: str, optimize: bool, int64: bool, image):
+        self.path = path
+        self.program_path = program_path
+        self.optimize = optimize
+        self.int64 = int64
+        self.image = image
+        self.saved = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        # State of the run in the last snapshot, set by `load`
+        self.digest = None
+        self.op_index = 0
+        self.steps = 0
+        self.stack = []
+
+    @classmethod
+    def create(cls, path: str, program_path: str, optimize: bool, int64: bool, mem_size: int) -> 'Checkpoint':
+        """ Starts the snapshots of a new run, the image is all zeroes like its memory """
+        image = open(path + SNAPSHOT_IMAGE_SUFFIX, 'w+b')
+        image.truncate(mem_size)
+        return cls(path, os.path.abspath(program_path), optimize, int64, image)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['Checkpoint']:
+        """ Reads the snapshot and brings its image up to date, returns `None` if it is missing or was written by
+        another version """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < SNAPSHOT_HEADER.size:
+            return None
+        magic, version, count_ops, optimize, int64, op_index, steps, digest = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or count_ops != COUNT_OPS:
+            return None
+        try:
+            image = open(path + SNAPSHOT_IMAGE_SUFFIX, 'r+b')
+        except OSError:
+            return None
+        offset = SNAPSHOT_HEADER.size
+        length, = struct.unpack_from('<I', data, offset)
+        program_path = data[offset + 4: offset + 4 + length].decode('utf-8')
+        offset += 4 + length
+        length, = struct.unpack_from('<Q', data, offset)
+        stack = [int(value) for value in data[offset + 8: offset + 8 + length].split()]
+        offset += 8 + length
+        pages, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        for _ in range(pages):
+            start, length = struct.unpack_from('<QI', data, offset)
+            os.pwrite(image.fileno(), data[offset + 12: offset + 12 + length], start)
+            offset += 12 + length
+        os.fsync(image.fileno())
+        checkpoint = cls(path, program_path, bool(optimize), bool(int64), image)
+        checkpoint.digest = digest
+        checkpoint.op_index = op_index
+        checkpoint.steps = steps
+        checkpoint.stack = stack
+        return checkpoint
+
+    def restore(self, vm: Interpreter) -> None:
+        """ Continues the run of the last snapshot in a new `vm`, which must be using the image as its memory """
+        # The output goes to the streams of the process, like the output of the other simulators
+        vm.output.stdout = vm.output.stderr = None
+        del vm.stack[:]
+        vm.stack.extend(self.stack)
+        vm.op_index = self.op_index
+        vm.steps = self.steps
+        vm.deadline = time.perf_counter() + vm.timeout if vm.timeout is not None else None
+        vm.exit_code = None
+
+    def write(self, vm: Interpreter) -> int:
+        """ Writes a snapshot of the paused run, returns the number of pages written """
+        vm.output.flush()
+        memory = vm.memory
+        saved = self.saved
+        size = len(memory)
+        changed = [start for start in range(0, size, SNAPSHOT_PAGE)
+                   if memory[start: min(start + SNAPSHOT_PAGE, size)] != saved[start: min(start + SNAPSHOT_PAGE, size)]]
+        out = io.BytesIO()
+        out.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, COUNT_OPS, self.optimize, self.int64,
+                                       vm.op_index, vm.steps, program_digest(vm.prg)))
+        encoded = self.program_path.encode('utf-8')
+        out.write(struct.pack('<I', len(encoded)) + encoded)
+        encoded = ' '.join(map(str, vm.stack)).encode('ascii')
+        out.write(struct.pack('<Q', len(encoded)) + encoded)
+        out.write(struct.pack('<I', len(changed)))
+        for start in changed:
+            page = memory[start: min(start + SNAPSHOT_PAGE, size)]
+            out.write(struct.pack('<QI', start, len(page)) + page)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(out.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        for start in changed:
+            os.pwrite(self.image.fileno(), memory[start: min(start + SNAPSHOT_PAGE, size)], start)
+        os.fsync(self.image.fileno())
+        return len(changed)
+
+    def remove(self) -> None:
+        """ Deletes the snapshot once the run has finished """
+        self.saved.close()
+        self.image.close()
+        for path in [self.path, self.path + SNAPSHOT_IMAGE_SUFFIX]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def simulate_checkpointed(vm: Interpreter, checkpoint: Checkpoint, interval: float = CHECKPOINT_INTERVAL) -> None:
+    """ Continues the started or restored run of `vm` to its end, writing a snapshot every `interval` seconds and on
+    SIGUSR1. On SIGTERM a snapshot is written and the simulation stops, to be resumed later. The snapshot is deleted
+    once the program finishes """
+    requests = []
+    handlers = {signum: signal.signal(signum, lambda signum, frame: requests.append(signum))
+                for signum in [signal.SIGUSR1, signal.SIGTERM]}
+    try:
+        deadline = time.monotonic() + interval
+        while not vm.resume(BUDGET_CHECK_INTERVAL):
+            if requests or time.monotonic() >= deadline:
+                pages = checkpoint.write(vm)
+                deadline = time.monotonic() + interval
+                if signal.SIGTERM in requests:
+                    print(f"[SNAPSHOT] {pages} pages written to `{checkpoint.path}` after {vm.steps} operations, "
+                          f"stopped", file=sys.stderr)
+                    exit(128 + signal.SIGTERM)
+                requests.clear()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    checkpoint.remove()
+    if vm.exit_code:
+        raise ProgramExit(vm.exit_code)
+
+
+# Python operators of the binary operations, used by `Transpiler`
+BINARY_OPERATORS = {
+    OP_ADD: '+',
+    OP_SUB: '-',
+    OP_BOR: '|',
+    OP_BAND: '&',
+    OP_SHR: '>>',
+    OP_SHL: '<<',
+    OP_EQ: '==',
+    OP_GT: '>',
+    OP_GE: '>=',
+    OP_LT: '<',
+    OP_LE: '<=',
+}
+
+
+class Transpiler:
+    """ Transpiler of a program into the source of a single python function `program(stack, memory, output)`.
+    Blocks become native `if` and `while` statements. Within a block the values on top of the stack are kept in local
+    variables (`pending`) and only pushed to the real stack before the next block boundary """
+
+    def __init__(self, prg: List[Operation]):
+        self.prg = prg
+        self.lines = []
+        self.indent = 1
+        self.pending = []
+        self.temp_count = 0
+
+    def emit(self, line: str) -> None:
+        self.lines.append('    ' * self.indent + line)
+
+    def temp(self, expression: str) -> str:
+        """ Assigns the expression to a new local variable and returns its name """
+        name = f't{self.temp_count}'
+        self.temp_count += 1
+        self.emit(f'{name} = {expression}')
+        return name
+
+    def take(self, count: int) -> List[str]:
+        """ Removes the top `count` values of the stack, returned in stack order (top value last) """
+        while len(self.pending) < count:
+            self.pending.insert(0, self.temp('pop()'))
+        values = self.pending[len(self.pending) - count:]
+        del self.pending[len(self.pending) - count:]
+        return values
+
+    def peek(self, depth: int) -> str:
+        """ Value at the given depth from the top of the stack, without removing it """
+        if depth < len(self.pending):
+            return self.pending[-1 - depth]
+        return self.temp(f'stack[{len(self.pending) - depth - 1}]')
+
+    def flush(self) -> None:
+        """ Pushes the pending values to the real stack """
+        if len(self.pending) == 1:
+            self.emit(f'push({self.pending[0]})')
+        elif self.pending:
+            self.emit(f'stack.extend(({", ".join(self.pending)}))')
+        self.pending = []
+
+    def condition(self, op: Operation) -> str:
+        """ Condition of the `if` or `do` operation, as a python expression """
+        if op.type in [OP_CMP_IF, OP_CMP_DO]:
+            val_1, val_2 = self.take(2)
+            return f'{val_1} {BINARY_OPERATORS[op.value]} {val_2}'
+        return self.take(1)[0]
+
+    def body(self, op_index: int) -> int:
+        """ Emits an indented block starting at the operation, returns the index of the operation terminating it """
+        self.indent += 1
+        start = len(self.lines)
+        op_index = self.block(op_index)
+        self.flush()
+        if len(self.lines) == start:
+            self.emit('pass')
+        self.indent -= 1
+        return op_index
+
+    def block(self, op_index: int) -> int:
+        """ Emits operations until the end of the block, returns the index of the operation terminating it """
+        while op_index < len(self.prg):
+            op = self.prg[op_index]
+            if op.type in [OP_ELSE, OP_END, OP_DO, OP_CMP_DO]:
+                return op_index
+            elif op.type in [OP_IF, OP_CMP_IF]:
+                condition = self.condition(op)
+                self.flush()
+                self.emit(f'if {condition}:')
+                op_index = self.body(op_index + 1)
+                if self.prg[op_index].type == OP_ELSE:
+                    self.emit('else:')
+                    op_index = self.body(op_index + 1)
+                assert self.prg[op_index].type == OP_END, f'{op_index}: `if` block is not closed with `end`'
+            elif op.type == OP_WHILE:
+                op_index = self.loop(op_index)
+            else:
+                self.operation(op)
+            op_index += 1
+        return op_index
+
+    def loop(self, op_index: int) -> int:
+        """ Emits the `while` loop starting at the operation, returns the index of the `end` closing it """
+        self.flush()
+        self.emit('while True:')
+        self.indent += 1
+        loop_start = op_index
+        op_index = self.block(op_index + 1)
+        assert self.prg[op_index].type in [OP_DO, OP_CMP_DO], f'{op_index}: `while` is not followed by `do`'
+        condition = self.condition(self.prg[op_index])
+        self.flush()
+        self.emit(f'if not ({condition}):')
+        self.emit('    break')
+        self.iteration(loop_start)
+        self.indent -= 1
+        op_index = self.body(op_index + 1)
+        assert self.prg[op_index].type == OP_END, f'{op_index}: `while-do` block is not closed with `end`'
+        return op_index
+
+    def iteration(self, loop_start: int) -> None:
+        """ Called at the start of every iteration of the loop, after its condition """
+        pass
+
+    def operation(self, op: Operation) -> None:
+        """ Emits a single operation that is not a block operation """
+        assert COUNT_OPS == 43, 'Exhaustive handling of operands in `Transpiler.operation`'
+        if op.type in [OP_PUSH, OP_MEM_OFFSET]:
+            self.pending.append(str(op.value))
+        elif op.type == OP_MEM:
+            self.pending.append('0')
+        elif op.type in [OP_EQ, OP_GT, OP_GE, OP_LT, OP_LE]:
+            val_1, val_2 = self.take(2)
+            self.pending.append(self.temp(f'int({val_1} {BINARY_OPERATORS[op.type]} {val_2})'))
+        elif op.type in BINARY_OPERATORS:
+            val_1, val_2 = self.take(2)
+            self.pending.append(self.temp(f'{val_1} {BINARY_OPERATORS[op.type]} {val_2}'))
+        elif op.type == OP_DUMP:
+            self.emit(f'output.dump({self.take(1)[0]})')
+        elif op.type == OP_DROP:
+            self.take(1)
+        elif op.type == OP_SWAP:
+            val_1, val_2 = self.take(2)
+            self.pending += [val_2, val_1]
+        elif op.type == OP_OVER:
+            self.pending.append(self.peek(1))
+        elif op.type == OP_CLONE:
+            self.pending.append(self.peek(0))
+        elif op.type == OP_CLONE2:
+            val_1 = self.peek(1)
+            val_2 = self.peek(0)
+            self.pending += [val_1, val_2]
+        elif op.type == OP_LOAD:
+            self.pending.append(self.temp(f'memory[{self.take(1)[0]}]'))
+        elif op.type == OP_SAVE:
+            val_1, val_2 = self.take(2)
+            if val_2.lstrip('-').isdigit():
+                self.emit(f'memory[{val_1}] = {int(val_2) & 0xFF}')
+            else:
+                self.emit(f'memory[{val_1}] = {val_2} & 0xFF')
+        elif op.type in WIDE_LOADS:
+            size = WIDE_LOADS[op.type]
+            val_1, = self.take(1)
+            self.pending.append(self.temp(f"int.from_bytes(memory[{val_1}: {val_1} + {size}], 'little', "
+                                          f"signed={size == 8})"))
+        elif op.type in WIDE_SAVES:
+            size = WIDE_SAVES[op.type]
+            val_1, val_2 = self.take(2)
+            self.emit(f"memory[{val_1}: {val_1} + {size}] = "
+                      f"({val_2} & {(1 << 8 * size) - 1}).to_bytes({size}, 'little')")
+        elif op.type in [OP_MEMCPY, OP_MEMSET]:
+            val_1, val_2, val_3 = self.take(3)
+            self.emit(f'{"memory_copy" if op.type == OP_MEMCPY else "memory_fill"}(memory, {val_1}, {val_2}, {val_3})')
+        elif op.type == OP_SYSCALL1:
+            val_1, val_2 = self.take(2)
+            self.emit(f'simulate_syscall1(output, {val_2}, {val_1})')
+        elif op.type == OP_SYSCALL3:
+            val_1, val_2, val_3, val_4 = self.take(4)
+            self.emit(f'simulate_syscall3(output, memory, {val_4}, {val_1}, {val_2}, {val_3})')
+        elif op.type in [OP_ADD_CONST, OP_ADD_MEM]:
+            val_1, = self.take(1)
+            self.pending.append(self.temp(f'{val_1} + {op.value}') if op.value else val_1)
+        elif op.type == OP_LOAD_MEM:
+            val_1, = self.take(1)
+            self.pending.append(self.temp(f'memory[{val_1} + {op.value}]' if op.value else f'memory[{val_1}]'))
+        elif op.type == OP_CLONE_LOAD_MEM:
+            val_1 = self.peek(0)
+            self.pending.append(self.temp(f'memory[{val_1} + {op.value}]' if op.value else f'memory[{val_1}]'))
+        else:
+            assert False, f'Unhandled instruction: {op.type}'
+
+    def transpile(self) -> str:
+        self.emit('push = stack.append')
+        self.emit('pop = stack.pop')
+        op_index = self.block(0)
+        assert op_index == len(self.prg), f'{op_index}: `else`, `do` or `end` without a block to close'
+        self.emit('pass')
+        return 'def program(stack, memory, output):\n' + '\n'.join(self.lines) + '\n'
+
+
+def transpile_program(prg: List[Operation]) -> str:
+    """ Transpiles the program into the source of a python function `program(stack, memory, output)` """
+    return Transpiler(prg).transpile()
+
+
+def transpiler_namespace() -> dict:
+    """ Globals of the transpiled functions """
+    return {'simulate_syscall1': simulate_syscall1, 'simulate_syscall3': simulate_syscall3,
+            'memory_copy': memory_copy, 'memory_fill': memory_fill}
+
+
+def simulate_transpiled(prg: List[Operation], file_path: str = '<program>', output: Optional[OutputBuffer] = None,
+                        memory: Optional[mmap.mmap] = None) -> None:
+    """ Simulates the program by transpiling it into a python function, compiled once and called with the memory.
+    Errors of `CheckedMemory` can't be traced back to an operation here, so they come without a location """
+    namespace = transpiler_namespace()
+    exec(compile(transpile_program(prg), f'<transpiled {file_path}>', 'exec'), namespace)
+    output = output if output is not None else OutputBuffer()
+    try:
+        namespace['program']([], memory if memory is not None else allocate_memory(), output)
+    finally:
+        output.flush()
+
+
+class LoopTranspiler(Transpiler):
+    """ Transpiler of a single `while` loop into the source of a python function `loop(stack, memory, output, counts)`
+    running it until its condition fails. The iterations of the loop and of the loops nested in it are counted in
+    local variables and added to `counts` by the index of their `while`, also when the program exits inside """
+
+    def __init__(self, prg: List[Operation], loop_start: int):
+        super().__init__(prg)
+        self.loop_start = loop_start
+        self.counters = []
+
+    def iteration(self, loop_start: int) -> None:
+        self.counters.append(loop_start)
+        self.emit(f'n{loop_start} += 1')
+
+    def transpile(self) -> str:
+        self.indent = 2
+        self.loop(self.loop_start)
+        self.flush()
+        counters = [f'n{loop_start}' for loop_start in self.counters]
+        return '\n'.join(['def loop(stack, memory, output, counts):',
+                          '    push = stack.append',
+                          '    pop = stack.pop',
+                          f'    {" = ".join(counters)} = 0',
+                          '    try:',
+                          *self.lines,
+                          '    finally:',
+                          *[f'        counts[{loop_start}] += n{loop_start}' for loop_start in self.counters]]) + '\n'
+
+
+# Number of backward jumps to its `while` after which `simulate_program_jit` compiles a loop
+JIT_THRESHOLD = 100
+
+
+def write_jit_report(prg: List[Operation], interpreted: List[int], compiled: List[int], hot: List[int],
+                     threshold: int, out: TextIO) -> None:
+    """ Prints every `while` loop, whether it was compiled and its iterations in both tiers """
+    loops = [op_index for op_index, op in enumerate(prg) if op.type == OP_WHILE]
+    print(f"[JIT] {len(hot)} of {len(loops)} loops compiled after {threshold} iterations", file=out)
+    print(f"{'while loop':<32}{'tier':>10}{'interpreted':>14}{'compiled':>14}", file=out)
+    for loop_start in loops:
+        tier = 'compiled' if loop_start in hot else 'threaded'
+        print(f"{format_location(prg[loop_start].loc):<32}{tier:>10}{interpreted[loop_start]:>14}"
+              f"{compiled[loop_start]:>14}", file=out)
+
+
+def simulate_program_jit(prg: List[Operation], output: Optional[OutputBuffer] = None,
+                         memory: Optional[mmap.mmap] = None, threshold: int = JIT_THRESHOLD,
+                         report: Optional[TextIO] = None) -> None:
+    """ Tiered simulator: the threaded-code handlers run the program and count the jumps back to every `while`. A loop
+    taken `threshold` times is transpiled by `LoopTranspiler` into a python function running whole iterations without
+    dispatch, its `while` handler calls it from then on and the threaded code continues after the loop. Loops nested
+    in a compiled loop are compiled with it. With `report` the loops are printed to it, also when the program exits """
+    stack = []
+    memory = memory if memory is not None else allocate_memory()
+    output = output if output is not None else OutputBuffer()
+    code = decode_program(prg, stack, memory, output)
+    interpreted = [0] * len(code)
+    compiled = [0] * len(code)
+    hot = []
+
+    def compile_loop(loop_start: int, loop_end: int) -> None:
+        namespace = transpiler_namespace()
+        location = format_location(prg[loop_start].loc)
+        exec(compile(LoopTranspiler(prg, loop_start).transpile(), f'<loop {location}>', 'exec'), namespace)
+        loop = namespace['loop']
+        after = loop_end + 1
+        hot.append(loop_start)
+
+        def handler():
+            loop(stack, memory, output, compiled)
+            return after
+        code[loop_start] = handler
+
+    def backward_jump(loop_start: int, loop_end: int) -> Callable[[], int]:
+        """ Handler of the `end` closing a loop, compiles the loop once it gets hot """
+        def handler():
+            interpreted[loop_start] += 1
+            if interpreted[loop_start] >= threshold:
+                compile_loop(loop_start, loop_end)
+                code[loop_end] = jump
+            return loop_start
+
+        def jump():
+            return loop_start
+        return handler
+
+    for op_index, op in enumerate(prg):
+        if op.type == OP_END and op.jump < len(prg) and prg[op.jump].type == OP_WHILE:
+            code[op_index] = backward_jump(op.jump, op_index)
+    end = len(code)
+    op_index = 0
+    try:
+        while op_index < end:
+            op_index = code[op_index]()
+    except MemoryAccessError as err:
+        raise MemoryAccessError(f'{format_location(prg[op_index].loc)}: {err}') from None
+    finally:
+        output.flush()
+        if report is not None:
+            write_jit_report(prg, interpreted, compiled, hot, threshold, report)
+
+
+# Vectorized binary operations of `LaneSimulator`, the shifts are handled separately
+LANE_OPERATIONS = {
+    OP_ADD: operator.add,
+    OP_SUB: operator.sub,
+    OP_BOR: operator.or_,
+    OP_BAND: operator.and_,
+}
+
+
+class LaneSimulator:
+    """ Simulator running one program over many lanes at once with NumPy, every lane with its own memory image. The
+    stack is a 2-D array of lanes by depth, which needs the depths of `check_stack_effects`, and the memory a 2-D array
+    of lanes by bytes. Every operation runs once for all the active lanes. Divergent `if` and `while` blocks run with a
+    mask of the lanes taking them, the lanes join again after the block. Values are 64-bit integers that wrap around
+    like in the compiled programs. Output is collected per lane, `exit` syscalls end their lanes only """
+
+    def __init__(self, prg: List[Operation], memory):
+        assert numpy is not None, 'LaneSimulator requires numpy'
+        self.prg = list(prg)
+        self.depths, max_depth, _ = check_stack_effects(self.prg)
+        self.memory = memory
+        lanes, self.size = memory.shape
+        self.stack = numpy.zeros((lanes, max(max_depth, 1)), dtype=numpy.int64)
+        self.alive = numpy.ones(lanes, dtype=bool)
+        self.exit_codes = numpy.zeros(lanes, dtype=numpy.int64)
+        self.outputs = [[bytearray() for _ in range(lanes)] for _ in range(2)]
+        # `do` of every `while`, found through the `end` the `do` jumps past
+        self.loops = {}
+        for op_index, op in enumerate(self.prg):
+            if op.type in [OP_DO, OP_CMP_DO]:
+                self.loops[self.prg[op.jump - 1].jump] = op_index
+
+    def run(self, start: int, end: int, mask) -> None:
+        """ Runs the operations in `[start, end)` on the lanes of the mask, the range must contain whole blocks """
+        prg = self.prg
+        op_index = start
+        while op_index < end:
+            op = prg[op_index]
+            if op.type in [OP_IF, OP_CMP_IF]:
+                condition = self.condition(op_index)
+                has_else = prg[op.jump - 1].type == OP_ELSE and op.jump - 1 > op_index
+                block_end = prg[op.jump - 1].jump if has_else else op.jump
+                taken = mask & condition
+                if taken.any():
+                    self.run(op_index + 1, op.jump - 1 if has_else else op.jump, taken)
+                if has_else:
+                    taken = mask & ~condition
+                    if taken.any():
+                        self.run(op.jump, block_end, taken)
+                assert prg[block_end].type == OP_END, f'{format_location(op.loc)}: `if` block is not closed with `end`'
+                op_index = block_end + 1
+            elif op.type == OP_WHILE:
+                assert op_index in self.loops, f'{format_location(op.loc)}: `while` is not followed by `do`'
+                do_index = self.loops[op_index]
+                block_end = prg[do_index].jump - 1
+                taken = mask
+                while True:
+                    self.run(op_index + 1, do_index, taken)
+                    taken = taken & self.alive & self.condition(do_index)
+                    if not taken.any():
+                        break
+                    self.run(do_index + 1, block_end, taken)
+                    taken = taken & self.alive
+                    if not taken.any():
+                        break
+                op_index = block_end + 1
+            else:
+                assert op.type not in [OP_ELSE, OP_END, OP_DO, OP_CMP_DO], \
+                    f'{format_location(op.loc)}: `{OP_NAMES[op.type]}` outside of its block, the program must keep ' \
+                    f'the nesting of the blocks'
+                self.operation(op_index, mask)
+                op_index += 1
+                if op.type != OP_SYSCALL1:
+                    continue
+            # Lanes may have exited in the operation or the block
+            mask = mask & self.alive
+            if not mask.any():
+                return
+
+    def condition(self, op_index: int):
+        """ Lanes where the condition of the `if` or `do` operation is true """
+        op = self.prg[op_index]
+        depth = self.depths[op_index]
+        if op.type in [OP_CMP_IF, OP_CMP_DO]:
+            return COMPARISONS[op.value][0](self.stack[:, depth - 2], self.stack[:, depth - 1])
+        return self.stack[:, depth - 1] != 0
+
+    def addresses(self, op_index: int, lanes, addresses, size: int = 1):
+        """ Checks that the memory accesses of the lanes are in bounds """
+        if len(addresses) and (addresses.min() < 0 or addresses.max() + size > self.size):
+            lane = lanes[numpy.argmax((addresses < 0) | (addresses + size > self.size))]
+            raise MemoryAccessError(f'{format_location(self.prg[op_index].loc)}: memory access out of bounds in lane '
+                                    f'{lane}, memory size is {self.size}')
+        return addresses
+
+    def operation(self, op_index: int, mask) -> None:
+        """ Runs a single operation that is not a block operation on the lanes of the mask """
+        assert COUNT_OPS == 43, 'Exhaustive handling of operands in `LaneSimulator.operation`'
+        op = self.prg[op_index]
+        stack = self.stack
+        top = self.depths[op_index] - 1
+
+        def store(slot: int, values) -> None:
+            numpy.copyto(stack[:, slot], values, where=mask)
+
+        if op.type in [OP_PUSH, OP_MEM, OP_MEM_OFFSET]:
+            store(top + 1, wrap_int64(op.value or 0))
+        elif op.type in LANE_OPERATIONS:
+            store(top - 1, LANE_OPERATIONS[op.type](stack[:, top - 1], stack[:, top]))
+        elif op.type in COMPARISONS:
+            store(top - 1, COMPARISONS[op.type][0](stack[:, top - 1], stack[:, top]))
+        elif op.type in [OP_SHL, OP_SHR]:
+            # Shifted as unsigned values, so `shr` is logical, by the amount modulo 64 like `lsl`/`lsr`
+            amount = (stack[:, top] & 63).astype(numpy.uint64)
+            values = stack[:, top - 1].view(numpy.uint64)
+            store(top - 1, (values << amount if op.type == OP_SHL else values >> amount).view(numpy.int64))
+        elif op.type == OP_DUMP:
+            outputs = self.outputs[0]
+            for lane in numpy.flatnonzero(mask):
+                outputs[lane] += b'%d\n' % stack[lane, top]
+        elif op.type == OP_DROP:
+            pass
+        elif op.type == OP_SWAP:
+            values = stack[:, top - 1].copy()
+            store(top - 1, stack[:, top])
+            store(top, values)
+        elif op.type == OP_OVER:
+            store(top + 1, stack[:, top - 1])
+        elif op.type == OP_CLONE:
+            store(top + 1, stack[:, top])
+        elif op.type == OP_CLONE2:
+            store(top + 1, stack[:, top - 1])
+            store(top + 2, stack[:, top])
+        elif op.type in [OP_ADD_CONST, OP_ADD_MEM]:
+            store(top, stack[:, top] + wrap_int64(op.value))
+        elif op.type in [OP_LOAD, OP_LOAD_MEM, OP_CLONE_LOAD_MEM]:
+            lanes = numpy.flatnonzero(mask)
+            addresses = self.addresses(op_index, lanes, stack[lanes, top] + (op.value if op.type != OP_LOAD else 0))
+            stack[lanes, top + (op.type == OP_CLONE_LOAD_MEM)] = self.memory[lanes, addresses]
+        elif op.type == OP_SAVE:
+            lanes = numpy.flatnonzero(mask)
+            addresses = self.addresses(op_index, lanes, stack[lanes, top - 1])
+            self.memory[lanes, addresses] = stack[lanes, top] & 0xFF
+        elif op.type in WIDE_LOADS:
+            size = WIDE_LOADS[op.type]
+            lanes = numpy.flatnonzero(mask)
+            addresses = self.addresses(op_index, lanes, stack[lanes, top], size)
+            values = numpy.zeros(len(lanes), dtype=numpy.uint64)
+            for byte in range(size):
+                values |= self.memory[lanes, addresses + byte].astype(numpy.uint64) << numpy.uint64(8 * byte)
+            stack[lanes, top] = values.view(numpy.int64)
+        elif op.type in WIDE_SAVES:
+            size = WIDE_SAVES[op.type]
+            lanes = numpy.flatnonzero(mask)
+            addresses = self.addresses(op_index, lanes, stack[lanes, top - 1], size)
+            values = stack[lanes, top].view(numpy.uint64)
+            for byte in range(size):
+                self.memory[lanes, addresses + byte] = (values >> numpy.uint64(8 * byte)) & numpy.uint64(0xFF)
+        elif op.type in [OP_MEMCPY, OP_MEMSET]:
+            for lane in numpy.flatnonzero(mask):
+                dst, src, count = (int(value) for value in stack[lane, top - 2: top + 1])
+                if count <= 0:
+                    continue
+                if op.type == OP_MEMCPY:
+                    self.addresses(op_index, [lane], numpy.array([dst, src]), count)
+                    self.memory[lane, dst: dst + count] = self.memory[lane, src: src + count].copy()
+                else:
+                    # `src` is the value to fill with
+                    self.addresses(op_index, [lane], numpy.array([dst]), count)
+                    self.memory[lane, dst: dst + count] = src & 0xFF
+        elif op.type == OP_SYSCALL1:
+            lanes = numpy.flatnonzero(mask)
+            # 1 is exit syscall
+            assert (stack[lanes, top] == 1).all(), f'Unhandled syscall: {stack[lanes, top]}'
+            self.exit_codes[lanes] = stack[lanes, top - 1]
+            self.alive[lanes] = False
+        elif op.type == OP_SYSCALL3:
+            for lane in numpy.flatnonzero(mask):
+                fd, address, count, number = (int(value) for value in stack[lane, top - 3: top + 1])
+                # 4 is write syscall
+                assert number == 4, f'Unhandled syscall: {number}'
+                assert fd in [1, 2], f'Unknown file description: {fd}'
+                self.addresses(op_index, [lane], numpy.array([address]), count)
+                self.outputs[fd - 1][lane] += self.memory[lane, address: address + count].tobytes()
+        else:
+            assert False, f'Unhandled instruction: {op.type}'
+
+
+def simulate_lanes(prg: List[Operation], memory) -> Tuple[List[bytes], List[bytes], 'numpy.ndarray']:
+    """ Runs the program over every lane of `memory`, a 2-D `uint8` NumPy array with the memory image of one lane per
+    row, changed in place. The program must keep the nesting of the blocks, so it can't come from
+    `optimize_control_flow`. Returns the stdout and stderr of every lane and their exit codes """
+    if numpy is None:
+        raise ImportError('simulate_lanes requires numpy')
+    simulator = LaneSimulator(prg, memory)
+    simulator.run(0, len(simulator.prg), simulator.alive.copy())
+    return [bytes(output) for output in simulator.outputs[0]], [bytes(output) for output in simulator.outputs[1]], \
+        simulator.exit_codes
+
+
+# Load and store instructions of the Apple ARM64 target by the size of the value in bytes
+ARM64_LOADS = {2: 'ldrh', 4: 'ldr', 8: 'ldr'}
+ARM64_STORES = {2: 'strh', 4: 'str', 8: 'str'}
+
+
+def setup_macros_and_functions(out: TextIO, output_buffer: int = 0) -> None:
+    """ Initial macros and functions setup. With `output_buffer` set, `dump` appends to the output buffer instead of
+    making a syscall """
+
+    # Macros for pushing and popping from the stack
+    out.write('.macro push Xn:req\n')
+    out.write('   str \\Xn, [sp, #-16]!\n')
+    out.write('.endm\n')
+    out.write('.macro pop Xn:req\n')
+    out.write('   ldr \\Xn, [sp], #16\n')
+    out.write('.endm\n')
+
+    # Dump function
+    # Prints signed value in x0 followed by a new line, the digits are those of its absolute value
+    out.write('dump:\n')
+    out.write('   stp x29, x30, [sp, -48]!\n')
+    out.write('   mov x8, x0\n')
+    out.write('   cmp x0, 0\n')
+    out.write('   cneg x0, x0, lt\n')
+    out.write('   mov x7, -3689348814741910324\n')
+    out.write('   mov w3, 10\n')
+    out.write('   mov x29, sp\n')
+    out.write('   add x1, sp, 16\n')
+    out.write('   mov x2, 1\n')
+    out.write('   movk x7, 0xcccd, lsl 0\n')
+    out.write('   strb w3, [sp, 47]\n')
+    out.write('.L2:\n')
+    out.write('   umulh x4, x0, x7\n')
+    out.write('   sub x5, x1, x2\n')
+    out.write('   mov x6, x0\n')
+    out.write('   add x2, x2, 1\n')
+    out.write('   lsr x4, x4, 3\n')
+    out.write('   add x3, x4, x4, lsl 2\n')
+    out.write('   sub x3, x0, x3, lsl 1\n')
+    out.write('   mov x0, x4\n')
+    out.write('   add w3, w3, 48\n')
+    out.write('   strb w3, [x5, 31]\n')
+    out.write('   cmp x6, 9\n')
+    out.write('   bhi .L2\n')
+    out.write('   sub x1, x1, x2\n')
+    out.write('   add x1, x1, 32\n')
+    out.write('   tbz x8, 63, .Ldump_write\n')
+    out.write('   mov w3, 45\n')
+    out.write('   strb w3, [x1, -1]!\n')
+    out.write('   add x2, x2, 1\n')
+    out.write('.Ldump_write:\n')
+    out.write('   mov w0, 1\n')
+    if output_buffer:
+        out.write('   bl buffer_write\n')
+    else:
+        out.write('   mov x16, 4\n')
+        out.write('   svc #0\n')
+    out.write('   ldp x29, x30, [sp], 48\n')
+    out.write('   ret\n')
+
+    # Memory copy function
+    # Copies x2 bytes from x1 to x0, backwards when the destination is after the source so the ranges may overlap
+    out.write('memory_copy:\n')
+    out.write('   cmp x2, 0\n')
+    out.write('   b.le .Lcopy_done\n')
+    out.write('   cmp x0, x1\n')
+    out.write('   b.ls .Lcopy_forward\n')
+    out.write('.Lcopy_backward:\n')
+    out.write('   sub x2, x2, 1\n')
+    out.write('   ldrb w3, [x1, x2]\n')
+    out.write('   strb w3, [x0, x2]\n')
+    out.write('   cbnz x2, .Lcopy_backward\n')
+    out.write('   ret\n')
+    out.write('.Lcopy_forward:\n')
+    out.write('   mov x4, 0\n')
+    out.write('.Lcopy_loop:\n')
+    out.write('   ldrb w3, [x1, x4]\n')
+    out.write('   strb w3, [x0, x4]\n')
+    out.write('   add x4, x4, 1\n')
+    out.write('   cmp x4, x2\n')
+    out.write('   b.lt .Lcopy_loop\n')
+    out.write('.Lcopy_done:\n')
+    out.write('   ret\n')
+
+    # Memory fill function
+    # Fills x2 bytes at x0 with the low byte of x1
+    out.write('memory_fill:\n')
+    out.write('   cmp x2, 0\n')
+    out.write('   b.le .Lfill_done\n')
+    out.write('.Lfill_loop:\n')
+    out.write('   strb w1, [x0], 1\n')
+    out.write('   subs x2, x2, 1\n')
+    out.write('   b.ne .Lfill_loop\n')
+    out.write('.Lfill_done:\n')
+    out.write('   ret\n')
+
+    if output_buffer:
+        setup_arm64_output_buffer(out, output_buffer)
+
+
+def setup_arm64_output_buffer(out: TextIO, size: int) -> None:
+    """ Runtime of the output buffer for the Apple ARM64 target. Writes to stdout are collected in `outbuf`, which is
+    flushed when it is full, before any other syscall and at exit """
+
+    # Buffer write function
+    # Appends x2 bytes at x1 to the buffer, flushing it first if they don't fit. Writes larger than the buffer go out
+    # directly
+    out.write('buffer_write:\n')
+    out.write('   stp x29, x30, [sp, -32]!\n')
+    out.write('   mov x29, sp\n')
+    out.write('   adrp x3, outbuf_len@PAGE\n')
+    out.write('   add x3, x3, outbuf_len@PAGEOFF\n')
+    out.write('   ldr x4, [x3]\n')
+    out.write('   add x5, x4, x2\n')
+    write_arm64_immediate(out, 'x6', size)
+    out.write('   cmp x5, x6\n')
+    out.write('   b.ls .Lbuffer_copy\n')
+    out.write('   stp x1, x2, [sp, 16]\n')
+    out.write('   bl flush_output\n')
+    out.write('   ldp x1, x2, [sp, 16]\n')
+    out.write('   adrp x3, outbuf_len@PAGE\n')
+    out.write('   add x3, x3, outbuf_len@PAGEOFF\n')
+    out.write('   mov x4, 0\n')
+    write_arm64_immediate(out, 'x6', size)
+    out.write('   cmp x2, x6\n')
+    out.write('   b.ls .Lbuffer_copy\n')
+    out.write('   mov x0, 1\n')
+    out.write('   mov x16, 4\n')
+    out.write('   svc #0\n')
+    out.write('   b .Lbuffer_done\n')
+    out.write('.Lbuffer_copy:\n')
+    out.write('   adrp x5, outbuf@PAGE\n')
+    out.write('   add x5, x5, outbuf@PAGEOFF\n')
+    out.write('   add x5, x5, x4\n')
+    out.write('   add x4, x4, x2\n')
+    out.write('   str x4, [x3]\n')
+    out.write('.Lbuffer_loop:\n')
+    out.write('   cbz x2, .Lbuffer_done\n')
+    out.write('   ldrb w6, [x1], 1\n')
+    out.write('   strb w6, [x5], 1\n')
+    out.write('   sub x2, x2, 1\n')
+    out.write('   b .Lbuffer_loop\n')
+    out.write('.Lbuffer_done:\n')
+    out.write('   ldp x29, x30, [sp], 32\n')
+    out.write('   ret\n')
+
+    # Flush function
+    # Writes the buffer to stdout and empties it
+    out.write('flush_output:\n')
+    out.write('   adrp x3, outbuf_len@PAGE\n')
+    out.write('   add x3, x3, outbuf_len@PAGEOFF\n')
+    out.write('   ldr x2, [x3]\n')
+    out.write('   cbz x2, .Lflush_done\n')
+    out.write('   adrp x1, outbuf@PAGE\n')
+    out.write('   add x1, x1, outbuf@PAGEOFF\n')
+    out.write('   mov x0, 1\n')
+    out.write('   mov x16, 4\n')
+    out.write('   svc #0\n')
+    out.write('   adrp x3, outbuf_len@PAGE\n')
+    out.write('   add x3, x3, outbuf_len@PAGEOFF\n')
+    out.write('   str xzr, [x3]\n')
+    out.write('.Lflush_done:\n')
+    out.write('   ret\n')
+
+    # Buffered syscall function
+    # Makes the syscall in x16 with the arguments in x0, x1 and x2. Writes to stdout go to the buffer, any other
+    # syscall flushes it first
+    out.write('buffered_syscall:\n')
+    out.write('   cmp x16, 4\n')
+    out.write('   b.ne .Lsyscall_flush\n')
+    out.write('   cmp x0, 1\n')
+    out.write('   b.eq buffer_write\n')
+    out.write('.Lsyscall_flush:\n')
+    out.write('   stp x29, x30, [sp, -48]!\n')
+    out.write('   stp x0, x1, [sp, 16]\n')
+    out.write('   stp x2, x16, [sp, 32]\n')
+    out.write('   bl flush_output\n')
+    out.write('   ldp x0, x1, [sp, 16]\n')
+    out.write('   ldp x2, x16, [sp, 32]\n')
+    out.write('   ldp x29, x30, [sp], 48\n')
+    out.write('   svc #0\n')
+    out.write('   ret\n')
+
+
+def write_arm64_immediate(out: TextIO, reg: str, value: int) -> None:
+    """ Moves a 64-bit immediate into the register, 16 bits at a time when it doesn't fit into a single `mov` """
+    value &= 0xFFFFFFFFFFFFFFFF
+    if value < 0x10000:
+        out.write(f'   mov {reg}, #{value}\n')
+        return
+    out.write(f'   movz {reg}, #{value & 0xFFFF}\n')
+    for shift in range(16, 64, 16):
+        chunk = (value >> shift) & 0xFFFF
+        if chunk:
+            out.write(f'   movk {reg}, #{chunk}, lsl {shift}\n')
+
+
+def write_arm64_add_immediate(out: TextIO, reg: str, scratch: str, value: int) -> None:
+    """ Adds an immediate to the register, going through the scratch register when it doesn't fit into 12 bits """
+    if value == 0:
+        return
+    if 0 < value < 4096:
+        out.write(f'   add {reg}, {reg}, #{value}\n')
+    elif -4096 < value < 0:
+        out.write(f'   sub {reg}, {reg}, #{-value}\n')
+    else:
+        write_arm64_immediate(out, scratch, value)
+        out.write(f'   add {reg}, {reg}, {scratch}\n')
+
+
+def arm64_syscall(output_buffer: int) -> str:
+    """ Instruction making the syscall set up in x16, x0, x1 and x2 """
+    return 'bl buffered_syscall' if output_buffer else 'svc #0'
+
+
+def write_arm64_prologue(out: TextIO, stack_depth: Optional[int] = None, output_buffer: int = 0) -> None:
+    """ Writes everything that comes before the first operation of the program for the Apple ARM64 target """
+    out.write('.global _main\n')
+    out.write('.align 2\n')
+
+    # Setup macros
+    setup_macros_and_functions(out, output_buffer)
+
+    out.write('_main:\n')
+    if stack_depth is not None:
+        # Switch to the stack sized by the maximum depth of the program
+        out.write('   adrp x0, stack_top@PAGE\n')
+        out.write('   add x0, x0, stack_top@PAGEOFF\n')
+        out.write('   mov sp, x0\n')
+
+
+def write_arm64_epilogue(out: TextIO, op_count: int, stack_depth: Optional[int] = None, output_buffer: int = 0,
+                         mem_size: int = MEMORY_ALLOCATION) -> None:
+    """ Writes the exit sequence after the last operation of the program and the memory for the Apple ARM64 target """
+    out.write(f'label_{op_count}:\n')
+    if output_buffer:
+        out.write('   bl flush_output\n')
+    out.write('   mov x0, #0\n')
+    out.write('   mov x16, #1\n')
+    out.write('   svc #0\n')
+
+    # Allocate memory
+    out.write('.section __DATA, __BSS\n')
+    out.write(f'mem: .skip {mem_size}\n')
+    if output_buffer:
+        out.write('.p2align 3\n')
+        out.write('outbuf_len: .skip 8\n')
+        out.write(f'outbuf: .skip {output_buffer}\n')
+    if stack_depth is not None:
+        # 16 bytes for every value and the frames of `dump` and the output buffer functions
+        out.write('.p2align 4\n')
+        out.write(f'stack: .skip {16 * stack_depth + 128}\n')
+        out.write('stack_top:\n')
+
+
+def compile_program_arm64(prg: List[Operation], out: TextIO, stack_depth: Optional[int] = None,
+                          output_buffer: int = 0, mem_size: int = MEMORY_ALLOCATION) -> None:
+    """ Generates Apple ARM64 assembly for the program """
+    write_arm64_prologue(out, stack_depth, output_buffer)
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `compile_program_arm64`'
+    for op_index in range(len(prg)):
+        op = prg[op_index]
+        out.write(f'label_{op_index}:\n')
+        if op.type == OP_PUSH:
+            # Pushes the value to the stack
+            out.write(f'   ;; -- push {op.value} --\n')
+            write_arm64_immediate(out, 'x0', op.value)
+            out.write('   push x0\n')
+        elif op.type == OP_ADD:
+            # Pops the top two values on the stack and pushes the result
+            out.write('   ;; -- add --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   add x0, x0, x1\n')
+            out.write('   push x0\n')
+        elif op.type == OP_SUB:
+            # Subtracts the top value from the second value on the stack and pushes the result
+            out.write('   ;; -- sub --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   sub x0, x1, x0\n')
+            out.write('   push x0\n')
+        elif op.type == OP_DUMP:
+            # Pops and prints the value at the top of the stack
+            out.write('   ;; -- dump --\n')
+            out.write('   pop x0\n')
+            out.write('   bl dump\n')
+        elif op.type == OP_DROP:
+            # Pops the value at the top of the stack
+            out.write('   ;; -- drop --\n')
+            out.write('   pop x0\n')
+        elif op.type == OP_SWAP:
+            # Pops the top two values on the stack and pushes them back in reverse order
+            out.write('   ;; -- swap --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   push x0\n')
+            out.write('   push x1\n')
+        elif op.type == OP_OVER:
+            # Pops the top two values on the stack and pushes back in order of second, top, second
+            out.write('   ;; -- over --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   push x1\n')
+            out.write('   push x0\n')
+            out.write('   push x1\n')
+        elif op.type == OP_CLONE:
+            # Pops the value at the top of the stack and pushes it back 2 times
+            out.write('   ;; -- clone --\n')
+            out.write('   pop x0\n')
+            out.write('   push x0\n')
+            out.write('   push x0\n')
+        elif op.type == OP_CLONE2:
+            # Pops the top two values on the stack and pushes them back 2 times in same order
+            out.write('   ; -- clone2 --\n')
+            out.write('   pop x1\n')
+            out.write('   pop x0\n')
+            out.write('   push x0\n')
+            out.write('   push x1\n')
+            out.write('   push x0\n')
+            out.write('   push x1\n')
+        elif op.type == OP_EQ:
+            # Pops the top two values on the stack and pushes the result of the EQUAL comparison
+            out.write('   ;; -- eq --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   cmp x0, x1\n')
+            out.write('   cset x0, eq\n')
+            out.write('   push x0\n')
+        elif op.type == OP_GT:
+            # Pops the top two values on the stack and pushes the result of the GREATER THAN comparison
+            out.write('   ;; -- eq --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   cmp x1, x0\n')
+            out.write('   cset x0, gt\n')
+            out.write('   push x0\n')
+        elif op.type == OP_GE:
+            # Pops the top two values on the stack and pushes the result of the GREATER OR EQUAL comparison
+            out.write('   ;; -- eq --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   cmp x1, x0\n')
+            out.write('   cset x0, ge\n')
+            out.write('   push x0\n')
+        elif op.type == OP_LT:
+            # Pops the top two values on the stack and pushes the result of the LOWER THAN comparison
+            out.write('   ;; -- eq --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   cmp x1, x0\n')
+            out.write('   cset x0, lt\n')
+            out.write('   push x0\n')
+        elif op.type == OP_LE:
+            # Pops the top two values on the stack and pushes the result of the LOWER OR EQUAL comparison
+            out.write('   ;; -- eq --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   cmp x1, x0\n')
+            out.write('   cset x0, le\n')
+            out.write('   push x0\n')
+        elif op.type == OP_BOR:
+            # Pops the top two values on the stack and pushes the result of the BITWISE OR operation
+            out.write('   ;; -- bor --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   orr x0, x0, x1\n')
+            out.write('   push x0\n')
+        elif op.type == OP_BAND:
+            # Pops the top two values on the stack and pushes the result of the BITWISE AND operation
+            out.write('   ;; -- band --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   and x0, x0, x1\n')
+            out.write('   push x0\n')
+        elif op.type == OP_SHR:
+            # Pops the top two values on the stack and pushes the result of the SHIFT RIGHT operation
+            out.write('   ;; -- shr --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   lsr x0, x1, x0\n')
+            out.write('   push x0\n')
+        elif op.type == OP_SHL:
+            # Pops the top two values on the stack and pushes the result of the SHIFT LEFT operation
+            out.write('   ;; -- shl --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   lsl x0, x1, x0\n')
+            out.write('   push x0\n')
+        elif op.type == OP_IF:
+            # Pops the top value on the stack and jumps to the END of the IF block if it is 0
+            assert op.jump is not None, "`end` is not referenced in `if` block"
+            out.write('   ;; -- if --\n')
+            out.write('   pop x0\n')
+            out.write(f'   cbz x0, label_{op.jump}\n')
+        elif op.type == OP_ELSE:
+            # Jumps in case IF block was executed, marks the start of the ELSE block
+            assert op.jump is not None, "`end` is not referenced in `else` block"
+            out.write(f'   b label_{op.jump}\n')
+            out.write('   ;; -- else --\n')
+        elif op.type == OP_WHILE:
+            # Marks the start of the WHILE block
+            out.write('   ;; -- while --\n')
+        elif op.type == OP_DO:
+            # Pops the top value on the stack and jumps to the END of the WHILE block if it is 0
+            assert op.jump is not None, "`end` is not referenced in `while-do` block"
+            out.write('   ;; -- do --\n')
+            out.write('   pop x0\n')
+            out.write(f'   cbz x0, label_{op.jump}\n')
+        elif op.type == OP_END:
+            # Marks the end of an IF or ELSE block
+            assert op.jump is not None, "`end` doesn't have reference to the next instruction to jump"
+            out.write('   ;; -- end --\n')
+            out.write(f'   b label_{op.jump}\n')
+        elif op.type == OP_MEM:
+            # Pushes the memory address to the stack
+            out.write('   ;; -- mem --\n')
+            out.write('   adrp x0, mem@PAGE\n')
+            out.write('   add x0, x0, mem@PAGEOFF\n')
+            out.write('   push x0\n')
+        elif op.type == OP_LOAD:
+            # Pops the top value on the stack and pushes the value at that memory address
+            out.write('   ;; -- load --\n')
+            out.write('   pop x0\n')
+            out.write('   ldrb w1, [x0]\n')
+            out.write('   push x1\n')
+        elif op.type == OP_SAVE:
+            # Pops the top two values on the stack and saves the top value to the memory address of the second value
+            out.write('   ;; -- save --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   strb w0, [x1]\n')
+        elif op.type in WIDE_LOADS:
+            # Pops the address on top of the stack and pushes the little-endian value at that memory address
+            out.write(f'   ;; -- {OP_NAMES[op.type]} --\n')
+            out.write('   pop x0\n')
+            out.write(f'   {ARM64_LOADS[WIDE_LOADS[op.type]]} {"x" if op.type == OP_LOAD64 else "w"}1, [x0]\n')
+            out.write('   push x1\n')
+        elif op.type in WIDE_SAVES:
+            # Pops the top two values on the stack and saves the top value to the memory address of the second value
+            out.write(f'   ;; -- {OP_NAMES[op.type]} --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write(f'   {ARM64_STORES[WIDE_SAVES[op.type]]} {"x" if op.type == OP_SAVE64 else "w"}0, [x1]\n')
+        elif op.type in [OP_MEMCPY, OP_MEMSET]:
+            # Pops the count, the source address or the value, and the destination address and copies or fills memory
+            out.write(f'   ;; -- {OP_NAMES[op.type]} --\n')
+            out.write('   pop x2\n')
+            out.write('   pop x1\n')
+            out.write('   pop x0\n')
+            out.write(f'   bl {"memory_copy" if op.type == OP_MEMCPY else "memory_fill"}\n')
+        elif op.type == OP_SYSCALL1:
+            # Pops the top two values on the stack and makes a syscall with the top value as the syscall number and
+            # the second value as the argument
+            out.write('   ;; -- syscall1 --\n')
+            out.write('   pop x16\n')
+            out.write('   pop x0\n')
+            out.write(f'   {arm64_syscall(output_buffer)}\n')
+        elif op.type == OP_SYSCALL3:
+            # Pops the top four values on the stack and makes a syscall with the top value as the syscall number and
+            # the next three values as the arguments
+            out.write('   ;; -- syscall3 --\n')
+            out.write('   pop x16\n')
+            out.write('   pop x2\n')
+            out.write('   pop x1\n')
+            out.write('   pop x0\n')
+            out.write(f'   {arm64_syscall(output_buffer)}\n')
+        elif op.type == OP_MEM_OFFSET:
+            # Pushes the memory address with a constant offset to the stack
+            out.write(f'   ;; -- mem {op.value} + --\n')
+            out.write('   adrp x0, mem@PAGE\n')
+            out.write('   add x0, x0, mem@PAGEOFF\n')
+            write_arm64_add_immediate(out, 'x0', 'x1', op.value)
+            out.write('   push x0\n')
+        elif op.type == OP_ADD_CONST:
+            # Adds a constant to the value at the top of the stack
+            out.write(f'   ;; -- {op.value} + --\n')
+            out.write('   pop x0\n')
+            write_arm64_add_immediate(out, 'x0', 'x1', op.value)
+            out.write('   push x0\n')
+        elif op.type == OP_ADD_MEM:
+            # Adds the memory address with a constant offset to the value at the top of the stack
+            out.write(f'   ;; -- mem + {op.value} + --\n')
+            out.write('   pop x0\n')
+            out.write('   adrp x1, mem@PAGE\n')
+            out.write('   add x1, x1, mem@PAGEOFF\n')
+            out.write('   add x0, x0, x1\n')
+            write_arm64_add_immediate(out, 'x0', 'x1', op.value)
+            out.write('   push x0\n')
+        elif op.type in [OP_LOAD_MEM, OP_CLONE_LOAD_MEM]:
+            # Replaces (or, for the clone variant, keeps) the offset at the top of the stack and pushes the value at
+            # that offset from the memory address
+            out.write(f'   ;; -- {"clone " if op.type == OP_CLONE_LOAD_MEM else ""}mem + {op.value} + load --\n')
+            if op.type == OP_CLONE_LOAD_MEM:
+                out.write('   ldr x0, [sp]\n')
+            else:
+                out.write('   pop x0\n')
+            out.write('   adrp x1, mem@PAGE\n')
+            out.write('   add x1, x1, mem@PAGEOFF\n')
+            out.write('   add x0, x0, x1\n')
+            write_arm64_add_immediate(out, 'x0', 'x1', op.value)
+            out.write('   ldrb w1, [x0]\n')
+            out.write('   push x1\n')
+        elif op.type in [OP_CMP_IF, OP_CMP_DO]:
+            # Pops the top two values on the stack and jumps to the END of the block if the comparison fails
+            assert op.jump is not None, "`end` is not referenced in `if` or `while-do` block"
+            out.write(f'   ;; -- {COMPARISONS[op.value][1]} {"if" if op.type == OP_CMP_IF else "do"} --\n')
+            out.write('   pop x0\n')
+            out.write('   pop x1\n')
+            out.write('   cmp x1, x0\n')
+            out.write(f'   b.{COMPARISONS[op.value][2]} label_{op.jump}\n')
+        else:
+            assert False, f'Unhandled instruction {op.type}'
+    write_arm64_epilogue(out, len(prg), stack_depth, output_buffer, mem_size)
+
+
+# Loads of a value of the given size in bytes from the address in rax into rax, and the part of rax stored by a save of
+# that size, for the x86-64 Linux target
+X86_64_LOADS = {2: 'movzwq (%rax), %rax', 4: 'mov (%rax), %eax', 8: 'mov (%rax), %rax'}
+X86_64_STORES = {2: '%ax', 4: '%eax', 8: '%rax'}
+
+
+def setup_x86_64_functions(out: TextIO, output_buffer: int = 0) -> None:
+    """ Initial functions setup for the x86-64 Linux target. With `output_buffer` set, `dump` appends to the output
+    buffer instead of making a syscall """
+
+    # Dump function
+    # Prints signed value in rdi followed by a new line
+    out.write('dump:\n')
+    out.write('   sub $40, %rsp\n')
+    out.write('   movb $10, 39(%rsp)\n')
+    out.write('   lea 39(%rsp), %rsi\n')
+    out.write('   mov %rdi, %rax\n')
+    out.write('   test %rax, %rax\n')
+    out.write('   jns .Ldump_digit\n')
+    out.write('   neg %rax\n')
+    out.write('.Ldump_digit:\n')
+    out.write('   xor %edx, %edx\n')
+    out.write('   mov $10, %ecx\n')
+    out.write('   div %rcx\n')
+    out.write('   add $48, %dl\n')
+    out.write('   dec %rsi\n')
+    out.write('   mov %dl, (%rsi)\n')
+    out.write('   test %rax, %rax\n')
+    out.write('   jnz .Ldump_digit\n')
+    out.write('   test %rdi, %rdi\n')
+    out.write('   jns .Ldump_write\n')
+    out.write('   dec %rsi\n')
+    out.write('   movb $45, (%rsi)\n')
+    out.write('.Ldump_write:\n')
+    out.write('   lea 40(%rsp), %rdx\n')
+    out.write('   sub %rsi, %rdx\n')
+    if output_buffer:
+        out.write('   call buffer_write\n')
+    else:
+        out.write('   mov $1, %edi\n')
+        out.write('   mov $1, %eax\n')
+        out.write('   syscall\n')
+    out.write('   add $40, %rsp\n')
+    out.write('   ret\n')
+
+    # Syscall number function
+    # Translates the syscall number in rax from the numbering used by the language (exit is 1, write is 4) to Linux
+    out.write('syscall_number:\n')
+    out.write('   cmp $4, %rax\n')
+    out.write('   jne .Lsyscall_exit\n')
+    out.write('   mov $1, %eax\n')
+    out.write('   ret\n')
+    out.write('.Lsyscall_exit:\n')
+    out.write('   cmp $1, %rax\n')
+    out.write('   jne .Lsyscall_done\n')
+    out.write('   mov $60, %eax\n')
+    out.write('.Lsyscall_done:\n')
+    out.write('   ret\n')
+
+    # Memory copy function
+    # Copies rcx bytes from rsi to rdi, backwards when the destination is after the source so the ranges may overlap
+    out.write('memory_copy:\n')
+    out.write('   test %rcx, %rcx\n')
+    out.write('   jle .Lcopy_done\n')
+    out.write('   cmp %rsi, %rdi\n')
+    out.write('   jbe .Lcopy_forward\n')
+    out.write('   lea -1(%rsi,%rcx), %rsi\n')
+    out.write('   lea -1(%rdi,%rcx), %rdi\n')
+    out.write('   std\n')
+    out.write('   rep movsb\n')
+    out.write('   cld\n')
+    out.write('   ret\n')
+    out.write('.Lcopy_forward:\n')
+    out.write('   rep movsb\n')
+    out.write('.Lcopy_done:\n')
+    out.write('   ret\n')
+
+    # Memory fill function
+    # Fills rcx bytes at rdi with al
+    out.write('memory_fill:\n')
+    out.write('   test %rcx, %rcx\n')
+    out.write('   jle .Lfill_done\n')
+    out.write('   rep stosb\n')
+    out.write('.Lfill_done:\n')
+    out.write('   ret\n')
+
+    if output_buffer:
+        setup_x86_64_output_buffer(out, output_buffer)
+
+
+def setup_x86_64_output_buffer(out: TextIO, size: int) -> None:
+    """ Runtime of the output buffer for the x86-64 Linux target. Writes to stdout are collected in `outbuf`, which is
+    flushed when it is full, before any other syscall and at exit """
+
+    # Buffer write function
+    # Appends rdx bytes at rsi to the buffer, flushing it first if they don't fit. Writes larger than the buffer go out
+    # directly
+    out.write('buffer_write:\n')
+    out.write('   mov outbuf_len(%rip), %rax\n')
+    out.write('   lea (%rax,%rdx), %rcx\n')
+    out.write(f'   cmp ${size}, %rcx\n')
+    out.write('   jbe .Lbuffer_copy\n')
+    out.write('   push %rsi\n')
+    out.write('   push %rdx\n')
+    out.write('   call flush_output\n')
+    out.write('   pop %rdx\n')
+    out.write('   pop %rsi\n')
+    out.write('   xor %eax, %eax\n')
+    out.write(f'   cmp ${size}, %rdx\n')
+    out.write('   jbe .Lbuffer_copy\n')
+    out.write('   mov $1, %edi\n')
+    out.write('   mov $1, %eax\n')
+    out.write('   syscall\n')
+    out.write('   ret\n')
+    out.write('.Lbuffer_copy:\n')
+    out.write('   lea outbuf(%rip), %rdi\n')
+    out.write('   add %rax, %rdi\n')
+    out.write('   add %rdx, %rax\n')
+    out.write('   mov %rax, outbuf_len(%rip)\n')
+    out.write('   mov %rdx, %rcx\n')
+    out.write('   rep movsb\n')
+    out.write('   ret\n')
+
+    # Flush function
+    # Writes the buffer to stdout and empties it
+    out.write('flush_output:\n')
+    out.write('   mov outbuf_len(%rip), %rdx\n')
+    out.write('   test %rdx, %rdx\n')
+    out.write('   jz .Lflush_done\n')
+    out.write('   lea outbuf(%rip), %rsi\n')
+    out.write('   mov $1, %edi\n')
+    out.write('   mov $1, %eax\n')
+    out.write('   syscall\n')
+    out.write('   movq $0, outbuf_len(%rip)\n')
+    out.write('.Lflush_done:\n')
+    out.write('   ret\n')
+
+    # Buffered syscall function
+    # Makes the Linux syscall in rax with the arguments in rdi, rsi and rdx. Writes to stdout go to the buffer, any
+    # other syscall flushes it first
+    out.write('buffered_syscall:\n')
+    out.write('   cmp $1, %rax\n')
+    out.write('   jne .Lsyscall_flush\n')
+    out.write('   cmp $1, %rdi\n')
+    out.write('   je buffer_write\n')
+    out.write('.Lsyscall_flush:\n')
+    out.write('   push %rax\n')
+    out.write('   push %rdi\n')
+    out.write('   push %rsi\n')
+    out.write('   push %rdx\n')
+    out.write('   call flush_output\n')
+    out.write('   pop %rdx\n')
+    out.write('   pop %rsi\n')
+    out.write('   pop %rdi\n')
+    out.write('   pop %rax\n')
+    out.write('   syscall\n')
+    out.write('   ret\n')
+
+
+def write_x86_64_immediate(out: TextIO, reg: str, value: int) -> None:
+    """ Moves a 64-bit immediate into the register """
+    value &= 0xFFFFFFFFFFFFFFFF
+    if value >= 0x8000000000000000:
+        value -= 0x10000000000000000
+    if -0x80000000 <= value < 0x80000000:
+        out.write(f'   mov ${value}, {reg}\n')
+    else:
+        out.write(f'   movabs ${value}, {reg}\n')
+
+
+def write_x86_64_address(out: TextIO, reg: str, offset: int) -> None:
+    """ Loads the memory address with a constant offset into the register """
+    if -0x80000000 <= offset < 0x80000000:
+        out.write(f'   lea mem{offset:+}(%rip), {reg}\n')
+    else:
+        out.write(f'   lea mem(%rip), {reg}\n')
+        write_x86_64_immediate(out, '%rcx', offset)
+        out.write(f'   add %rcx, {reg}\n')
+
+
+# Condition code suffixes of x86-64 for the condition codes of ARM64 used in `COMPARISONS`
+X86_64_CONDITIONS = {'eq': 'e', 'ne': 'ne', 'gt': 'g', 'ge': 'ge', 'lt': 'l', 'le': 'le'}
+
+
+def x86_64_syscall(output_buffer: int) -> str:
+    """ Instruction making the syscall set up in rax, rdi, rsi and rdx """
+    return 'call buffered_syscall' if output_buffer else 'syscall'
+
+
+def write_x86_64_prologue(out: TextIO, stack_depth: Optional[int] = None, output_buffer: int = 0) -> None:
+    """ Writes everything that comes before the first operation of the program for the x86-64 Linux target """
+    out.write('.global _start\n')
+    out.write('.text\n')
+
+    # Setup functions
+    setup_x86_64_functions(out, output_buffer)
+
+    out.write('_start:\n')
+    if stack_depth is not None:
+        # Switch to the stack sized by the maximum depth of the program
+        out.write('   lea stack_top(%rip), %rsp\n')
+
+
+def write_x86_64_epilogue(out: TextIO, op_count: int, stack_depth: Optional[int] = None, output_buffer: int = 0,
+                          mem_size: int = MEMORY_ALLOCATION) -> None:
+    """ Writes the exit sequence after the last operation of the program and the memory for the x86-64 Linux target """
+    out.write(f'label_{op_count}:\n')
+    if output_buffer:
+        out.write('   call flush_output\n')
+    out.write('   mov $60, %eax\n')
+    out.write('   xor %edi, %edi\n')
+    out.write('   syscall\n')
+
+    # Allocate memory
+    out.write('.bss\n')
+    out.write(f'mem: .skip {mem_size}\n')
+    if output_buffer:
+        out.write('.p2align 3\n')
+        out.write('outbuf_len: .skip 8\n')
+        out.write(f'outbuf: .skip {output_buffer}\n')
+    if stack_depth is not None:
+        # 8 bytes for every value, the return addresses and the frames of `dump` and the output buffer functions
+        out.write('.p2align 4\n')
+        out.write(f'stack: .skip {8 * stack_depth + 128}\n')
+        out.write('stack_top:\n')
+
+
+def compile_program_x86_64(prg: List[Operation], out: TextIO, stack_depth: Optional[int] = None,
+                           output_buffer: int = 0, mem_size: int = MEMORY_ALLOCATION) -> None:
+    """ Generates x86-64 Linux assembly for the program, in GNU as syntax """
+    write_x86_64_prologue(out, stack_depth, output_buffer)
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `compile_program_x86_64`'
+    for op_index in range(len(prg)):
+        op = prg[op_index]
+        out.write(f'label_{op_index}:\n')
+        if op.type == OP_PUSH:
+            # Pushes the value to the stack
+            out.write(f'   # -- push {op.value} --\n')
+            write_x86_64_immediate(out, '%rax', op.value)
+            out.write('   push %rax\n')
+        elif op.type == OP_ADD:
+            # Pops the top value and adds it to the new top of the stack
+            out.write('   # -- add --\n')
+            out.write('   pop %rax\n')
+            out.write('   add %rax, (%rsp)\n')
+        elif op.type == OP_SUB:
+            # Pops the top value and subtracts it from the new top of the stack
+            out.write('   # -- sub --\n')
+            out.write('   pop %rax\n')
+            out.write('   sub %rax, (%rsp)\n')
+        elif op.type == OP_DUMP:
+            # Pops and prints the value at the top of the stack
+            out.write('   # -- dump --\n')
+            out.write('   pop %rdi\n')
+            out.write('   call dump\n')
+        elif op.type == OP_DROP:
+            # Pops the value at the top of the stack
+            out.write('   # -- drop --\n')
+            out.write('   add $8, %rsp\n')
+        elif op.type == OP_SWAP:
+            # Pops the top two values on the stack and pushes them back in reverse order
+            out.write('   # -- swap --\n')
+            out.write('   pop %rax\n')
+            out.write('   pop %rbx\n')
+            out.write('   push %rax\n')
+            out.write('   push %rbx\n')
+        elif op.type == OP_OVER:
+            # Pushes the second value on the stack
+            out.write('   # -- over --\n')
+            out.write('   pushq 8(%rsp)\n')
+        elif op.type == OP_CLONE:
+            # Pushes the value at the top of the stack
+            out.write('   # -- clone --\n')
+            out.write('   pushq (%rsp)\n')
+        elif op.type == OP_CLONE2:
+            # Pushes the top two values on the stack in same order
+            out.write('   # -- clone2 --\n')
+            out.write('   pushq 8(%rsp)\n')
+            out.write('   pushq 8(%rsp)\n')
+        elif op.type in COMPARISONS:
+            # Pops the top two values on the stack and pushes the result of the comparison
+            out.write(f'   # -- {COMPARISONS[op.type][1]} --\n')
+            out.write('   pop %rax\n')
+            out.write('   pop %rbx\n')
+            out.write('   xor %ecx, %ecx\n')
+            out.write('   cmp %rax, %rbx\n')
+            out.write(f'   set{X86_64_CONDITIONS[COMPARISONS[op.type][1]]} %cl\n')
+            out.write('   push %rcx\n')
+        elif op.type == OP_BOR:
+            # Pops the top value and performs BITWISE OR with the new top of the stack
+            out.write('   # -- bor --\n')
+            out.write('   pop %rax\n')
+            out.write('   or %rax, (%rsp)\n')
+        elif op.type == OP_BAND:
+            # Pops the top value and performs BITWISE AND with the new top of the stack
+            out.write('   # -- band --\n')
+            out.write('   pop %rax\n')
+            out.write('   and %rax, (%rsp)\n')
+        elif op.type == OP_SHR:
+            # Pops the top value and shifts the new top of the stack right by it
+            out.write('   # -- shr --\n')
+            out.write('   pop %rcx\n')
+            out.write('   shrq %cl, (%rsp)\n')
+        elif op.type == OP_SHL:
+            # Pops the top value and shifts the new top of the stack left by it
+            out.write('   # -- shl --\n')
+            out.write('   pop %rcx\n')
+            out.write('   shlq %cl, (%rsp)\n')
+        elif op.type in [OP_IF, OP_DO]:
+            # Pops the top value on the stack and jumps to the END of the block if it is 0
+            assert op.jump is not None, "`end` is not referenced in `if` or `while-do` block"
+            out.write(f'   # -- {"if" if op.type == OP_IF else "do"} --\n')
+            out.write('   pop %rax\n')
+            out.write('   test %rax, %rax\n')
+            out.write(f'   jz label_{op.jump}\n')
+        elif op.type == OP_ELSE:
+            # Jumps in case IF block was executed, marks the start of the ELSE block
+            assert op.jump is not None, "`end` is not referenced in `else` block"
+            out.write(f'   jmp label_{op.jump}\n')
+            out.write('   # -- else --\n')
+        elif op.type == OP_WHILE:
+            # Marks the start of the WHILE block
+            out.write('   # -- while --\n')
+        elif op.type == OP_END:
+            # Marks the end of a block
+            assert op.jump is not None, "`end` doesn't have reference to the next instruction to jump"
+            out.write('   # -- end --\n')
+            out.write(f'   jmp label_{op.jump}\n')
+        elif op.type == OP_MEM:
+            # Pushes the memory address to the stack
+            out.write('   # -- mem --\n')
+            out.write('   lea mem(%rip), %rax\n')
+            out.write('   push %rax\n')
+        elif op.type == OP_LOAD:
+            # Replaces the address at the top of the stack with the byte at that memory address
+            out.write('   # -- load --\n')
+            out.write('   mov (%rsp), %rax\n')
+            out.write('   movzbq (%rax), %rax\n')
+            out.write('   mov %rax, (%rsp)\n')
+        elif op.type == OP_SAVE:
+            # Pops the top two values on the stack and saves the top value to the memory address of the second value
+            out.write('   # -- save --\n')
+            out.write('   pop %rax\n')
+            out.write('   pop %rbx\n')
+            out.write('   mov %al, (%rbx)\n')
+        elif op.type in WIDE_LOADS:
+            # Replaces the address at the top of the stack with the little-endian value at that memory address
+            out.write(f'   # -- {OP_NAMES[op.type]} --\n')
+            out.write('   mov (%rsp), %rax\n')
+            out.write(f'   {X86_64_LOADS[WIDE_LOADS[op.type]]}\n')
+            out.write('   mov %rax, (%rsp)\n')
+        elif op.type in WIDE_SAVES:
+            # Pops the top two values on the stack and saves the top value to the memory address of the second value
+            out.write(f'   # -- {OP_NAMES[op.type]} --\n')
+            out.write('   pop %rax\n')
+            out.write('   pop %rbx\n')
+            out.write(f'   mov {X86_64_STORES[WIDE_SAVES[op.type]]}, (%rbx)\n')
+        elif op.type in [OP_MEMCPY, OP_MEMSET]:
+            # Pops the count, the source address or the value, and the destination address and copies or fills memory
+            out.write(f'   # -- {OP_NAMES[op.type]} --\n')
+            out.write('   pop %rcx\n')
+            out.write(f'   pop {"%rsi" if op.type == OP_MEMCPY else "%rax"}\n')
+            out.write('   pop %rdi\n')
+            out.write(f'   call {"memory_copy" if op.type == OP_MEMCPY else "memory_fill"}\n')
+        elif op.type == OP_SYSCALL1:
+            # Pops the syscall number and its argument and makes the syscall
+            out.write('   # -- syscall1 --\n')
+            out.write('   pop %rax\n')
+            out.write('   call syscall_number\n')
+            out.write('   pop %rdi\n')
+            out.write(f'   {x86_64_syscall(output_buffer)}\n')
+        elif op.type == OP_SYSCALL3:
+            # Pops the syscall number and its three arguments and makes the syscall
+            out.write('   # -- syscall3 --\n')
+            out.write('   pop %rax\n')
+            out.write('   call syscall_number\n')
+            out.write('   pop %rdx\n')
+            out.write('   pop %rsi\n')
+            out.write('   pop %rdi\n')
+            out.write(f'   {x86_64_syscall(output_buffer)}\n')
+        elif op.type == OP_MEM_OFFSET:
+            # Pushes the memory address with a constant offset to the stack
+            out.write(f'   # -- mem {op.value} + --\n')
+            write_x86_64_address(out, '%rax', op.value)
+            out.write('   push %rax\n')
+        elif op.type == OP_ADD_CONST:
+            # Adds a constant to the value at the top of the stack
+            out.write(f'   # -- {op.value} + --\n')
+            write_x86_64_immediate(out, '%rax', op.value)
+            out.write('   add %rax, (%rsp)\n')
+        elif op.type == OP_ADD_MEM:
+            # Adds the memory address with a constant offset to the value at the top of the stack
+            out.write(f'   # -- mem + {op.value} + --\n')
+            write_x86_64_address(out, '%rax', op.value)
+            out.write('   add %rax, (%rsp)\n')
+        elif op.type in [OP_LOAD_MEM, OP_CLONE_LOAD_MEM]:
+            # Replaces (or, for the clone variant, keeps) the offset at the top of the stack and pushes the value at
+            # that offset from the memory address
+            out.write(f'   # -- {"clone " if op.type == OP_CLONE_LOAD_MEM else ""}mem + {op.value} + load --\n')
+            write_x86_64_address(out, '%rax', op.value)
+            out.write('   add (%rsp), %rax\n')
+            out.write('   movzbq (%rax), %rax\n')
+            if op.type == OP_CLONE_LOAD_MEM:
+                out.write('   push %rax\n')
+            else:
+                out.write('   mov %rax, (%rsp)\n')
+        elif op.type in [OP_CMP_IF, OP_CMP_DO]:
+            # Pops the top two values on the stack and jumps to the END of the block if the comparison fails
+            assert op.jump is not None, "`end` is not referenced in `if` or `while-do` block"
+            out.write(f'   # -- {COMPARISONS[op.value][1]} {"if" if op.type == OP_CMP_IF else "do"} --\n')
+            out.write('   pop %rax\n')
+            out.write('   pop %rbx\n')
+            out.write('   cmp %rax, %rbx\n')
+            out.write(f'   j{X86_64_CONDITIONS[COMPARISONS[op.value][2]]} label_{op.jump}\n')
+        else:
+            assert False, f'Unhandled instruction {op.type}'
+    write_x86_64_epilogue(out, len(prg), stack_depth, output_buffer, mem_size)
+
+
+# Arithmetic and bitwise operations, with their names used in comments of the generated assembly
+ARITHMETIC_OPS = {OP_ADD: 'add', OP_SUB: 'sub', OP_BOR: 'bor', OP_BAND: 'band', OP_SHR: 'shr', OP_SHL: 'shl'}
+
+
+class Arm64Emitter:
+    """ Instructions of the Apple ARM64 target used by `compile_program_cached` """
+    registers = ['x19', 'x20', 'x21', 'x22', 'x23', 'x24', 'x25', 'x26']
+    scratch = 'x2'
+    prologue = staticmethod(write_arm64_prologue)
+    epilogue = staticmethod(write_arm64_epilogue)
+    binary = {OP_ADD: 'add', OP_SUB: 'sub', OP_BOR: 'orr', OP_BAND: 'and', OP_SHR: 'lsr', OP_SHL: 'lsl'}
+
+    def __init__(self, out: TextIO, output_buffer: int = 0):
+        self.out = out
+        self.output_buffer = output_buffer
+
+    def comment(self, text: str) -> None:
+        self.out.write(f'   ;; -- {text} --\n')
+
+    def push(self, reg: str) -> None:
+        self.out.write(f'   push {reg}\n')
+
+    def pop(self, reg: str) -> None:
+        self.out.write(f'   pop {reg}\n')
+
+    def peek(self, reg: str, slot: int) -> None:
+        self.out.write(f'   ldr {reg}, [sp, #{16 * slot}]\n')
+
+    def drop(self) -> None:
+        self.out.write('   add sp, sp, #16\n')
+
+    def move(self, dst: str, src: str) -> None:
+        self.out.write(f'   mov {dst}, {src}\n')
+
+    def immediate(self, reg: str, value: int) -> None:
+        write_arm64_immediate(self.out, reg, value)
+
+    def add_immediate(self, reg: str, value: int) -> None:
+        write_arm64_add_immediate(self.out, reg, 'x1', value)
+
+    def address(self, reg: str, offset: int) -> None:
+        self.out.write(f'   adrp {reg}, mem@PAGE\n')
+        self.out.write(f'   add {reg}, {reg}, mem@PAGEOFF\n')
+        write_arm64_add_immediate(self.out, reg, 'x1', offset)
+
+    def arithmetic(self, op_type: int, dst: str, src: str) -> None:
+        self.out.write(f'   {self.binary[op_type]} {dst}, {dst}, {src}\n')
+
+    def add(self, dst: str, src: str) -> None:
+        self.out.write(f'   add {dst}, {dst}, {src}\n')
+
+    def compare(self, condition: str, dst: str, src: str) -> None:
+        self.out.write(f'   cmp {dst}, {src}\n')
+        self.out.write(f'   cset {dst}, {condition}\n')
+
+    def load_byte(self, dst: str, address: str) -> None:
+        self.out.write(f'   ldrb w{dst[1:]}, [{address}]\n')
+
+    def store_byte(self, address: str, value: str) -> None:
+        self.out.write(f'   strb w{value[1:]}, [{address}]\n')
+
+    def load_wide(self, dst: str, address: str, size: int) -> None:
+        self.out.write(f'   {ARM64_LOADS[size]} {dst if size == 8 else "w" + dst[1:]}, [{address}]\n')
+
+    def store_wide(self, address: str, value: str, size: int) -> None:
+        self.out.write(f'   {ARM64_STORES[size]} {value if size == 8 else "w" + value[1:]}, [{address}]\n')
+
+    def bulk(self, function: str, val_1: str, val_2: str, val_3: str) -> None:
+        self.out.write(f'   mov x0, {val_1}\n')
+        self.out.write(f'   mov x1, {val_2}\n')
+        self.out.write(f'   mov x2, {val_3}\n')
+        self.out.write(f'   bl {function}\n')
+
+    def branch_zero(self, reg: str, label: int) -> None:
+        self.out.write(f'   cbz {reg}, label_{label}\n')
+
+    def branch_compare(self, condition: str, val_1: str, val_2: str, label: int) -> None:
+        self.out.write(f'   cmp {val_1}, {val_2}\n')
+        self.out.write(f'   b.{condition} label_{label}\n')
+
+    def jump(self, label: int) -> None:
+        self.out.write(f'   b label_{label}\n')
+
+    def dump(self, reg: str) -> None:
+        self.out.write(f'   mov x0, {reg}\n')
+        self.out.write('   bl dump\n')
+
+    def syscall(self, args: int) -> None:
+        self.out.write('   pop x16\n')
+        for reg in ['x2', 'x1', 'x0'][3 - args:]:
+            self.out.write(f'   pop {reg}\n')
+        self.out.write(f'   {arm64_syscall(self.output_buffer)}\n')
+
+
+class X86_64Emitter:
+    """ Instructions of the x86-64 Linux target used by `compile_program_cached` """
+    registers = ['%r12', '%r13', '%r14', '%r15', '%r8', '%r9', '%r10']
+    scratch = '%rdx'
+    prologue = staticmethod(write_x86_64_prologue)
+    epilogue = staticmethod(write_x86_64_epilogue)
+    binary = {OP_ADD: 'add', OP_SUB: 'sub', OP_BOR: 'or', OP_BAND: 'and', OP_SHR: 'shr', OP_SHL: 'shl'}
+
+    def __init__(self, out: TextIO, output_buffer: int = 0):
+        self.out = out
+        self.output_buffer = output_buffer
+
+    def comment(self, text: str) -> None:
+        self.out.write(f'   # -- {text} --\n')
+
+    def push(self, reg: str) -> None:
+        self.out.write(f'   push {reg}\n')
+
+    def pop(self, reg: str) -> None:
+        self.out.write(f'   pop {reg}\n')
+
+    def peek(self, reg: str, slot: int) -> None:
+        self.out.write(f'   mov {8 * slot}(%rsp), {reg}\n')
+
+    def drop(self) -> None:
+        self.out.write('   add $8, %rsp\n')
+
+    def move(self, dst: str, src: str) -> None:
+        self.out.write(f'   mov {src}, {dst}\n')
+
+    def immediate(self, reg: str, value: int) -> None:
+        write_x86_64_immediate(self.out, reg, value)
+
+    def add_immediate(self, reg: str, value: int) -> None:
+        if value:
+            write_x86_64_immediate(self.out, '%rax', value)
+            self.out.write(f'   add %rax, {reg}\n')
+
+    def address(self, reg: str, offset: int) -> None:
+        write_x86_64_address(self.out, reg, offset)
+
+    def arithmetic(self, op_type: int, dst: str, src: str) -> None:
+        if op_type in [OP_SHR, OP_SHL]:
+            self.out.write(f'   mov {src}, %rcx\n')
+            self.out.write(f'   {self.binary[op_type]} %cl, {dst}\n')
+        else:
+            self.out.write(f'   {self.binary[op_type]} {src}, {dst}\n')
+
+    def add(self, dst: str, src: str) -> None:
+        self.out.write(f'   add {src}, {dst}\n')
+
+    def compare(self, condition: str, dst: str, src: str) -> None:
+        self.out.write(f'   cmp {src}, {dst}\n')
+        self.out.write(f'   set{X86_64_CONDITIONS[condition]} %al\n')
+        self.out.write(f'   movzbq %al, {dst}\n')
+
+    def load_byte(self, dst: str, address: str) -> None:
+        self.out.write(f'   movzbq ({address}), {dst}\n')
+
+    def store_byte(self, address: str, value: str) -> None:
+        self.out.write(f'   mov {value}, %rax\n')
+        self.out.write(f'   mov %al, ({address})\n')
+
+    def load_wide(self, dst: str, address: str, size: int) -> None:
+        self.out.write(f'   mov {address}, %rax\n')
+        self.out.write(f'   {X86_64_LOADS[size]}\n')
+        self.out.write(f'   mov %rax, {dst}\n')
+
+    def store_wide(self, address: str, value: str, size: int) -> None:
+        self.out.write(f'   mov {value}, %rax\n')
+        self.out.write(f'   mov {X86_64_STORES[size]}, ({address})\n')
+
+    def bulk(self, function: str, val_1: str, val_2: str, val_3: str) -> None:
+        self.out.write(f'   mov {val_1}, %rdi\n')
+        self.out.write(f'   mov {val_2}, {"%rsi" if function == "memory_copy" else "%rax"}\n')
+        self.out.write(f'   mov {val_3}, %rcx\n')
+        self.out.write(f'   call {function}\n')
+
+    def branch_zero(self, reg: str, label: int) -> None:
+        self.out.write(f'   test {reg}, {reg}\n')
+        self.out.write(f'   jz label_{label}\n')
+
+    def branch_compare(self, condition: str, val_1: str, val_2: str, label: int) -> None:
+        self.out.write(f'   cmp {val_2}, {val_1}\n')
+        self.out.write(f'   j{X86_64_CONDITIONS[condition]} label_{label}\n')
+
+    def jump(self, label: int) -> None:
+        self.out.write(f'   jmp label_{label}\n')
+
+    def dump(self, reg: str) -> None:
+        self.out.write(f'   mov {reg}, %rdi\n')
+        self.out.write('   call dump\n')
+
+    def syscall(self, args: int) -> None:
+        self.out.write('   pop %rax\n')
+        self.out.write('   call syscall_number\n')
+        for reg in ['%rdx', '%rsi', '%rdi'][3 - args:]:
+            self.out.write(f'   pop {reg}\n')
+        self.out.write(f'   {x86_64_syscall(self.output_buffer)}\n')
+
+
+# `memcpy` and `memset` take their three operands in registers at once
+MIN_STACK_REGISTERS = 3
+
+
+class RegisterStack:
+    """ Compile time shape of the top of the stack: the values above the memory stack that are kept in registers,
+    bottom to top. The memory stack holds the rest of the values """
+
+    def __init__(self, emitter, count: int):
+        assert MIN_STACK_REGISTERS <= count <= len(emitter.registers), \
+            f'Number of stack registers must be between {MIN_STACK_REGISTERS} and {len(emitter.registers)}'
+        self.emitter = emitter
+        self.registers = emitter.registers[:count]
+        self.cached = []
+
+    def spill(self) -> None:
+        """ Pushes all cached values to the memory stack """
+        for reg in self.cached:
+            self.emitter.push(reg)
+        self.cached = []
+
+    def allocate(self) -> str:
+        """ Returns a free register, pushing the bottom cached value to the memory stack when there is none """
+        if len(self.cached) == len(self.registers):
+            self.emitter.push(self.cached.pop(0))
+        return next(reg for reg in self.registers if reg not in self.cached)
+
+    def take(self, count: int) -> List[str]:
+        """ Removes the top `count` values of the stack, returned in stack order (top value last) """
+        while len(self.cached) < count:
+            reg = self.allocate()
+            self.emitter.pop(reg)
+            self.cached.insert(0, reg)
+        values = self.cached[len(self.cached) - count:]
+        del self.cached[len(self.cached) - count:]
+        return values
+
+    def peek(self, depth: int) -> str:
+        """ Copies the value at the given depth from the top of the stack into a new register and pushes it """
+        reg = self.allocate()
+        if depth < len(self.cached):
+            self.emitter.move(reg, self.cached[-1 - depth])
+        else:
+            self.emitter.peek(reg, depth - len(self.cached))
+        self.cached.append(reg)
+        return reg
+
+
+def compile_program_cached(prg: List[Operation], out: TextIO, emitter_class, count: int,
+                           stack_depth: Optional[int] = None, output_buffer: int = 0,
+                           mem_size: int = MEMORY_ALLOCATION) -> None:
+    """ Generates assembly for the program keeping the top `count` values of the stack in registers. Registers are
+    pushed to the memory stack only at jump targets and jumps, and before `dump` and syscalls """
+    emitter = emitter_class(out, output_buffer)
+    stack = RegisterStack(emitter, count)
+    targets = {op.jump for op in prg if op.jump is not None}
+    emitter.prologue(out, stack_depth, output_buffer)
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `compile_program_cached`'
+    for op_index in range(len(prg)):
+        op = prg[op_index]
+        if op_index in targets:
+            stack.spill()
+        out.write(f'label_{op_index}:\n')
+        if op.type == OP_PUSH:
+            emitter.comment(f'push {op.value}')
+            reg = stack.allocate()
+            emitter.immediate(reg, op.value)
+            stack.cached.append(reg)
+        elif op.type in ARITHMETIC_OPS:
+            emitter.comment(ARITHMETIC_OPS[op.type])
+            val_1, val_2 = stack.take(2)
+            emitter.arithmetic(op.type, val_1, val_2)
+            stack.cached.append(val_1)
+        elif op.type in COMPARISONS:
+            emitter.comment(COMPARISONS[op.type][1])
+            val_1, val_2 = stack.take(2)
+            emitter.compare(COMPARISONS[op.type][1], val_1, val_2)
+            stack.cached.append(val_1)
+        elif op.type == OP_DUMP:
+            emitter.comment('dump')
+            val_1, = stack.take(1)
+            stack.spill()
+            emitter.dump(val_1)
+        elif op.type == OP_DROP:
+            emitter.comment('drop')
+            if stack.cached:
+                stack.cached.pop()
+            else:
+                emitter.drop()
+        elif op.type == OP_SWAP:
+            emitter.comment('swap')
+            val_1, val_2 = stack.take(2)
+            stack.cached += [val_2, val_1]
+        elif op.type == OP_OVER:
+            emitter.comment('over')
+            stack.peek(1)
+        elif op.type == OP_CLONE:
+            emitter.comment('clone')
+            stack.peek(0)
+        elif op.type == OP_CLONE2:
+            emitter.comment('clone2')
+            stack.peek(1)
+            stack.peek(1)
+        elif op.type in [OP_IF, OP_DO]:
+            assert op.jump is not None, "`end` is not referenced in `if` or `while-do` block"
+            emitter.comment('if' if op.type == OP_IF else 'do')
+            val_1, = stack.take(1)
+            stack.spill()
+            emitter.branch_zero(val_1, op.jump)
+        elif op.type in [OP_ELSE, OP_END]:
+            assert op.jump is not None, "`else` or `end` doesn't have reference to the next instruction to jump"
+            stack.spill()
+            emitter.jump(op.jump)
+            emitter.comment('else' if op.type == OP_ELSE else 'end')
+        elif op.type == OP_WHILE:
+            emitter.comment('while')
+        elif op.type in [OP_MEM, OP_MEM_OFFSET]:
+            emitter.comment(f'mem {op.value or 0} +')
+            reg = stack.allocate()
+            emitter.address(reg, op.value or 0)
+            stack.cached.append(reg)
+        elif op.type == OP_LOAD:
+            emitter.comment('load')
+            val_1, = stack.take(1)
+            emitter.load_byte(val_1, val_1)
+            stack.cached.append(val_1)
+        elif op.type == OP_SAVE:
+            emitter.comment('save')
+            val_1, val_2 = stack.take(2)
+            emitter.store_byte(val_1, val_2)
+        elif op.type in WIDE_LOADS:
+            emitter.comment(OP_NAMES[op.type])
+            val_1, = stack.take(1)
+            emitter.load_wide(val_1, val_1, WIDE_LOADS[op.type])
+            stack.cached.append(val_1)
+        elif op.type in WIDE_SAVES:
+            emitter.comment(OP_NAMES[op.type])
+            val_1, val_2 = stack.take(2)
+            emitter.store_wide(val_1, val_2, WIDE_SAVES[op.type])
+        elif op.type in [OP_MEMCPY, OP_MEMSET]:
+            emitter.comment(OP_NAMES[op.type])
+            val_1, val_2, val_3 = stack.take(3)
+            emitter.bulk('memory_copy' if op.type == OP_MEMCPY else 'memory_fill', val_1, val_2, val_3)
+        elif op.type in [OP_SYSCALL1, OP_SYSCALL3]:
+            emitter.comment('syscall1' if op.type == OP_SYSCALL1 else 'syscall3')
+            stack.spill()
+            emitter.syscall(1 if op.type == OP_SYSCALL1 else 3)
+        elif op.type == OP_ADD_CONST:
+            emitter.comment(f'{op.value} +')
+            val_1, = stack.take(1)
+            emitter.add_immediate(val_1, op.value)
+            stack.cached.append(val_1)
+        elif op.type in [OP_ADD_MEM, OP_LOAD_MEM, OP_CLONE_LOAD_MEM]:
+            emitter.comment(f'{"clone " if op.type == OP_CLONE_LOAD_MEM else ""}mem + {op.value} +'
+                            f'{" load" if op.type != OP_ADD_MEM else ""}')
+            if op.type == OP_CLONE_LOAD_MEM:
+                stack.peek(0)
+            val_1, = stack.take(1)
+            emitter.address(emitter.scratch, op.value)
+            emitter.add(val_1, emitter.scratch)
+            if op.type != OP_ADD_MEM:
+                emitter.load_byte(val_1, val_1)
+            stack.cached.append(val_1)
+        elif op.type in [OP_CMP_IF, OP_CMP_DO]:
+            assert op.jump is not None, "`end` is not referenced in `if` or `while-do` block"
+            emitter.comment(f'{COMPARISONS[op.value][1]} {"if" if op.type == OP_CMP_IF else "do"}')
+            val_1, val_2 = stack.take(2)
+            stack.spill()
+            emitter.branch_compare(COMPARISONS[op.value][2], val_1, val_2, op.jump)
+        else:
+            assert False, f'Unhandled instruction {op.type}'
+    stack.spill()
+    emitter.epilogue(out, len(prg), stack_depth, output_buffer, mem_size)
+
+
+def compile_program(prg: List[Operation], file_path: str, target: str = TARGET_ARM64_MACOS,
+                    stack_registers: int = 0, stack_depth: Optional[int] = None, output_buffer: int = 0,
+                    mem_size: int = MEMORY_ALLOCATION) -> None:
+    """ Generates assembly of the given target for the program into the file. When `stack_registers` is set, the top
+    values of the stack are kept in that many registers. When `stack_depth` is known, the program runs on its own
+    stack of that size instead of the one provided by the system. When `output_buffer` is set, writes to stdout are
+    collected in a buffer of that many bytes instead of making a syscall each. `mem_size` is the size of `mem` """
+    with open(file_path, 'w') as out:
+        if stack_registers:
+            emitter_class = Arm64Emitter if target == TARGET_ARM64_MACOS else X86_64Emitter
+            compile_program_cached(prg, out, emitter_class, stack_registers, stack_depth, output_buffer, mem_size)
+        elif target == TARGET_ARM64_MACOS:
+            compile_program_arm64(prg, out, stack_depth, output_buffer, mem_size)
+        elif target == TARGET_X86_64_LINUX:
+            compile_program_x86_64(prg, out, stack_depth, output_buffer, mem_size)
+        else:
+            assert False, f'Unknown target: {target}'
+
+
+def default_target() -> str:
+    """ Target of the host, Apple ARM64 unless running on x86-64 Linux """
+    if platform.system() == 'Linux' and platform.machine() in ['x86_64', 'AMD64']:
+        return TARGET_X86_64_LINUX
+    return TARGET_ARM64_MACOS
+
+
+# Size of the pieces the source is read in, lines are never split between pieces
+LEX_CHUNK_SIZE = 1 << 20
+# A token is a run of non-whitespace characters or a string in double quotes, comments run from `#` to the end of the
+# line
+TOKEN_REGEX = re.compile(r'\n|#[^\n]*|"[^"\n]*"|[^\s#]+')
+
+
+def read_lines_chunked(file_path: str) -> Iterator[str]:
+    """ Reads the file in pieces of whole lines, each ending with a newline except possibly the last one """
+    with open(file_path, 'r') as f:
+        pending = []
+        while True:
+            chunk = f.read(LEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            cut = chunk.rfind('\n') + 1
+            if not cut:
+                pending.append(chunk)
+                continue
+            pending.append(chunk[:cut])
+            yield ''.join(pending)
+            pending = [chunk[cut:]]
+        rest = ''.join(pending)
+        if rest:
+            yield rest
+
+
+# Lexical analysis of a file in a single pass, yields each token lazily
+def lex_file(file_path: str) -> Iterator[Token]:
+    row = 0
+    for piece in read_lines_chunked(file_path):
+        line_start = 0
+        for match in TOKEN_REGEX.finditer(piece):
+            word = match.group()
+            if word == '\n':
+                row += 1
+                line_start = match.end()
+            elif word[0] != '#':  # Skip comments
+                yield Token(file_path, row, match.start() - line_start, word)
+
+
+def construct_blocks(ops: Iterable[Operation]) -> List[Operation]:
+    """ Links the blocks while collecting the operations, so the front end can produce them lazily """
+    prg = []
+    stack = []
+    assert COUNT_OPS == 43, ('Exhaustive handling of operands in `construct_blocks`. Note, not all operations need to '
+                             'be implemented here. Only those that form blocks')
+    for op in ops:
+        op_index = len(prg)
+        prg.append(op)
+        if op.type == OP_IF:
+            stack.append(op_index)
+        elif op.type == OP_ELSE:
+            assert stack, '`else` can be used only with with `if` blocks'
+            block_start = stack.pop()
+            assert prg[block_start].type == OP_IF, '`else` can be used only with with `if` blocks'
+            prg[block_start].jump = op_index + 1
+            stack.append(op_index)
+        elif op.type == OP_WHILE:
+            stack.append(op_index)
+        elif op.type == OP_DO:
+            block_while = stack.pop()
+            prg[op_index].jump = block_while
+            stack.append(op_index)
+        elif op.type == OP_END:
+            assert stack, 'Unnecessary `end` operation'
+            block_start = stack.pop()
+            if prg[block_start].type in [OP_IF, OP_ELSE]:
+                prg[block_start].jump = op_index
+                prg[op_index].jump = op_index + 1
+            elif prg[block_start].type == OP_DO:
+                assert prg[block_start].jump is not None, '`while` is not referenced in `do` block'
+                prg[op_index].jump = prg[block_start].jump
+                prg[block_start].jump = op_index + 1
+            else:
+                assert False, '`end` can be used only with with `if`, `else`, `while-do` blocks'
+    return prg
+
+
+# Binary operations that `optimize_program` is able to fold when both operands are constants, see `can_fold`
+FOLDABLE_OPS = {
+    OP_ADD: operator.add,
+    OP_SUB: operator.sub,
+    OP_BOR: operator.or_,
+    OP_BAND: operator.and_,
+    OP_SHR: operator.rshift,
+    OP_SHL: operator.lshift,
+    OP_EQ: lambda a, b: int(a == b),
+    OP_GT: lambda a, b: int(a > b),
+    OP_GE: lambda a, b: int(a >= b),
+    OP_LT: lambda a, b: int(a < b),
+    OP_LE: lambda a, b: int(a <= b),
+}
+
+
+def can_fold(op_type: int, a: int, b: int) -> bool:
+    """ Whether folding the operation on the constants gives the same value with the unbounded integers of the
+    simulators and with the 64-bit arithmetic of `--int64` and the compiled program: the operands and the result must
+    fit into 64 bits, shift amounts must be below 64 and `shr`, a logical shift in 64 bits, must shift a non-negative
+    value """
+    if not fits_int64(a, b):
+        return False
+    if op_type in [OP_SHR, OP_SHL] and not 0 <= b < 64:
+        return False
+    if op_type == OP_SHR and a < 0:
+        return False
+    return fits_int64(FOLDABLE_OPS[op_type](a, b))
+
+
+# Types of the operations that can end a sequence matched by `fuse_operations`
+FUSION_LAST_OPS = set(FOLDABLE_OPS) | {OP_ADD, OP_SUB, OP_ADD_CONST, OP_LOAD, OP_LOAD_MEM, OP_IF, OP_DO, OP_MEM}
+
+
+def fuse_operations(ops: List[Operation]) -> Optional[List[Operation]]:
+    """ Returns the replacement for exactly the given sequence if it matches a peephole pattern, `None` otherwise """
+    types = [op.type for op in ops]
+    if len(ops) == 3:
+        op_1, op_2, op_3 = ops
+        if types[:2] == [OP_PUSH, OP_PUSH] and op_3.type in FOLDABLE_OPS:
+            if can_fold(op_3.type, op_1.value, op_2.value):
+                return [Operation(OP_PUSH, op_1.loc, value=FOLDABLE_OPS[op_3.type](op_1.value, op_2.value))]
+        elif types == [OP_PUSH, OP_MEM_OFFSET, OP_ADD] and can_fold(OP_ADD, op_1.value, op_2.value):
+            return [Operation(OP_MEM_OFFSET, op_1.loc, value=op_1.value + op_2.value)]
+    elif len(ops) == 2:
+        op_1, op_2 = ops
+        if op_1.type == OP_PUSH and op_2.type in [OP_ADD, OP_SUB]:
+            return [Operation(OP_ADD_CONST, op_1.loc, value=op_1.value if op_2.type == OP_ADD else -op_1.value)]
+        elif op_1.type in [OP_PUSH, OP_MEM_OFFSET, OP_ADD_CONST, OP_ADD_MEM] and op_2.type == OP_ADD_CONST \
+                and can_fold(OP_ADD, op_1.value, op_2.value):
+            return [Operation(op_1.type, op_1.loc, value=op_1.value + op_2.value)]
+        elif op_1.type == OP_MEM_OFFSET and op_2.type == OP_ADD:
+            return [Operation(OP_ADD_MEM, op_1.loc, value=op_1.value)]
+        elif op_1.type == OP_ADD_MEM and op_2.type == OP_LOAD:
+            return [Operation(OP_LOAD_MEM, op_1.loc, value=op_1.value)]
+        elif op_1.type == OP_CLONE and op_2.type == OP_LOAD_MEM:
+            return [Operation(OP_CLONE_LOAD_MEM, op_1.loc, value=op_2.value)]
+        elif op_1.type in COMPARISONS and op_2.type in [OP_IF, OP_DO]:
+            fused_type = OP_CMP_IF if op_2.type == OP_IF else OP_CMP_DO
+            return [Operation(fused_type, op_1.loc, value=op_1.type, jump=op_2.jump)]
+    elif len(ops) == 1:
+        op_1, = ops
+        if op_1.type == OP_MEM:
+            return [Operation(OP_MEM_OFFSET, op_1.loc, value=0)]
+        elif op_1.type == OP_ADD_CONST and op_1.value == 0:
+            return []
+    return None
+
+
+def optimize_program(prg: List[Operation]) -> List[Operation]:
+    """ Peephole optimization pass: folds constants, folds `mem` offsets into addresses and fuses frequent sequences
+    into superinstructions. Operations that are jump targets are never merged into the operation before them """
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `optimize_program`'
+    targets = {op.jump for op in prg if op.jump is not None}
+    result = []
+    # Whether the operation at the same index of `result` is a jump target, fusion may not reach past it
+    is_target = []
+    index_map = []
+    for op_index in range(len(prg)):
+        op = prg[op_index]
+        index_map.append(len(result))
+        result.append(Operation(op.type, op.loc, value=op.value, jump=op.jump))
+        is_target.append(op_index in targets)
+        while result and result[-1].type in FUSION_LAST_OPS:
+            # Only the tail after the last jump target may be fused, the target itself can still be replaced
+            start = len(result) - 1
+            while start > 0 and not is_target[start] and len(result) - start < 3:
+                start -= 1
+            tail = result[start:]
+            replacement = None
+            for size in range(len(tail), 0, -1):
+                replacement = fuse_operations(tail[-size:])
+                if replacement is not None:
+                    break
+            if replacement is None or (not replacement and is_target[-1]):
+                break
+            first_is_target = is_target[-size]
+            del result[-size:]
+            del is_target[-size:]
+            result.extend(replacement)
+            is_target.extend([first_is_target] + [False] * (len(replacement) - 1))
+    index_map.append(len(result))
+    for op in result:
+        if op.jump is not None:
+            op.jump = index_map[op.jump]
+    return result
+
+
+# Operations jumping to `jump` when the condition they pop is false, they end a basic block
+CONDITIONAL_JUMPS = [OP_IF, OP_DO, OP_CMP_IF, OP_CMP_DO]
+# Operations always jumping to `jump`, they end a basic block
+UNCONDITIONAL_JUMPS = [OP_ELSE, OP_END]
+
+
+class BasicBlock:
+    """ Basic block of the control-flow graph: straight-line operations entered only at the first one, without the
+    block operations. The block ends with `branch`, a conditional jump to the block `target` taken when its condition
+    is false, and continues with the block `next`. `None` for `target` or `next` is the end of the program, `halts`
+    marks blocks ending with the `exit` syscall, which have no successors """
+    __slots__ = ('ops', 'branch', 'target', 'next', 'halts', 'loc')
+
+    def __init__(self, loc: Tuple[str, int, int]):
+        self.ops = []
+        self.branch = None
+        self.target = None
+        self.next = None
+        self.halts = False
+        # Location of the jump to `next`, if one is needed
+        self.loc = loc
+
+    def successors(self) -> List[int]:
+        if self.halts:
+            return []
+        return [block for block in [self.next, self.target if self.branch else None] if block is not None]
+
+
+def halts(ops: List[Operation]) -> bool:
+    """ Whether the operations end with the `exit` syscall, `1 syscall1` """
+    return len(ops) >= 2 and ops[-1].type == OP_SYSCALL1 and ops[-2].type == OP_PUSH and ops[-2].value == 1
+
+
+def build_cfg(prg: List[Operation]) -> List[BasicBlock]:
+    """ Splits the linked program into basic blocks, the first one is the entry. A block starts at every jump target
+    and after every jump and `exit` syscall """
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `build_cfg`'
+    leaders = {0} | {op.jump for op in prg if op.jump is not None}
+    for op_index, op in enumerate(prg):
+        if op.type in CONDITIONAL_JUMPS or op.type in UNCONDITIONAL_JUMPS or \
+                (op.type == OP_SYSCALL1 and halts(prg[op_index - 1: op_index + 1])):
+            leaders.add(op_index + 1)
+    starts = sorted(leader for leader in leaders if leader < len(prg))
+    block_of = {start: index for index, start in enumerate(starts)}
+    blocks = []
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else len(prg)
+        block = BasicBlock(prg[start].loc)
+        block.next = block_of.get(end)
+        for op in prg[start:end]:
+            if op.type in CONDITIONAL_JUMPS:
+                block.branch = op
+                block.target = block_of.get(op.jump)
+            elif op.type in UNCONDITIONAL_JUMPS:
+                block.next = block_of.get(op.jump)
+                block.loc = op.loc
+            elif op.type != OP_WHILE:
+                block.ops.append(op)
+                block.loc = op.loc
+        block.halts = halts(block.ops)
+        blocks.append(block)
+    return blocks
+
+
+def fold_constant_branches(blocks: List[BasicBlock]) -> int:
+    """ Turns the branches on a value pushed in the same block, like `0 if`, into unconditional jumps. Returns the
+    number of branches folded """
+    folded = 0
+    for block in blocks:
+        if block.branch is not None and block.branch.type in [OP_IF, OP_DO] and block.ops \
+                and block.ops[-1].type == OP_PUSH and fits_int64(block.ops[-1].value) and not block.halts:
+            if block.ops.pop().value == 0:
+                block.next = block.target
+            block.branch = None
+            block.target = None
+            folded += 1
+    return folded
+
+
+def thread_jumps(blocks: List[BasicBlock]) -> int:
+    """ Redirects the edges leading to empty blocks, like the `while` an `end` jumps back to, to the block the empty
+    one continues with. Returns the number of edges redirected """
+
+    def destination(block: Optional[int]) -> Optional[int]:
+        seen = set()
+        while block is not None and block not in seen and not blocks[block].ops and blocks[block].branch is None \
+                and not blocks[block].halts:
+            seen.add(block)
+            block = blocks[block].next
+        # An empty block looping on itself is an infinite loop, it is kept as it is
+        return block if block not in seen else min(seen)
+
+    threaded = 0
+    for block in blocks:
+        for attribute in ['next', 'target']:
+            successor = getattr(block, attribute)
+            if successor is not None:
+                threaded_successor = destination(successor)
+                if threaded_successor != successor:
+                    setattr(block, attribute, threaded_successor)
+                    threaded += 1
+    return threaded
+
+
+def reachable_blocks(blocks: List[BasicBlock]) -> List[bool]:
+    """ Marks the blocks reachable from the entry """
+    reachable = [False] * len(blocks)
+    worklist = [0] if blocks else []
+    while worklist:
+        block = worklist.pop()
+        if not reachable[block]:
+            reachable[block] = True
+            worklist.extend(blocks[block].successors())
+    return reachable
+
+
+def layout_blocks(blocks: List[BasicBlock], reachable: List[bool]) -> List[int]:
+    """ Orders the reachable blocks so that as many blocks as possible are followed by their `next` one. Chains of
+    blocks are laid out from the entry, every other chain starts at the first block not placed yet """
+    placed = [False] * len(blocks)
+    order = []
+    for start in range(len(blocks)):
+        block = start
+        while block is not None and reachable[block] and not placed[block]:
+            placed[block] = True
+            order.append(block)
+            block = None if blocks[block].halts else blocks[block].next
+    return order
+
+
+def linearize_blocks(blocks: List[BasicBlock], order: List[int]) -> List[Operation]:
+    """ Turns the laid out blocks back into operations. A block not followed by its `next` one ends with an `end`
+    jumping to it, conditional jumps keep their operation with the new target """
+    starts = {}
+    size = 0
+    for position, block in enumerate(order):
+        starts[block] = size
+        following = order[position + 1] if position + 1 < len(order) else None
+        size += len(blocks[block].ops) + (blocks[block].branch is not None)
+        size += not blocks[block].halts and blocks[block].next != following
+    starts[None] = size
+
+    prg = []
+    for position, index in enumerate(order):
+        following = order[position + 1] if position + 1 < len(order) else None
+        block = blocks[index]
+        # Only the jumps change, the other operations are shared with the program the blocks were built from
+        prg.extend(block.ops)
+        if block.branch is not None:
+            prg.append(Operation(block.branch.type, block.branch.loc, value=block.branch.value,
+                                 jump=starts[block.target]))
+        if not block.halts and block.next != following:
+            prg.append(Operation(OP_END, block.loc, jump=starts[block.next]))
+    return prg
+
+
+def optimize_control_flow(prg: List[Operation], report: Optional[TextIO] = None) -> List[Operation]:
+    """ Control-flow optimization over the basic blocks of the linked program: folds branches on constants, threads
+    jumps through empty blocks (`while`, `end` jumping to the next operation), removes unreachable blocks, like the
+    code after `exit` or in `0 if ... end`, and lays the blocks out to fall through to their successors. The result
+    no longer has the nesting of the source, so it is for the engines that only follow jumps. With `report` the
+    statistics of every pass are written to it """
+    prg = list(prg)
+    blocks = build_cfg(prg)
+    jumps = sum(op.type in CONDITIONAL_JUMPS or op.type in UNCONDITIONAL_JUMPS for op in prg)
+    folded = fold_constant_branches(blocks)
+    threaded = thread_jumps(blocks)
+    reachable = reachable_blocks(blocks)
+    order = layout_blocks(blocks, reachable)
+    result = linearize_blocks(blocks, order)
+    if report is not None:
+        unreachable = [block for block, is_reachable in zip(blocks, reachable) if not is_reachable]
+        print(f"[CFG] build: {len(blocks)} blocks from {len(prg)} operations", file=report)
+        print(f"[CFG] constant branches: {folded} folded", file=report)
+        print(f"[CFG] jump threading: {threaded} edges redirected", file=report)
+        print(f"[CFG] unreachable blocks: {len(unreachable)} removed with "
+              f"{sum(len(block.ops) + (block.branch is not None) for block in unreachable)} operations", file=report)
+        print(f"[CFG] layout: {len(order)} blocks, jumps {jumps} -> "
+              f"{sum(op.type in CONDITIONAL_JUMPS or op.type in UNCONDITIONAL_JUMPS for op in result)}, "
+              f"operations {len(prg)} -> {len(result)}", file=report)
+    return result
+
+
+def check_stack_effects(prg: List[Operation]) -> Tuple[List[Optional[int]], int, Optional[Tuple[str, int, int]]]:
+    """ Statically computes the stack depth before every operation, following both the fall through and the jumps.
+    Returns the depths (`None` for unreachable operations), the maximum depth and the location where it is reached.
+    Raises `StackEffectError` on stack underflow and on blocks that leave a different depth on different paths """
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `check_stack_effects`'
+    depths = [None] * (len(prg) + 1)
+    depths[0] = 0
+    max_depth, max_loc = 0, None
+    worklist = [0]
+    while worklist:
+        op_index = worklist.pop()
+        if op_index == len(prg):
+            continue
+        op = prg[op_index]
+        depth = depths[op_index]
+        inputs, outputs = STACK_EFFECTS[op.type]
+        if depth < inputs:
+            raise StackEffectError(op.loc, f'stack underflow, `{OP_NAMES[op.type]}` takes {inputs} value(s) but the '
+                                           f'stack has {depth}')
+        depth += outputs - inputs
+        if depth > max_depth:
+            max_depth, max_loc = depth, op.loc
+        successors = [] if op.type in [OP_ELSE, OP_END] else [op_index + 1]
+        if op.jump is not None:
+            successors.append(op.jump)
+        for successor in successors:
+            if depths[successor] is None:
+                depths[successor] = depth
+                worklist.append(successor)
+            elif depths[successor] != depth:
+                loc = prg[successor].loc if successor < len(prg) else op.loc
+                raise StackEffectError(loc, f'unbalanced block, stack depth is {depths[successor]} on one path and '
+                                            f'{depth} on another')
+    return depths[:len(prg)], max_depth, max_loc
+
+
+# Operations of the keywords, everything else is an integer to push
+KEYWORDS = {
+    '+': OP_ADD, '-': OP_SUB, 'dump': OP_DUMP, 'drop': OP_DROP, 'swap': OP_SWAP, 'over': OP_OVER, 'clone': OP_CLONE,
+    'clone2': OP_CLONE2, '=': OP_EQ, '>': OP_GT, '>=': OP_GE, '<': OP_LT, '<=': OP_LE, 'bor': OP_BOR, 'band': OP_BAND,
+    'shr': OP_SHR, 'shl': OP_SHL, 'if': OP_IF, 'else': OP_ELSE, 'end': OP_END, 'while': OP_WHILE, 'do': OP_DO,
+    'mem': OP_MEM, 'load': OP_LOAD, 'save': OP_SAVE, 'syscall1': OP_SYSCALL1, 'syscall3': OP_SYSCALL3,
+    'load16': OP_LOAD16, 'load32': OP_LOAD32, 'load64': OP_LOAD64, 'save16': OP_SAVE16, 'save32': OP_SAVE32,
+    'save64': OP_SAVE64, 'memcpy': OP_MEMCPY, 'memset': OP_MEMSET,
+}
+
+
+def convert_to_op(token: Token) -> Operation:
+    assert COUNT_OPS == 43, 'Exhaustive handling of operands in `convert_to_op`'
+    op_type = KEYWORDS.get(token.value)
+    if op_type is not None:
+        return Operation(op_type, token.get_location())
+    try:
+        return Operation(OP_PUSH, token.get_location(), value=int(token.value))
+    except ValueError as err:
+        print(f"{token}: {err}")
+        exit(1)
+
+
+class Module:
+    """ Operations of a source file with the files it includes spliced in, not linked into blocks yet. `sources` lists
+    every file the operations come from, the file of the module first, with their stamps and hashes """
+    __slots__ = ('ops', 'sources')
+
+    def __init__(self, ops: List[Operation], sources: List[Tuple[str, Tuple[int, int], bytes]]):
+        self.ops = ops
+        self.sources = sources
+
+
+# Included modules by path, kept for the life of the process, see `load_module`
+MODULE_CACHE = {}
+# Suffix of the files included modules are cached in, next to the bytecode of the programs
+MODULE_SUFFIX = '.qtm'
+
+
+def sources_unchanged(sources: List[Tuple[str, Tuple[int, int], bytes]]) -> bool:
+    """ Whether none of the files changed, judged by their stamps or, when a stamp differs, by their hashes """
+    for path, stamp, digest in sources:
+        try:
+            if source_stamp(path) != stamp and source_hash(path) != digest:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def load_module(path: str, use_cache: bool = True, cache_dir: Optional[str] = None,
+                including: Tuple[str, ...] = ()) -> Module:
+    """ Parses the file into operations, splicing in the files it includes with `include "<path>"`, resolved relative
+    to the including file. `including` is the chain of files including this one. Included modules are parsed once:
+    they are kept in `MODULE_CACHE` and, with `use_cache`, in `.qtm` files next to the bytecode. A cached module is
+    used only as long as none of its sources has changed """
+    chain = [os.path.abspath(file) for file in including]
+    if including:
+        module = MODULE_CACHE.get(path)
+        if module is None and use_cache:
+            program = read_bytecode(bytecode_path(path, False, cache_dir, MODULE_SUFFIX), False, path)
+            if program is not None:
+                module = Module(list(program), program.sources)
+        # A module including one of the files that include it is parsed again, so the cycle is reported
+        if (module is not None and sources_unchanged(module.sources)
+                and not any(os.path.abspath(source[0]) in chain for source in module.sources)):
+            MODULE_CACHE[path] = module
+            return module
+
+    if not including and not os.path.isfile(path):
+        print(f"ERROR: file {path} doesn't exist")
+        exit(1)
+    ops = []
+    sources = [(path, source_stamp(path), source_hash(path))]
+    tokens = lex_file(path)
+    for token in tokens:
+        if token.value != 'include':
+            ops.append(convert_to_op(token))
+            continue
+        name = next(tokens, None)
+        if name is None or len(name.value) < 2 or name.value[0] != '"' or name.value[-1] != '"':
+            print(f"ERROR: {token}: `include` expects the path of a file in double quotes")
+            exit(1)
+        include_path = os.path.normpath(os.path.join(os.path.dirname(path), name.value[1:-1]))
+        files = [*including, path]
+        if os.path.abspath(include_path) in chain + [os.path.abspath(path)]:
+            cycle = files[[os.path.abspath(file) for file in files].index(os.path.abspath(include_path)):]
+            print(f"ERROR: {name}: include cycle {' -> '.join(cycle + [include_path])}")
+            exit(1)
+        if not os.path.isfile(include_path):
+            print(f"ERROR: {name}: included file {include_path} doesn't exist")
+            exit(1)
+        module = load_module(include_path, use_cache, cache_dir, tuple(files))
+        ops.extend(module.ops)
+        known = {source[0] for source in sources}
+        sources.extend(source for source in module.sources if source[0] not in known)
+
+    module = Module(ops, sources)
+    if including:
+        MODULE_CACHE[path] = module
+        if use_cache and ops:
+            program = Program.from_operations(ops)
+            program.sources = sources
+            try:
+                write_bytecode(program, bytecode_path(path, False, cache_dir, MODULE_SUFFIX), False)
+            except OSError:
+                pass
+    return module
+
+
+def load_program(path: str, use_cache: bool = True, cache_dir: Optional[str] = None) -> List:
+    """ Parses the program with the files it includes and links its blocks. The operations of cached modules are
+    shared, so they are copied before linking sets their jumps """
+    module = load_module(path, use_cache, cache_dir)
+    return construct_blocks(Operation(op.type, op.loc, op.value) for op in module.ops)
+
+
+# Version of the `.qtc` bytecode format, bump it whenever the format or the meaning of the operations changes
+BYTECODE_VERSION = 3
+BYTECODE_MAGIC = b'QTC\0'
+# Magic, format version, number of operations, optimization level, source modification time, size and hash
+BYTECODE_HEADER = struct.Struct('<4sIIBqq32s')
+# Modification time, size and hash of an included source, following the length of its path
+BYTECODE_SOURCE = struct.Struct('<qq32s')
+BYTECODE_CACHE_DIR = '__qtcache__'
+
+
+def source_stamp(path: str) -> Tuple[int, int]:
+    """ Modification time and size of the source, used to validate the bytecode without hashing the source """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def source_hash(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def bytecode_path(path: str, optimize: bool, cache_dir: Optional[str] = None, suffix: str = '.qtc') -> str:
+    """ Path of the bytecode of the source, in `__qtcache__` next to it or in the given cache directory """
+    name = os.path.splitext(os.path.basename(path))[0] + ('.O1' if optimize else '.O0') + suffix
+    if cache_dir is None:
+        return os.path.join(os.path.dirname(path), BYTECODE_CACHE_DIR, name)
+    # Sources from different directories share the cache directory, so the name includes a hash of the full path
+    path_hash = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{path_hash}-{name}')
+
+
+def little_endian(column: array) -> bytes:
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def relative_source(file: str, source_path: str) -> str:
+    """ Path of a file the program comes from as written into the bytecode: relative to the directory of its main
+    source, so the bytecode stays valid when the sources are reached by another path, and empty for the main source """
+    return '' if file == source_path else os.path.relpath(file, os.path.dirname(source_path) or '.')
+
+
+def resolve_source(file: str, source_path: str) -> str:
+    """ Reverse of `relative_source` for the program loaded from `source_path` """
+    return source_path if not file else os.path.normpath(os.path.join(os.path.dirname(source_path), file))
+
+
+def write_bytecode(program: Program, file_path: str, optimize: bool) -> None:
+    """ Writes the program into a `.qtc` bytecode file, together with the stamps and hashes of its sources """
+    source_path, stamp, digest = program.sources[0]
+    out = io.BytesIO()
+    out.write(BYTECODE_HEADER.pack(BYTECODE_MAGIC, BYTECODE_VERSION, COUNT_OPS, optimize, *stamp, digest))
+    out.write(struct.pack('<Q', len(program)))
+    for column in [program.types, program.values, program.jumps, program.loc_files, program.loc_rows,
+                   program.loc_cols]:
+        out.write(little_endian(column))
+    out.write(struct.pack('<I', len(program.files)))
+    for file in program.files:
+        encoded = relative_source(file, source_path).encode('utf-8')
+        out.write(struct.pack('<I', len(encoded)) + encoded)
+    out.write(struct.pack('<I', len(program.wide_values)))
+    for op_index, value in program.wide_values.items():
+        encoded = str(value).encode('ascii')
+        out.write(struct.pack('<QI', op_index, len(encoded)) + encoded)
+    out.write(struct.pack('<I', len(program.sources) - 1))
+    for file, stamp, digest in program.sources[1:]:
+        encoded = relative_source(file, source_path).encode('utf-8')
+        out.write(struct.pack('<I', len(encoded)) + encoded + BYTECODE_SOURCE.pack(*stamp, digest))
+    # Written to a temporary file first, so concurrent runs never see a partially written bytecode
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(out.getvalue())
+    os.replace(temp_path, file_path)
+
+
+def read_bytecode(file_path: str, optimize: bool, source_path: str) -> Optional[Program]:
+    """ Reads the program from a `.qtc` bytecode file, returns `None` if it is missing, was written by another version
+    or any of its sources has changed since """
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < BYTECODE_HEADER.size:
+        return None
+    magic, version, count_ops, level, mtime, size, digest = BYTECODE_HEADER.unpack_from(data)
+    if magic != BYTECODE_MAGIC or version != BYTECODE_VERSION or count_ops != COUNT_OPS or level != optimize:
+        return None
+    # A deleted source makes the bytecode stale too, loading the source reports it
+    if not sources_unchanged([(source_path, (mtime, size), digest)]):
+        return None
+    program = Program()
+    program.sources.append((source_path, (mtime, size), digest))
+    offset = BYTECODE_HEADER.size
+    count, = struct.unpack_from('<Q', data, offset)
+    offset += 8
+    for column in [program.types, program.values, program.jumps, program.loc_files, program.loc_rows,
+                   program.loc_cols]:
+        end = offset + count * column.itemsize
+        column.frombytes(data[offset:end])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        offset = end
+    files, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    for _ in range(files):
+        length, = struct.unpack_from('<I', data, offset)
+        program.files.append(resolve_source(data[offset + 4: offset + 4 + length].decode('utf-8'), source_path))
+        offset += 4 + length
+    wide_values, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    for _ in range(wide_values):
+        op_index, length = struct.unpack_from('<QI', data, offset)
+        program.wide_values[op_index] = int(data[offset + 12: offset + 12 + length])
+        offset += 12 + length
+    sources, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    for _ in range(sources):
+        length, = struct.unpack_from('<I', data, offset)
+        file = resolve_source(data[offset + 4: offset + 4 + length].decode('utf-8'), source_path)
+        mtime, size, digest = BYTECODE_SOURCE.unpack_from(data, offset + 4 + length)
+        program.sources.append((file, (mtime, size), digest))
+        offset += 4 + length + BYTECODE_SOURCE.size
+    if not sources_unchanged(program.sources[1:]):
+        return None
+    return program
+
+
+def build_program(path: str, optimize: bool, use_cache: bool = True, cache_dir: Optional[str] = None) -> Program:
+    """ Runs the front end and, if requested, the optimizer over the source and packs the result """
+    module = load_module(path, use_cache, cache_dir)
+    prg = construct_blocks(Operation(op.type, op.loc, op.value) for op in module.ops)
+    if optimize:
+        prg = optimize_program(prg)
+    program = Program.from_operations(prg)
+    program.sources = module.sources
+    return program
+
+
+def load_program_cached(path: str, optimize: bool, use_cache: bool = True, cache_dir: Optional[str] = None) -> Program:
+    """ Loads the program from its bytecode if it is up to date, otherwise builds it and writes the bytecode """
+    cache_path = bytecode_path(path, optimize, cache_dir)
+    if use_cache:
+        program = read_bytecode(cache_path, optimize, path)
+        if program is not None:
+            return program
+    program = build_program(path, optimize, use_cache, cache_dir)
+    if use_cache and len(program):
+        try:
+            write_bytecode(program, cache_path, optimize)
+        except OSError:
+            # The cache is an optimization only, read-only source directories simply don't get one
+            pass
+    return program
+
+
+def cache_dir(options: List[str]) -> Optional[str]:
+    """ Cache directory given with `--cache-dir=<dir>`, if any """
+    for option in options:
+        if option.startswith('--cache-dir='):
+            return option[len('--cache-dir='):]
+    return None
+
+
+def rule110_source(size: int) -> str:
+    """ Rule 110 with `size` cells for `size` steps, the same program as `examples/rule110.qt` """
+    return f"""mem {size} + 1 save
+0 while clone {size} < do
+    0 while clone {size + 2} < do
+        clone mem + load
+        if
+            clone mem + {size + 2} + 42 save
+        else
+            clone mem + {size + 2} + 32 save
+        end
+        1 +
+    end
+    drop
+    mem {size + 2} + 10 save
+    1 mem {size + 2} + {size + 2} 4 syscall3
+    mem load 1 shl
+    mem 1 + load
+    bor
+    1 while clone {size} < do
+        swap 1 shl 7 band
+        over mem + 1 + load bor
+        clone2 110 swap shr 1 band
+        swap mem + swap save swap
+        1 +
+    end
+    drop
+    drop
+    1 +
+end
+"""
+
+
+def arithmetic_source(size: int) -> str:
+    """ Tight loop of arithmetic over two values kept on the stack """
+    return f"""0 0 while clone {size} < do
+    swap over + 255 band
+    clone 3 shl swap 1 shr bor 1023 band
+    swap 1 +
+end
+drop dump
+"""
+
+
+def memory_source(size: int) -> str:
+    """ Loop saving into and loading from a 64 KiB window of memory """
+    return f"""0 while clone {size} < do
+    clone 65535 band mem + over save
+    clone 32767 band mem + load drop
+    clone 1 + 65535 band mem + load
+    over 65535 band mem + swap save
+    1 +
+end
+drop
+"""
+
+
+def output_source(size: int) -> str:
+    """ Loop printing every counter value with `dump` """
+    return f"""0 while clone {size} < do
+    clone dump
+    1 +
+end
+drop
+"""
+
+
+def straight_line_source(size: int) -> str:
+    """ Generated straight-line source of `size` lines, it mostly measures the front end """
+    line = "clone 1 + 65535 band mem + load drop 7 band clone 2 shl bor  # generated\n"
+    return "0\n" + line * size + "dump\n"
+
+
+# Benchmark programs, with their source generators and the default sizes
+BENCHMARKS = {
+    'rule110': (rule110_source, 100),
+    'arithmetic': (arithmetic_source, 100_000),
+    'memory': (memory_source, 50_000),
+    'output': (output_source, 50_000),
+    'straight-line': (straight_line_source, 5_000),
+}
+# Loop iterations of the arithmetic benchmark program every VM of `run_scheduler_benchmark` runs
+SCHEDULER_BENCH_SIZE = 100
+# Phases timed by `run_benchmark`, in order
+BENCH_PHASES = ['lex', 'convert', 'blocks', 'optimize', 'cfg', 'simulate', 'codegen']
+BENCH_DEFAULT_THRESHOLD = 10.0
+# Phases shorter than this both in the results and in the baseline are not compared
+BENCH_MIN_SECONDS = 0.001
+
+
+def count_executed_operations(prg: List[Operation]) -> int:
+    """ Runs the program with the threaded-code simulator, counting the executed operations """
+    stack = []
+    memory = allocate_memory()
+    output = OutputBuffer()
+    code = decode_program(prg, stack, memory, output)
+    end = len(code)
+    op_index = 0
+    count = 0
+    try:
+        while op_index < end:
+            op_index = code[op_index]()
+            count += 1
+    except SystemExit:
+        count += 1
+    output.flush()
+    return count
+
+
+def run_benchmark(source_path: str, repeat: int, target: str) -> dict:
+    """ Times every phase of loading, simulating and compiling the program, keeping the best of `repeat` runs. The
+    output of the program is discarded """
+    best = {}
+
+    def record(phase: str, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        best[phase] = min(best.get(phase, elapsed), elapsed)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        executed = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            tokens = list(lex_file(source_path))
+            record('lex', start)
+            start = time.perf_counter()
+            ops = [convert_to_op(token) for token in tokens]
+            record('convert', start)
+            start = time.perf_counter()
+            prg = construct_blocks(ops)
+            record('blocks', start)
+            start = time.perf_counter()
+            prg = optimize_program(prg)
+            record('optimize', start)
+            start = time.perf_counter()
+            prg = optimize_control_flow(prg)
+            record('cfg', start)
+            if executed is None:
+                executed = count_executed_operations(prg)
+            max_depth = None
+            start = time.perf_counter()
+            try:
+                try:
+                    depths, max_depth, _ = check_stack_effects(prg)
+                except StackEffectError:
+                    # Like `sim`, programs that can't be verified run on the growing stack and get no stack of
+                    # their own when compiled
+                    simulate_program(prg)
+                else:
+                    simulate_program_static(prg, depths, max_depth)
+            except SystemExit:
+                pass
+            record('simulate', start)
+            start = time.perf_counter()
+            compile_program(prg, f'{source_path}.s', target, 0, max_depth)
+            record('codegen', start)
+    # Every phase but the simulation handles each operation of the program once
+    result = {'ops': len(tokens), 'executed_ops': executed, 'phases': {}}
+    for phase in BENCH_PHASES:
+        count = executed if phase == 'simulate' else len(tokens)
+        result['phases'][phase] = {'seconds': best[phase], 'ops_per_second': count / best[phase] if best[phase] else 0}
+    return result
+
+
+def run_scheduler_benchmark(source_path: str, vms: int, repeat: int) -> dict:
+    """ Times decoding `vms` copies of the program and running them concurrently with `Scheduler`, keeping the best
+    of `repeat` runs """
+    prg = optimize_control_flow(optimize_program(load_program(source_path)))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        executed = count_executed_operations(prg) * vms
+    decode = schedule = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        interpreters = [Interpreter(prg) for _ in range(vms)]
+        elapsed = time.perf_counter() - start
+        decode = min(decode, elapsed) if decode is not None else elapsed
+        start = time.perf_counter()
+        asyncio.run(Scheduler().run_all(interpreters))
+        elapsed = time.perf_counter() - start
+        schedule = min(schedule, elapsed) if schedule is not None else elapsed
+        del interpreters
+    # Every VM decodes every operation once
+    result = {'ops': len(prg) * vms, 'executed_ops': executed, 'phases': {}}
+    result['phases']['decode'] = {'seconds': decode, 'ops_per_second': len(prg) * vms / decode if decode else 0}
+    result['phases']['schedule'] = {'seconds': schedule, 'ops_per_second': executed / schedule if schedule else 0}
+    return result
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """ Returns a description of every phase that got slower than the baseline by more than `threshold` percent """
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks'] or baseline['benchmarks'][name]['ops'] != result['ops']:
+            continue
+        for phase, timing in result['phases'].items():
+            base = baseline['benchmarks'][name]['phases'].get(phase)
+            # Phases this short are dominated by noise
+            if base is None or max(base['seconds'], timing['seconds']) < BENCH_MIN_SECONDS:
+                continue
+            change = (timing['seconds'] / base['seconds'] - 1) * 100
+            if change > threshold:
+                regressions.append(f"{name} {phase}: {base['seconds'] * 1000:.2f}ms -> "
+                                   f"{timing['seconds'] * 1000:.2f}ms ({change:+.1f}%)")
+    return regressions
+
+
+def mem_size(options: List[str]) -> int:
+    """ Size of the memory given with `--mem-size=<bytes>`, `MEMORY_ALLOCATION` by default """
+    size = MEMORY_ALLOCATION
+    for option in options:
+        if option.startswith('--mem-size='):
+            size = int(option[len('--mem-size='):])
+    if size <= 0:
+        print("ERROR: size of the memory must be positive")
+        exit(1)
+    return size
+
+
+def output_buffer_size(options: List[str]) -> int:
+    """ Size of the output buffer given with `--output-buffer=<bytes>` or `--unbuffered`, `OUTPUT_BUFFER_SIZE` by
+    default """
+    size = OUTPUT_BUFFER_SIZE
+    for option in options:
+        if option.startswith('--output-buffer='):
+            size = int(option[len('--output-buffer='):])
+        elif option == '--unbuffered':
+            size = 0
+    return size
+
+
+def checkpoint_options(options: List[str]) -> Tuple[Optional[str], float]:
+    """ Snapshot path given with `--checkpoint=<file>`, if any, and the seconds between the snapshots given with
+    `--checkpoint-every=<seconds>`, `CHECKPOINT_INTERVAL` by default """
+    path = None
+    interval = CHECKPOINT_INTERVAL
+    for option in options:
+        if option.startswith('--checkpoint='):
+            path = option[len('--checkpoint='):]
+        elif option.startswith('--checkpoint-every='):
+            interval = float(option[len('--checkpoint-every='):])
+    if interval <= 0:
+        print("ERROR: interval between the snapshots must be positive")
+        exit(1)
+    return path, interval
+
+
+def simulate_file(program_path: str, options: List[str]) -> None:
+    """ Loads and simulates the program with the engine chosen by the `sim` options """
+    program = load_program_cached(program_path, '-O0' not in options, '--no-cache' not in options,
+                                  cache_dir(options))
+    collapsed_paths = [option[len('--profile-out='):] for option in options
+                       if option.startswith('--profile-out=')]
+    output = OutputBuffer(output_buffer_size(options))
+    memory = allocate_memory(mem_size(options), '--checked' in options)
+    jit_threshold = JIT_THRESHOLD
+    for option in options:
+        if option.startswith('--jit-threshold='):
+            jit_threshold = int(option[len('--jit-threshold='):])
+    jit = any(option in options for option in ['--jit', '--jit-stats'])
+    nested = collapsed_paths or jit or any(option in options for option in ['--dump-code', '--profile', '--transpile',
+                                                                            '--reference'])
+    # The threaded-code engines only follow the jumps, the others rely on the nesting of the blocks
+    if '-O0' not in options and not nested:
+        program = optimize_control_flow(program, sys.stderr if '--cfg-stats' in options else None)
+    int64 = '--int64' in options
+    if int64 and (jit or any(option in options for option in ['--transpile', '--reference'])):
+        print("ERROR: `--int64` is supported only by the threaded-code simulators")
+        exit(1)
+    snapshot_path, interval = checkpoint_options(options)
+    if snapshot_path is not None and nested:
+        print("ERROR: `--checkpoint` is supported only by the threaded-code simulator")
+        exit(1)
+    try:
+        if '--dump-code' in options:
+            print(transpile_program(program), end='')
+        elif '--profile' in options or collapsed_paths:
+            simulate_program_profiled(program, collapsed_paths[-1] if collapsed_paths else None, output, memory,
+                                      int64)
+        elif '--transpile' in options:
+            simulate_transpiled(program, program_path, output, memory)
+        elif '--reference' in options:
+            simulate_program_reference(program, memory)
+        elif jit:
+            simulate_program_jit(program, output, memory, jit_threshold,
+                                 sys.stderr if '--jit-stats' in options else None)
+        elif snapshot_path is not None:
+            # The interpreter allocates the memory itself, so that it knows it is zeroed already
+            vm = Interpreter(program, len(memory), '--checked' in options, output.size, int64=int64)
+            vm.start()
+            # The output goes to the streams of the process, like the output of the other simulators
+            vm.output.stdout = vm.output.stderr = None
+            checkpoint = Checkpoint.create(snapshot_path, program_path, '-O0' not in options, int64, len(memory))
+            simulate_checkpointed(vm, checkpoint, interval)
+        else:
+            try:
+                depths, max_depth, _ = check_stack_effects(program)
+            except StackEffectError:
+                # Programs that can't be verified statically keep the growing stack of the threaded-code simulator
+                simulate_program(program, output, memory, int64)
+            else:
+                simulate_program_static(program, depths, max_depth, output, memory, int64)
+    except MemoryAccessError as err:
+        print(f"ERROR: {err}", file=sys.stderr)
+        exit(1)
+
+
+def resume_file(snapshot_path: str, options: List[str]) -> None:
+    """ Continues the simulation saved in the snapshot, writing the next snapshots into it """
+    checkpoint = Checkpoint.load(snapshot_path)
+    if checkpoint is None:
+        print(f"ERROR: `{snapshot_path}` is not a snapshot of this version of the simulator")
+        exit(1)
+    program = load_program_cached(checkpoint.program_path, checkpoint.optimize, '--no-cache' not in options,
+                                  cache_dir(options))
+    if checkpoint.optimize:
+        program = optimize_control_flow(program)
+    if program_digest(program) != checkpoint.digest:
+        print(f"ERROR: program `{checkpoint.program_path}` has changed since the snapshot was written")
+        exit(1)
+    memory = allocate_memory(len(checkpoint.saved), '--checked' in options, checkpoint.image.fileno())
+    vm = Interpreter(program, output_buffer=output_buffer_size(options), int64=checkpoint.int64, memory=memory)
+    checkpoint.restore(vm)
+    try:
+        simulate_checkpointed(vm, checkpoint, checkpoint_options(options)[1])
+    except MemoryAccessError as err:
+        print(f"ERROR: {err}", file=sys.stderr)
+        exit(1)
+
+
+def collect_programs(paths: List[str]) -> List[str]:
+    """ The given files, plus every `.qt` file found under the given directories in a stable order """
+    programs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            programs.append(path)
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories[:] = sorted(name for name in subdirectories if name != BYTECODE_CACHE_DIR)
+            programs.extend(os.path.join(directory, name) for name in sorted(files) if name.endswith('.qt'))
+    return programs
+
+
+def simulate_captured(job: Tuple[str, List[str]]) -> dict:
+    """ Simulates the program like `simulate_file` does, but collects its stdout and stderr and turns the exit of the
+    program, including `syscall1` and errors, into an exit code instead of leaving the process """
+    program_path, options = job
+    stdout = io.TextIOWrapper(io.BytesIO(), write_through=True)
+    stderr = io.TextIOWrapper(io.BytesIO(), write_through=True)
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    start = time.perf_counter()
+    try:
+        simulate_file(program_path, options)
+        code = 0
+    except SystemExit as err:
+        code = err.code if isinstance(err.code, int) else 0 if err.code is None else 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        seconds = time.perf_counter() - start
+        sys.stdout, sys.stderr = saved
+    # The same exit code the program would have had as a process of its own
+    return {'path': program_path, 'code': code & 0xff, 'seconds': seconds,
+            'stdout': stdout.buffer.getvalue(), 'stderr': stderr.buffer.getvalue()}
+
+
+def simulate_batch(program_paths: List[str], options: List[str], jobs: int) -> int:
+    """ Simulates the programs on `jobs` worker processes, every worker runs many programs so the startup is paid only
+    once. The outputs are printed in the order of the programs, followed by a summary. Returns 1 if any program
+    failed """
+    jobs_list = [(program_path, options) for program_path in program_paths]
+    start = time.perf_counter()
+    if jobs > 1 and len(jobs_list) > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(jobs_list))) as pool:
+            chunk_size = max(1, len(jobs_list) // (jobs * 4))
+            results = []
+            for result in pool.map(simulate_captured, jobs_list, chunksize=chunk_size):
+                write_captured(result)
+                results.append(result)
+    else:
+        results = []
+        for job in jobs_list:
+            results.append(simulate_captured(job))
+            write_captured(results[-1])
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if result['code'] != 0]
+    width = max([len(result['path']) for result in results] + [len('program')])
+    print(f"{'program':<{width}}  {'exit':>4}  {'time':>10}")
+    for result in results:
+        print(f"{result['path']:<{width}}  {result['code']:>4}  {result['seconds'] * 1000:>8.1f}ms")
+    print(f"{len(results)} programs, {len(results) - len(failed)} passed, {len(failed)} failed "
+          f"in {elapsed:.2f}s with {jobs} jobs")
+    return 1 if failed else 0
+
+
+def write_captured(result: dict) -> None:
+    """ Writes the captured output of one program of a batch under a header naming it """
+    sys.stdout.write(f"==> {result['path']} <==\n")
+    sys.stdout.flush()
+    for stream, data in [(sys.stdout, result['stdout']), (sys.stderr, result['stderr'])]:
+        stream.flush()
+        stream.buffer.write(data)
+        # Keep the next header on a line of its own
+        if data and not data.endswith(b'\n'):
+            stream.buffer.write(b'\n')
+        stream.buffer.flush()
+
+
+def usage(prg: str) -> None:
+    print(f"Usage: {prg} <SUBCOMMAND> [ARGS]")
+    print("SUBCOMMANDS:")
+    print("   sim [OPTIONS] <files>    Simulate the program, or every program in the files and directories")
+    print("      -j <N>, -j<N>         Simulate the programs on N processes (0: one per CPU), print a summary")
+    print("      --reference           Use the reference engine instead of the threaded-code one")
+    print("      --transpile           Transpile the program into a python function and run it")
+    print("      --dump-code           Print the python source generated by `--transpile` instead of running it")
+    print("      --jit                 Compile the hot `while` loops into python functions while simulating")
+    print(f"      --jit-threshold=<N>   Compile a loop after N iterations (default: {JIT_THRESHOLD})")
+    print("      --jit-stats           Print the loops and their iterations in both tiers to stderr, implies `--jit`")
+    print(f"      --mem-size=<N>        Size of the memory in bytes (default: {MEMORY_ALLOCATION})")
+    print("      --checked             Check the bounds of every memory access, report the operation going out of them")
+    print("      --int64               Keep the values in 64 bits and wrap them around like the compiled program")
+    print("      --unbuffered          Write the output of every `dump` and `syscall3` immediately")
+    print(f"      --output-buffer=<N>   Buffer up to N bytes of output (default: {OUTPUT_BUFFER_SIZE})")
+    print("      --profile             Count and time every operation, print the hot spots to stderr")
+    print("      --profile-out=<file>  Also write the profile as collapsed stacks for flamegraph tools")
+    print("      -O0, -O1              Disable or enable (default) the peephole and control-flow optimizers")
+    print("      --cfg-stats           Print the statistics of every control-flow optimization pass to stderr")
+    print("      --checkpoint=<file>   Write snapshots of the simulation to the file, also on SIGUSR1 and SIGTERM")
+    print(f"      --checkpoint-every=<N> Seconds between the snapshots (default: {CHECKPOINT_INTERVAL:g})")
+    print("      --resume <file>       Continue the simulation saved in the snapshot instead of running files")
+    print("      --no-cache            Don't read or write the `.qtc` bytecode of the program")
+    print("      --cache-dir=<dir>     Keep the bytecode in the directory instead of `__qtcache__` next to the source")
+    print("   com [OPTIONS] <file>     Compile the program")
+    print("      -r                    Run the program after compilation")
+    print("      -o <path>             Path of the executable (default: output)")
+    print(f"      --target=<target>     One of: {', '.join(TARGETS)} (default: host)")
+    print("      --stack-regs=<N>      Keep the top N values of the stack in registers (default: 0, disabled)")
+    print(f"      --mem-size=<N>        Size of the memory in bytes (default: {MEMORY_ALLOCATION})")
+    print("      --buffered-output     Collect the output in a buffer instead of making a syscall for every write")
+    print("      --output-buffer=<N>   Same as `--buffered-output` with a buffer of N bytes "
+          f"(default: {OUTPUT_BUFFER_SIZE})")
+    print("      -O0, -O1              Disable or enable (default) the peephole and control-flow optimizers")
+    print("      --cfg-stats           Print the statistics of every control-flow optimization pass")
+    print("      --no-cache            Don't read or write the `.qtc` bytecode of the program")
+    print("      --cache-dir=<dir>     Keep the bytecode in the directory instead of `__qtcache__` next to the source")
+    print("   check <file>             Check the stack effects of the program and report its maximum depth")
+    print("   build [OPTIONS] <files>  Precompile the programs into `.qtc` bytecode")
+    print("      -O0, -O1              Disable or enable (default) the peephole optimizer")
+    print("      --cache-dir=<dir>     Keep the bytecode in the directory instead of `__qtcache__` next to the source")
+    print("   bench [OPTIONS] [names]  Time every phase of the benchmark programs, all of them by default")
+    print(f"                            One of: {', '.join(BENCHMARKS)}")
+    print("      --scale=<N>           Multiply the size of every benchmark by N (default: 1)")
+    print("      --repeat=<N>          Keep the best of N runs (default: 3)")
+    print("      --vms=<N>             Also run N small programs concurrently on the asyncio scheduler")
+    print("      --json=<file>         Write the results into the file")
+    print("      --baseline=<file>     Compare to the results written before with `--json`, fail on regressions")
+    print(f"      --threshold=<P>       Allowed slowdown against the baseline in percent (default: "
+          f"{BENCH_DEFAULT_THRESHOLD:g})")
+
+
+def call_cmd(cmd: List[str]) -> int:
+    print(cmd)
+    return subprocess.call(cmd)
+
+
+def compiler_version() -> str:
+    """ Hash of the compiler itself, so that any change to it invalidates the build cache """
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_key(program: Program, target: str, stack_registers: int, stack_depth: Optional[int],
+              output_buffer: int = 0, mem_size: int = MEMORY_ALLOCATION) -> str:
+    """ Content address of the executable built from the program with the given options. Source locations don't
+    affect the generated code, so only the operations are hashed """
+    key = hashlib.sha256()
+    key.update(f'{compiler_version()}:{target}:{stack_registers}:{stack_depth}:{output_buffer}:'
+               f'{mem_size}:'.encode())
+    for column in [program.types, program.values, program.jumps]:
+        key.update(little_endian(column))
+    key.update(repr(sorted(program.wide_values.items())).encode())
+    return key.hexdigest()
+
+
+def compile_executable(program_path: str, output_path: str, target: str, stack_registers: int, optimize: bool,
+                       use_cache: bool, cache_directory: Optional[str], output_buffer: int = 0,
+                       mem_size: int = MEMORY_ALLOCATION, cfg_stats: bool = False) -> None:
+    """ Compiles the program into an executable at `output_path`, reusing an executable from the build cache when the
+    program and the options are unchanged. Intermediate files are named after the output, so builds with different
+    outputs can run concurrently in one directory """
+    timings = []
+    start = time.perf_counter()
+    program = load_program_cached(program_path, optimize, use_cache, cache_directory)
+    if optimize:
+        program = Program.from_operations(optimize_control_flow(program, sys.stdout if cfg_stats else None))
+    try:
+        _, stack_depth, _ = check_stack_effects(program)
+    except StackEffectError:
+        stack_depth = None
+    timings.append(('load', time.perf_counter() - start))
+
+    if cache_directory is None:
+        cache_directory = os.path.join(os.path.dirname(program_path), BYTECODE_CACHE_DIR)
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    key = build_key(program, target, stack_registers, stack_depth, output_buffer, mem_size)
+    cached_path = os.path.join(cache_directory, f'{key}.bin')
+    if use_cache and os.path.exists(cached_path):
+        start = time.perf_counter()
+        temp_path = f'{output_path}.{os.getpid()}.tmp'
+        shutil.copy2(cached_path, temp_path)
+        os.replace(temp_path, output_path)
+        timings.append(('copy', time.perf_counter() - start))
+        print(f"[CACHE] hit {cached_path}")
+    else:
+        start = time.perf_counter()
+        compile_program(program, f'{output_path}.s', target, stack_registers, stack_depth, output_buffer,
+                        mem_size)
+        timings.append(('codegen', time.perf_counter() - start))
+        for step, cmd in [('as', ['as', '-o', f'{output_path}.o', f'{output_path}.s']),
+                          ('ld', ['ld', '-o', output_path, f'{output_path}.o'])]:
+            start = time.perf_counter()
+            if call_cmd(cmd) != 0:
+                print(f"ERROR: `{step}` failed")
+                exit(1)
+            timings.append((step, time.perf_counter() - start))
+        if use_cache:
+            os.makedirs(cache_directory, exist_ok=True)
+            temp_path = f'{cached_path}.{os.getpid()}.tmp'
+            shutil.copy2(output_path, temp_path)
+            os.replace(temp_path, cached_path)
+            print(f"[CACHE] miss, stored {cached_path}")
+    print("[TIME] " + ', '.join(f'{step} {elapsed * 1000:.1f}ms' for step, elapsed in timings))
+
+
+if __name__ == '__main__':
+    argv = sys.argv
+    program_name, *argv = argv
 
     if len(argv) < 1:
         usage(program_name)
@@ -650,25 +4585,187 @@ if __name__ == '__main__':
             usage(program_name)
             print("ERROR: no file is provided for simulation")
             exit(1)
-        program_path, *argv = argv
-        program = load_program(program_path)
-        simulate_program(program)
+        options = []
+        program_paths = []
+        jobs = None
+        snapshot_path = None
+        while argv:
+            arg, *argv = argv
+            if arg == '-j':
+                if len(argv) < 1:
+                    usage(program_name)
+                    print("ERROR: no number of jobs is provided for `-j`")
+                    exit(1)
+                jobs, *argv = argv
+                jobs = int(jobs) or os.cpu_count() or 1
+            elif arg.startswith('-j') and arg[2:].isdigit():
+                jobs = int(arg[2:]) or os.cpu_count() or 1
+            elif arg == '--resume':
+                if len(argv) < 1:
+                    usage(program_name)
+                    print("ERROR: no snapshot is provided for `--resume`")
+                    exit(1)
+                snapshot_path, *argv = argv
+            elif arg.startswith('-'):
+                # Options apply to all the programs, wherever they are given
+                options.append(arg)
+            else:
+                program_paths.append(arg)
+        if snapshot_path is not None:
+            if program_paths or jobs is not None:
+                usage(program_name)
+                print("ERROR: `--resume` continues the program of the snapshot, no files are expected")
+                exit(1)
+            resume_file(snapshot_path, options)
+            exit(0)
+        if len(program_paths) < 1:
+            usage(program_name)
+            print("ERROR: no file is provided for simulation")
+            exit(1)
+        if any(option.startswith('--checkpoint=') for option in options) and \
+                (jobs is not None or len(program_paths) > 1 or os.path.isdir(program_paths[0])):
+            usage(program_name)
+            print("ERROR: `--checkpoint` is supported only for a single program")
+            exit(1)
+        if jobs is None and len(program_paths) == 1 and not os.path.isdir(program_paths[0]):
+            simulate_file(program_paths[0], options)
+        else:
+            exit(simulate_batch(collect_programs(program_paths), options, jobs or 1))
     elif subcommand == 'com':
-        options = ''
         if len(argv) < 1:
             usage(program_name)
             print("ERROR: no file is provided for compilation")
             exit(1)
-        elif len(argv) > 1:
-            options, program_path, *argv = argv
+        options = []
+        output_path = 'output'
+        while len(argv) > 1 and argv[0].startswith('-'):
+            option, *argv = argv
+            if option == '-o':
+                output_path, *argv = argv
+            else:
+                options.append(option)
+        if len(argv) < 1:
+            usage(program_name)
+            print("ERROR: no file is provided for compilation")
+            exit(1)
+        program_path, *argv = argv
+        target = default_target()
+        stack_registers = 0
+        output_buffer = 0
+        for option in options:
+            if option.startswith('--stack-regs='):
+                stack_registers = int(option[len('--stack-regs='):])
+            elif option == '--buffered-output':
+                output_buffer = OUTPUT_BUFFER_SIZE
+            elif option.startswith('--output-buffer='):
+                output_buffer = int(option[len('--output-buffer='):])
+                if output_buffer <= 0:
+                    usage(program_name)
+                    print("ERROR: size of the output buffer must be positive")
+                    exit(1)
+            elif option.startswith('--target='):
+                target = option[len('--target='):]
+                if target not in TARGETS:
+                    usage(program_name)
+                    print(f"ERROR: unknown target {target}, expected one of: {', '.join(TARGETS)}")
+                    exit(1)
+        emitter_class = Arm64Emitter if target == TARGET_ARM64_MACOS else X86_64Emitter
+        if stack_registers and not MIN_STACK_REGISTERS <= stack_registers <= len(emitter_class.registers):
+            usage(program_name)
+            print(f"ERROR: number of stack registers must be between {MIN_STACK_REGISTERS} and "
+                  f"{len(emitter_class.registers)} for {target}")
+            exit(1)
+        compile_executable(program_path, output_path, target, stack_registers, '-O0' not in options,
+                           '--no-cache' not in options, cache_dir(options), output_buffer, mem_size(options),
+                           '--cfg-stats' in options)
+        if '-r' in options:
+            call_cmd([os.path.join('.', output_path)])
+    elif subcommand == 'build':
+        options = [arg for arg in argv if arg.startswith('-')]
+        program_paths = [arg for arg in argv if not arg.startswith('-')]
+        if len(program_paths) < 1:
+            usage(program_name)
+            print("ERROR: no file is provided for building")
+            exit(1)
+        for program_path in program_paths:
+            program = build_program(program_path, '-O0' not in options, True, cache_dir(options))
+            output_path = bytecode_path(program_path, '-O0' not in options, cache_dir(options))
+            write_bytecode(program, output_path, '-O0' not in options)
+            print(f"{program_path} -> {output_path}")
+    elif subcommand == 'check':
+        if len(argv) < 1:
+            usage(program_name)
+            print("ERROR: no file is provided for checking")
+            exit(1)
+        program_path, *argv = argv
+        try:
+            _, max_depth, max_loc = check_stack_effects(load_program(program_path))
+        except StackEffectError as err:
+            print(f"ERROR: {err}")
+            exit(1)
+        if max_loc is None:
+            print(f"{program_path}: stack is balanced, it is never used")
         else:
-            program_path, *argv = argv
-        program = load_program(program_path)
-        compile_program(program, 'output.s')
-        call_cmd(['as', '-o', 'output.o', 'output.s'])
-        call_cmd(['ld', '-o', 'output', 'output.o'])
-        if options == '-r':
-            call_cmd(['./output'])
+            print(f"{program_path}: stack is balanced, maximum depth is {max_depth} at {format_location(max_loc)}")
+    elif subcommand == 'bench':
+        options = [arg for arg in argv if arg.startswith('-')]
+        names = [arg for arg in argv if not arg.startswith('-')] or list(BENCHMARKS)
+        scale, repeat, json_path, baseline_path, threshold = 1, 3, None, None, BENCH_DEFAULT_THRESHOLD
+        vms = 0
+        for option in options:
+            if option.startswith('--scale='):
+                scale = int(option[len('--scale='):])
+            elif option.startswith('--repeat='):
+                repeat = int(option[len('--repeat='):])
+            elif option.startswith('--json='):
+                json_path = option[len('--json='):]
+            elif option.startswith('--baseline='):
+                baseline_path = option[len('--baseline='):]
+            elif option.startswith('--threshold='):
+                threshold = float(option[len('--threshold='):])
+            elif option.startswith('--vms='):
+                vms = int(option[len('--vms='):])
+        for name in names:
+            if name not in BENCHMARKS:
+                usage(program_name)
+                print(f"ERROR: unknown benchmark {name}, expected one of: {', '.join(BENCHMARKS)}")
+                exit(1)
+        results = {'python': platform.python_version(), 'scale': scale, 'repeat': repeat, 'benchmarks': {}}
+        with tempfile.TemporaryDirectory() as work_dir:
+            for name in names:
+                generate, size = BENCHMARKS[name]
+                source_path = os.path.join(work_dir, f'{name}.qt')
+                with open(source_path, 'w') as f:
+                    f.write(generate(size * scale))
+                result = run_benchmark(source_path, repeat, default_target())
+                results['benchmarks'][name] = result
+                print(f"{name}: {result['ops']} ops, {result['executed_ops']} executed")
+                for phase, timing in result['phases'].items():
+                    print(f"    {phase:<10}{timing['seconds'] * 1000:>12.2f}ms"
+                          f"{timing['ops_per_second'] / 1e6:>12.2f}M ops/s")
+            if vms > 0:
+                source_path = os.path.join(work_dir, 'scheduler.qt')
+                with open(source_path, 'w') as f:
+                    f.write(arithmetic_source(SCHEDULER_BENCH_SIZE * scale))
+                name = f'scheduler-{vms}'
+                result = run_scheduler_benchmark(source_path, vms, repeat)
+                results['benchmarks'][name] = result
+                print(f"{name}: {vms} VMs, {result['executed_ops']} executed ops")
+                for phase, timing in result['phases'].items():
+                    print(f"    {phase:<10}{timing['seconds'] * 1000:>12.2f}ms"
+                          f"{timing['ops_per_second'] / 1e6:>12.2f}M ops/s")
+        if json_path is not None:
+            with open(json_path, 'w') as f:
+                json.dump(results, f, indent=2)
+        if baseline_path is not None:
+            with open(baseline_path, 'r') as f:
+                regressions = compare_to_baseline(results, json.load(f), threshold)
+            if regressions:
+                print(f"ERROR: regressions of more than {threshold}% against {baseline_path}:")
+                for regression in regressions:
+                    print(f"    {regression}")
+                exit(1)
+            print(f"No regressions of more than {threshold}% against {baseline_path}")
     else:
         usage(program_name)
         print(f"ERROR: unknown subcommand {subcommand}")
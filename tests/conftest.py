@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The tests import `quantum` from the root of the repository and the helpers next to them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
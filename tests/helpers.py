@@ -0,0 +1,101 @@
+""" Helpers of the tests: writing programs, running them with `quantum.py` and generating random ones """
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUANTUM = os.path.join(ROOT, 'quantum.py')
+EXAMPLES = sorted(os.path.join(ROOT, 'examples', name) for name in os.listdir(os.path.join(ROOT, 'examples'))
+                  if name.endswith('.qt'))
+
+
+def write_program(directory, source: str, name: str = 'program.qt') -> str:
+    """ Writes the source into the directory and returns its path """
+    path = os.path.join(str(directory), name)
+    with open(path, 'w') as f:
+        f.write(source)
+    return path
+
+
+def run_quantum(*args: str, timeout: float = 120, cwd: str = None) -> subprocess.CompletedProcess:
+    """ Runs `quantum.py` with the arguments, capturing the output as bytes """
+    return subprocess.run([sys.executable, QUANTUM, *args], capture_output=True, timeout=timeout, cwd=cwd)
+
+
+def simulate(path: str, *options: str) -> tuple:
+    """ Stdout and exit code of `sim` with the options, the bytecode cache is not touched """
+    result = run_quantum('sim', '--no-cache', *options, path)
+    return result.stdout, result.returncode
+
+
+def can_compile() -> bool:
+    return platform.system() == 'Linux' and platform.machine() in ['x86_64', 'AMD64'] and \
+        shutil.which('as') is not None and shutil.which('ld') is not None
+
+
+def compile_and_run(path: str, *options: str) -> tuple:
+    """ Stdout and exit code of the program compiled for x86-64 Linux with the options, skips the test when the host
+    can't assemble and run it """
+    if not can_compile():
+        pytest.skip('needs an x86-64 Linux host with `as` and `ld`')
+    output_path = os.path.splitext(path)[0] + ''.join(options).replace('=', '').replace('-', '_') + '.out'
+    result = run_quantum('com', '--no-cache', '--target=x86_64-linux', '-o', output_path, *options, path)
+    assert result.returncode == 0, result.stdout + result.stderr
+    run = subprocess.run([output_path], capture_output=True, timeout=60)
+    return run.stdout, run.returncode
+
+
+def random_block(rng: random.Random, depth: int = 0) -> str:
+    """ Random block leaving the stack as it found it, with nested `if` and `while` blocks and memory accesses """
+    words = []
+    pushed = 0
+    for _ in range(rng.randint(1, 8)):
+        choice = rng.random()
+        if choice < 0.25:
+            words.append(str(rng.choice([rng.randint(-5, 300), rng.randint(-2 ** 63, 2 ** 63 - 1)])))
+            pushed += 1
+        elif choice < 0.4 and pushed >= 2:
+            words.append(rng.choice(['+', '-', 'bor', 'band', '=', '>', '>=', '<', '<=', 'swap', 'over', 'clone2']))
+            pushed += {'swap': 0, 'over': 1, 'clone2': 2}.get(words[-1], -1)
+        elif choice < 0.5 and pushed >= 1:
+            words.append(rng.choice([f'{rng.randint(0, 70)} shl', f'{rng.randint(0, 70)} shr', '1 +', '3 -']))
+        elif choice < 0.6 and pushed >= 1:
+            words.append('dump')
+            pushed -= 1
+        elif choice < 0.68:
+            words.append(f'mem {rng.randint(0, 50)} + {rng.randint(32, 126)} save')
+        elif choice < 0.74:
+            words.append(f'mem {rng.randint(0, 50)} + load')
+            pushed += 1
+        elif choice < 0.78:
+            words.append(f'mem {rng.randint(0, 50)} + {rng.randint(-70000, 70000)} save{rng.choice([16, 32, 64])}')
+        elif choice < 0.82:
+            words.append(f'mem {rng.randint(0, 50)} + load{rng.choice([16, 32, 64])}')
+            pushed += 1
+        elif choice < 0.84:
+            words.append(f'mem {rng.randint(0, 50)} + mem {rng.randint(0, 50)} + {rng.randint(0, 20)} memcpy')
+        elif choice < 0.86:
+            words.append(f'mem {rng.randint(0, 50)} + {rng.randint(-300, 300)} {rng.randint(0, 20)} memset')
+        elif choice < 0.93 and depth < 3:
+            words.append(f'{rng.randint(0, 3)} {rng.randint(0, 3)} {rng.choice(["<", "=", ">=", "<=", ">"])} '
+                         f'if {random_block(rng, depth + 1)} else {random_block(rng, depth + 1)} end')
+        elif depth < 3:
+            words.append(f'{rng.randint(0, 6)} while clone 0 > do {random_block(rng, depth + 1)} 1 - end drop')
+    words += ['dump'] * pushed
+    return ' '.join(words)
+
+
+def random_program(seed: int) -> str:
+    """ Random balanced program, some of them write memory to stdout or exit with a code of their own """
+    rng = random.Random(seed)
+    source = random_block(rng)
+    if rng.random() < 0.3:
+        source += ' 1 mem 5 + 3 4 syscall3'
+    if rng.random() < 0.1:
+        source += ' 7 1 syscall1 999 dump'
+    return source + '\n'
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from helpers import EXAMPLES, run_quantum, simulate, write_program
+
+
+def test_options_after_the_file(tmp_path):
+    path = write_program(tmp_path, '1 2 + dump\n')
+    result = run_quantum('sim', path, '--no-cache', '-O0')
+    assert (result.stdout, result.returncode) == (b'3\n', 0)
+    assert not os.path.exists(os.path.join(str(tmp_path), '__qtcache__'))
+
+
+@pytest.mark.parametrize('jobs', [['-j', '2'], ['-j2']])
+def test_jobs_after_the_files(tmp_path, jobs):
+    write_program(tmp_path, '1 dump\n', 'a.qt')
+    write_program(tmp_path, '2 dump 5 1 syscall1\n', 'b.qt')
+    result = run_quantum('sim', str(tmp_path), '--no-cache', *jobs)
+    assert result.returncode == 1
+    assert b'2 programs, 1 passed, 1 failed' in result.stdout
+    assert result.stdout.index(b'1\n') < result.stdout.index(b'2\n')
+
+
+def test_batch_output_matches_single_runs():
+    result = run_quantum('sim', '--no-cache', '-j', '2', *EXAMPLES)
+    for path in EXAMPLES:
+        stdout, _ = simulate(path)
+        assert stdout in result.stdout
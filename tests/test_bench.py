@@ -0,0 +1,24 @@
+import quantum
+from helpers import write_program
+
+
+def test_benchmark_of_unverifiable_program(tmp_path):
+    # The loop leaves a value on the stack on every iteration, so the stack effects can't be verified
+    path = write_program(tmp_path, '0 while clone 5 < do clone 1 + end dump\n')
+    result = quantum.run_benchmark(path, 1, quantum.TARGET_X86_64_LINUX)
+    assert set(result['phases']) == set(quantum.BENCH_PHASES)
+    assert result['executed_ops'] > result['ops']
+
+
+def test_benchmark_of_generated_program(tmp_path):
+    path = write_program(tmp_path, quantum.rule110_source(10))
+    result = quantum.run_benchmark(path, 2, quantum.TARGET_ARM64_MACOS)
+    assert all(phase['seconds'] >= 0 for phase in result['phases'].values())
+
+
+def test_regressions_over_threshold():
+    def results(seconds: float) -> dict:
+        return {'benchmarks': {'rule110': {'ops': 10, 'phases': {'simulate': {'seconds': seconds}}}}}
+    assert quantum.compare_to_baseline(results(0.5), results(0.4), 10.0)
+    assert not quantum.compare_to_baseline(results(0.42), results(0.4), 10.0)
+    assert not quantum.compare_to_baseline(results(0.0005), results(0.0001), 10.0)
@@ -0,0 +1,195 @@
+import itertools
+import os
+import subprocess
+
+import pytest
+
+import quantum
+from helpers import can_compile, run_quantum, simulate, write_program
+
+# Distinct modification times for the rewritten sources, the stamps of files written within the resolution of the
+# file system clock could be equal otherwise
+STAMPS = itertools.count(1)
+
+
+def rewrite(directory, source: str, name: str = 'program.qt') -> str:
+    path = write_program(directory, source, name)
+    os.utime(path, ns=(0, next(STAMPS)))
+    return path
+
+
+def operations(prg) -> list:
+    return [(op.type, op.value, op.jump) for op in prg]
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_bytecode_round_trip(tmp_path, optimize):
+    path = write_program(tmp_path, '1 2 + dump 0 while clone 3 < do 1 + end drop 18446744073709551616 dump\n')
+    built = quantum.load_program_cached(path, optimize)
+    assert os.path.exists(quantum.bytecode_path(path, optimize))
+    loaded = quantum.read_bytecode(quantum.bytecode_path(path, optimize), optimize, path)
+    assert loaded is not None
+    assert operations(loaded) == operations(built)
+    assert [op.loc for op in loaded] == [op.loc for op in built]
+
+
+def test_bytecode_of_changed_source_is_stale(tmp_path):
+    path = write_program(tmp_path, '1 dump\n')
+    quantum.load_program_cached(path, True)
+    rewrite(tmp_path, '2 dump\n')
+    assert quantum.read_bytecode(quantum.bytecode_path(path, True), True, path) is None
+    assert run_quantum('sim', path).stdout == b'2\n'
+
+
+def test_bytecode_of_touched_source_is_kept(tmp_path):
+    path = write_program(tmp_path, '1 dump\n')
+    quantum.load_program_cached(path, True)
+    os.utime(path, ns=(0, 0))
+    assert quantum.read_bytecode(quantum.bytecode_path(path, True), True, path) is not None
+
+
+def test_bytecode_of_other_level_is_not_used(tmp_path):
+    path = write_program(tmp_path, '1 dump\n')
+    quantum.load_program_cached(path, True)
+    assert quantum.read_bytecode(quantum.bytecode_path(path, True), False, path) is None
+
+
+def test_bytecode_of_deleted_source_is_stale(tmp_path):
+    path = write_program(tmp_path, '1 dump\n')
+    quantum.load_program_cached(path, True)
+    os.remove(path)
+    assert quantum.read_bytecode(quantum.bytecode_path(path, True), True, path) is None
+    result = run_quantum('sim', path)
+    assert result.returncode == 1
+    assert b"doesn't exist" in result.stdout
+
+
+def test_cache_dir(tmp_path):
+    path = write_program(tmp_path, '1 dump\n')
+    cache = str(tmp_path / 'cache')
+    assert run_quantum('sim', f'--cache-dir={cache}', path).stdout == b'1\n'
+    assert os.listdir(cache)
+    assert not os.path.exists(os.path.join(str(tmp_path), quantum.BYTECODE_CACHE_DIR))
+
+
+def write_library(tmp_path, value: int) -> None:
+    os.makedirs(str(tmp_path / 'lib'), exist_ok=True)
+    write_program(tmp_path / 'lib', f'include "inner.qt" {value} +\n', 'outer.qt')
+    write_program(tmp_path / 'lib', '1 dump\n', 'inner.qt')
+
+
+def test_include_splices_modules(tmp_path):
+    write_library(tmp_path, 10)
+    path = write_program(tmp_path, '5 include "lib/outer.qt" dump include "lib/inner.qt"\n')
+    assert simulate(path) == simulate(path, '--reference') == (b'1\n15\n1\n', 0)
+
+
+def test_edited_library_invalidates_bytecode(tmp_path):
+    write_library(tmp_path, 10)
+    path = write_program(tmp_path, '5 include "lib/outer.qt" dump\n')
+    assert run_quantum('sim', path).stdout == b'1\n15\n'
+    rewrite(tmp_path / 'lib', '2 dump\n', 'inner.qt')
+    assert run_quantum('sim', path).stdout == b'2\n15\n'
+    rewrite(tmp_path / 'lib', 'include "inner.qt" 20 +\n', 'outer.qt')
+    assert run_quantum('sim', path).stdout == b'2\n25\n'
+
+
+def test_module_cache_drops_changed_modules(tmp_path):
+    write_library(tmp_path, 10)
+    outer = str(tmp_path / 'lib' / 'outer.qt')
+    module = quantum.load_module(outer, False, including=('main.qt',))
+    assert quantum.load_module(outer, False, including=('main.qt',)) is module
+    rewrite(tmp_path / 'lib', '3 dump\n', 'inner.qt')
+    changed = quantum.load_module(outer, False, including=('main.qt',))
+    assert changed is not module
+    assert [op.value for op in changed.ops if op.type == quantum.OP_PUSH] == [3, 10]
+
+
+def test_module_bytecode_is_reused(tmp_path):
+    write_library(tmp_path, 10)
+    path = write_program(tmp_path, '5 include "lib/outer.qt" dump\n')
+    assert run_quantum('sim', path).stdout == b'1\n15\n'
+    cached = quantum.bytecode_path(str(tmp_path / 'lib' / 'outer.qt'), False, None, quantum.MODULE_SUFFIX)
+    assert os.path.exists(cached)
+    program = quantum.read_bytecode(cached, False, str(tmp_path / 'lib' / 'outer.qt'))
+    assert program is not None
+    assert [source[0] for source in program.sources] == [str(tmp_path / 'lib' / 'outer.qt'),
+                                                         str(tmp_path / 'lib' / 'inner.qt')]
+
+
+def test_bytecode_is_valid_from_other_directories(tmp_path):
+    write_library(tmp_path, 10)
+    write_program(tmp_path, '5 include "lib/outer.qt" dump\n')
+    assert run_quantum('sim', 'program.qt', cwd=str(tmp_path)).stdout == b'1\n15\n'
+    assert run_quantum('sim', os.path.join(os.path.basename(str(tmp_path)), 'program.qt'),
+                       cwd=os.path.dirname(str(tmp_path))).stdout == b'1\n15\n'
+
+
+@pytest.mark.parametrize('files, message', [
+    ({'program.qt': 'include "a.qt"\n', 'a.qt': 'include "b.qt"\n', 'b.qt': 'include "a.qt"\n'},
+     b'include cycle '),
+    ({'program.qt': '1 dump include "missing.qt"\n'}, b"included file "),
+    ({'program.qt': 'include missing.qt\n'}, b'`include` expects the path of a file in double quotes'),
+])
+def test_include_errors(tmp_path, files, message):
+    for name, source in files.items():
+        write_program(tmp_path, source, name)
+    result = run_quantum('sim', '--no-cache', str(tmp_path / 'program.qt'))
+    assert result.returncode == 1
+    assert message in result.stdout
+
+
+def test_locations_point_into_included_file(tmp_path):
+    write_program(tmp_path, '1 dump\nmem 100 + load\n', 'lib.qt')
+    path = write_program(tmp_path, 'include "lib.qt" dump\n')
+    result = run_quantum('sim', '--no-cache', '--checked', '--mem-size=64', path)
+    assert f'{tmp_path / "lib.qt"}:1:10: memory access out of bounds'.encode() in result.stderr
+
+
+def build_key(tmp_path, source: str, *args) -> str:
+    program = quantum.load_program_cached(write_program(tmp_path, source), True, False)
+    return quantum.build_key(program, *(args or (quantum.TARGET_X86_64_LINUX, 0, 1)))
+
+
+def test_build_key_depends_on_operations_and_options(tmp_path):
+    key = build_key(tmp_path, '1 dump\n')
+    assert build_key(tmp_path, '\n  1   dump  \n') == key
+    assert build_key(tmp_path, '2 dump\n') != key
+    assert build_key(tmp_path, '18446744073709551616 dump\n') != build_key(tmp_path, '36893488147419103232 dump\n')
+    options = [(quantum.TARGET_ARM64_MACOS, 0, 1), (quantum.TARGET_X86_64_LINUX, 3, 1),
+               (quantum.TARGET_X86_64_LINUX, 0, 2), (quantum.TARGET_X86_64_LINUX, 0, 1, 64),
+               (quantum.TARGET_X86_64_LINUX, 0, 1, 0, 1024)]
+    keys = {build_key(tmp_path, '1 dump\n', *args) for args in options}
+    assert len(keys) == len(options) and key not in keys
+
+
+def compile_cached(tmp_path, *options: str) -> bytes:
+    if not can_compile():
+        pytest.skip('needs an x86-64 Linux host with `as` and `ld`')
+    output_path = str(tmp_path / 'program')
+    result = run_quantum('com', '--target=x86_64-linux', '-o', output_path, *options, str(tmp_path / 'program.qt'))
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+
+def test_build_cache_reuses_executable(tmp_path):
+    write_program(tmp_path, '1 dump\n')
+    assert b'[CACHE] miss' in compile_cached(tmp_path)
+    assert b'[CACHE] hit' in compile_cached(tmp_path)
+    assert b'[CACHE] miss' in compile_cached(tmp_path, '--stack-regs=3')
+    assert b'[CACHE] miss' in compile_cached(tmp_path, '--buffered-output')
+    assert b'[CACHE] hit' in compile_cached(tmp_path, '--stack-regs=3')
+
+
+def test_build_cache_of_changed_program(tmp_path):
+    write_program(tmp_path, '1 dump\n')
+    compile_cached(tmp_path)
+    rewrite(tmp_path, '2 dump\n')
+    assert b'[CACHE] miss' in compile_cached(tmp_path)
+    assert subprocess.run([str(tmp_path / 'program')], capture_output=True).stdout == b'2\n'
+
+
+def test_build_without_cache(tmp_path):
+    write_program(tmp_path, '1 dump\n')
+    assert b'[CACHE]' not in compile_cached(tmp_path, '--no-cache')
+    assert not os.path.exists(str(tmp_path / quantum.BYTECODE_CACHE_DIR))
@@ -0,0 +1,53 @@
+import pytest
+
+import quantum
+from helpers import EXAMPLES, compile_and_run, random_program, run_quantum, simulate, write_program
+
+BRANCHY_SOURCES = [
+    '0 if 1 dump else 2 dump end 3 dump',
+    '1 if 1 dump else 2 dump end 3 dump',
+    '0 while 0 do 1 dump end drop 4 dump',
+    '3 while clone 0 > do clone dump 1 - end drop',
+    '1 dump 0 1 syscall1 2 dump',
+    '2 while clone do 1 - 0 if 9 dump end end drop 5 dump',
+]
+
+
+@pytest.mark.parametrize('source', BRANCHY_SOURCES)
+def test_cfg_keeps_output(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert simulate(path) == simulate(path, '-O0')
+    assert simulate(path) == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_cfg_keeps_output_of_examples(path):
+    assert simulate(path) == simulate(path, '-O0')
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_cfg_keeps_output_of_random_programs(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--int64') == simulate(path, '--int64', '-O0')
+    assert simulate(path) == simulate(path, '-O0')
+
+
+@pytest.mark.parametrize('source', BRANCHY_SOURCES)
+def test_cfg_keeps_output_of_compiled_program(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert compile_and_run(path) == compile_and_run(path, '-O0')
+
+
+def test_cfg_removes_unreachable_code(tmp_path):
+    prg = quantum.load_program_cached(write_program(tmp_path, '0 if 1 dump end 2 dump 0 1 syscall1 3 dump\n'), True,
+                                      False)
+    optimized = quantum.optimize_control_flow(prg)
+    assert len(optimized) < len(prg)
+    assert quantum.OP_IF not in [op.type for op in optimized]
+
+
+def test_cfg_stats(tmp_path):
+    path = write_program(tmp_path, BRANCHY_SOURCES[0] + '\n')
+    result = run_quantum('sim', '--no-cache', '--cfg-stats', path)
+    assert result.stdout == b'2\n3\n'
+    assert b'[CFG] constant branches: 1 folded' in result.stderr
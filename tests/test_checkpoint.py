@@ -0,0 +1,99 @@
+import io
+import os
+
+import pytest
+
+import quantum
+from helpers import random_program, run_quantum, simulate, write_program
+
+
+def load(path: str) -> quantum.Program:
+    return quantum.optimize_control_flow(quantum.load_program_cached(path, True, False))
+
+
+def capture(vm: quantum.Interpreter, sink: io.BytesIO) -> None:
+    vm.output.stdout = sink
+    vm.output.stderr = io.BytesIO()
+
+
+def run_with_snapshots(tmp_path, path: str, slice_size: int, int64: bool) -> tuple:
+    """ Runs the program in slices, restoring a new `Interpreter` from a snapshot after every one of them """
+    prg = load(path)
+    snapshot_path = str(tmp_path / 'run.snap')
+    vm = quantum.Interpreter(prg, int64=int64)
+    vm.start()
+    sink = io.BytesIO()
+    capture(vm, sink)
+    checkpoint = quantum.Checkpoint.create(snapshot_path, path, True, int64, len(vm.memory))
+    while not vm.resume(slice_size):
+        checkpoint.write(vm)
+        checkpoint.saved.close()
+        checkpoint.image.close()
+        checkpoint = quantum.Checkpoint.load(snapshot_path)
+        assert checkpoint.digest == quantum.program_digest(prg)
+        memory = quantum.allocate_memory(len(checkpoint.saved), False, checkpoint.image.fileno())
+        vm = quantum.Interpreter(prg, int64=checkpoint.int64, memory=memory)
+        checkpoint.restore(vm)
+        capture(vm, sink)
+    checkpoint.remove()
+    return sink.getvalue(), vm.exit_code, vm.steps
+
+
+@pytest.mark.parametrize('slice_size', [1, 7, 100])
+@pytest.mark.parametrize('seed', range(8))
+def test_restored_run_matches_uninterrupted_run(tmp_path, seed, slice_size):
+    path = write_program(tmp_path, random_program(seed))
+    vm = quantum.Interpreter(load(path), int64=seed % 2 == 0)
+    out = io.BytesIO()
+    exit_code = vm.run(stdout=out, stderr=io.BytesIO())
+    assert run_with_snapshots(tmp_path, path, slice_size, seed % 2 == 0) == (out.getvalue(), exit_code, vm.steps)
+    assert os.listdir(str(tmp_path)) == ['program.qt']
+
+
+def write_snapshot(tmp_path, path: str, slices: int) -> bytes:
+    """ Runs the program for some slices and leaves a snapshot of the run behind, returns the output so far """
+    vm = quantum.Interpreter(load(path))
+    vm.start()
+    sink = io.BytesIO()
+    capture(vm, sink)
+    for _ in range(slices):
+        assert not vm.resume(50)
+    checkpoint = quantum.Checkpoint.create(str(tmp_path / 'run.snap'), path, True, False, len(vm.memory))
+    checkpoint.write(vm)
+    return sink.getvalue()
+
+
+def test_resume_continues_the_run(tmp_path):
+    path = write_program(tmp_path, quantum.rule110_source(12) + ' 3 1 syscall1\n')
+    done = write_snapshot(tmp_path, path, 20)
+    assert done
+    result = run_quantum('sim', '--no-cache', '--resume', str(tmp_path / 'run.snap'))
+    assert (done + result.stdout, result.returncode) == simulate(path)
+    assert not os.path.exists(str(tmp_path / 'run.snap'))
+    assert not os.path.exists(str(tmp_path / 'run.snap') + quantum.SNAPSHOT_IMAGE_SUFFIX)
+
+
+def test_resume_rejects_changed_program(tmp_path):
+    path = write_program(tmp_path, quantum.rule110_source(12))
+    write_snapshot(tmp_path, path, 5)
+    write_program(tmp_path, quantum.rule110_source(13))
+    result = run_quantum('sim', '--no-cache', '--resume', str(tmp_path / 'run.snap'))
+    assert result.returncode == 1
+    assert b'has changed since the snapshot was written' in result.stdout
+
+
+def test_resume_rejects_other_files(tmp_path):
+    snapshot_path = write_program(tmp_path, '1 dump\n', 'run.snap')
+    result = run_quantum('sim', '--resume', snapshot_path)
+    assert result.returncode == 1
+    assert b'is not a snapshot of this version of the simulator' in result.stdout
+
+
+@pytest.mark.parametrize('int64', [[], ['--int64']])
+def test_checkpointed_run_matches_simulation(tmp_path, int64):
+    path = write_program(tmp_path, quantum.rule110_source(20) + ' 18446744073709551615 dump 4 1 syscall1\n')
+    snapshot_path = str(tmp_path / 'run.snap')
+    result = run_quantum('sim', '--no-cache', f'--checkpoint={snapshot_path}', '--checkpoint-every=0.001', *int64,
+                         path)
+    assert (result.stdout, result.returncode) == simulate(path, *int64)
+    assert not os.path.exists(snapshot_path)
@@ -0,0 +1,104 @@
+import io
+import os
+
+import pytest
+
+import quantum
+from helpers import ROOT, compile_and_run, random_program, run_quantum, simulate, write_program
+
+BULK_SOURCE = 'mem 65 save mem 1 + mem 1 memcpy mem 1 + load dump\n'
+WIDE_SOURCES = [
+    'mem 258 save16 mem load dump mem 1 + load dump mem load16 dump',
+    'mem -1 save32 mem load32 dump mem load16 dump mem 4 + load dump',
+    'mem -2 save64 mem load64 dump mem load32 dump mem 7 + load dump',
+    'mem 65536 save16 mem load16 dump mem 4294967297 save32 mem load32 dump',
+    'mem 3 + 9223372036854775807 save64 mem 3 + load64 dump mem 10 + load dump',
+    'mem 1 + 2 save mem 2 + 3 save mem 1 + mem 3 memcpy mem load32 dump',
+    'mem 1 + 2 save mem 2 + 3 save mem mem 1 + 3 memcpy mem load32 dump',
+    'mem 2 + 513 5 memset mem load64 dump mem 2 + -1 0 memset mem load dump',
+]
+
+
+@pytest.mark.parametrize('emitter_class', [quantum.Arm64Emitter, quantum.X86_64Emitter])
+def test_register_stack_needs_three_registers(emitter_class):
+    emitter = emitter_class(io.StringIO())
+    with pytest.raises(AssertionError):
+        quantum.RegisterStack(emitter, quantum.MIN_STACK_REGISTERS - 1)
+    quantum.RegisterStack(emitter, quantum.MIN_STACK_REGISTERS)
+
+
+def test_stack_regs_below_minimum_is_rejected(tmp_path):
+    path = write_program(tmp_path, BULK_SOURCE)
+    result = run_quantum('com', '--no-cache', '--target=x86_64-linux', '--stack-regs=2', path, timeout=30)
+    assert result.returncode == 1
+    assert b'number of stack registers must be between 3' in result.stdout
+
+
+@pytest.mark.parametrize('target', quantum.TARGETS)
+def test_bulk_operations_with_fewest_stack_registers(tmp_path, target):
+    prg = quantum.load_program_cached(write_program(tmp_path, BULK_SOURCE), True, False)
+    quantum.compile_program(prg, str(tmp_path / 'program.s'), target, quantum.MIN_STACK_REGISTERS)
+    assert 'memory_copy' in (tmp_path / 'program.s').read_text()
+
+
+def test_bulk_operations_run_with_fewest_stack_registers(tmp_path):
+    path = write_program(tmp_path, BULK_SOURCE)
+    assert compile_and_run(path, f'--stack-regs={quantum.MIN_STACK_REGISTERS}') == (b'65\n', 0)
+
+
+@pytest.mark.parametrize('source', WIDE_SOURCES)
+def test_wide_operations_match_reference(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert simulate(path) == simulate(path, '--reference') == simulate(path, '--int64', '-O0')
+
+
+@pytest.mark.parametrize('options', [[], ['-O0'], [f'--stack-regs={quantum.MIN_STACK_REGISTERS}'], ['--stack-regs=6']])
+@pytest.mark.parametrize('source', WIDE_SOURCES)
+def test_wide_operations_of_compiled_program(tmp_path, source, options):
+    path = write_program(tmp_path, source + '\n')
+    assert compile_and_run(path, *options) == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_compiled_random_program_with_stack_registers(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert compile_and_run(path, '--stack-regs=4') == compile_and_run(path) == simulate(path, '--int64')
+
+
+SIGNED_SOURCE = '0 dump -1 dump 9 dump -10 dump 9223372036854775807 dump -9223372036854775808 dump\n'
+
+
+@pytest.mark.parametrize('options', [[], ['--buffered-output'], ['--stack-regs=4']])
+def test_dump_prints_signed_values(tmp_path, options):
+    path = write_program(tmp_path, SIGNED_SOURCE)
+    assert compile_and_run(path, *options) == simulate(path) == simulate(path, '--int64')
+
+
+def test_arm64_dump_prints_sign(tmp_path):
+    prg = quantum.load_program_cached(write_program(tmp_path, SIGNED_SOURCE), True, False)
+    quantum.compile_program(prg, str(tmp_path / 'program.s'), quantum.TARGET_ARM64_MACOS)
+    assembly = (tmp_path / 'program.s').read_text()
+    dump = assembly[assembly.index('dump:'):assembly.index('ret', assembly.index('dump:'))]
+    assert 'cneg x0, x0, lt' in dump and 'mov w3, 45' in dump
+
+
+def memory_instructions(path) -> int:
+    """ Instructions of the assembly that access memory: pushes and pops, and the ones with a memory operand """
+    count = 0
+    for line in path.read_text().splitlines():
+        words = line.split(None, 1)
+        if not words or words[0].endswith(':') or words[0][0] in '.;#':
+            continue
+        if words[0] in ['push', 'pop', 'pushq', 'popq'] or (words[0] != 'lea' and ('[' in line or '(' in line)):
+            count += 1
+    return count
+
+
+@pytest.mark.parametrize('stack_registers', [quantum.MIN_STACK_REGISTERS, 4])
+@pytest.mark.parametrize('target', quantum.TARGETS)
+def test_stack_registers_remove_memory_accesses(tmp_path, target, stack_registers):
+    prg = quantum.load_program_cached(os.path.join(ROOT, 'examples', 'rule110.qt'), True, False)
+    quantum.compile_program(prg, str(tmp_path / 'plain.s'), target)
+    quantum.compile_program(prg, str(tmp_path / 'cached.s'), target, stack_registers)
+    # Measured on rule110: 155 down to 49 on ARM64 and 112 down to 40 on x86-64 with 4 registers
+    assert memory_instructions(tmp_path / 'cached.s') * 2 < memory_instructions(tmp_path / 'plain.s')
@@ -0,0 +1,147 @@
+""" Differential tests of the simulator engines against the reference simulator """
+import io
+
+import pytest
+
+import quantum
+from helpers import EXAMPLES, compile_and_run, random_program, run_quantum, simulate, write_program
+
+# Leaves a value on the stack on every iteration, so it can't be verified statically
+UNVERIFIABLE_SOURCE = '0 while clone 5 < do clone 1 + end dump dump dump dump dump dump\n'
+
+
+def simulate_static(prg, output, int64: bool = False) -> None:
+    depths, max_depth, _ = quantum.check_stack_effects(prg)
+    quantum.simulate_program_static(prg, depths, max_depth, output, int64=int64)
+
+
+def run_in_process(simulator, path: str, *args) -> tuple:
+    """ Stdout and exit code of the simulator function called in this process on the optimized program """
+    prg = quantum.load_program_cached(path, True, False)
+    sink = io.BytesIO()
+    exit_code = 0
+    try:
+        simulator(prg, *args, quantum.OutputBuffer(stdout=sink, stderr=io.BytesIO()))
+    except quantum.ProgramExit as err:
+        exit_code = err.code
+    return sink.getvalue(), exit_code
+
+
+@pytest.mark.parametrize('seed', range(15))
+def test_threaded_code_matches_reference(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert run_in_process(quantum.simulate_program, path) == simulate(path, '--reference')
+    # The reference without optimizations checks the optimizer too
+    assert simulate(path) == simulate(path, '--reference', '-O0')
+
+
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_threaded_code_matches_reference_on_examples(path):
+    assert run_in_process(quantum.simulate_program, path) == simulate(path, '--reference')
+
+
+def test_threaded_code_runs_unverifiable_program(tmp_path):
+    path = write_program(tmp_path, UNVERIFIABLE_SOURCE)
+    assert simulate(path) == simulate(path, '--reference') == (b'5\n4\n3\n2\n1\n0\n', 0)
+
+
+@pytest.mark.parametrize('seed', range(15))
+def test_transpiled_matches_reference(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--transpile') == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_transpiled_matches_reference_on_examples(path):
+    assert simulate(path, '--transpile', '-O0') == simulate(path, '--reference', '-O0')
+
+
+def test_dumped_code_compiles(tmp_path):
+    path = write_program(tmp_path, random_program(3))
+    stdout, returncode = simulate(path, '--dump-code')
+    assert returncode == 0
+    compile(stdout, path, 'exec')
+
+
+@pytest.mark.parametrize('seed', range(15))
+def test_static_matches_reference(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert run_in_process(simulate_static, path) == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_static_matches_reference_on_examples(path):
+    assert run_in_process(simulate_static, path) == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('source', [UNVERIFIABLE_SOURCE, 'drop\n', '1 if 2 end dump\n'])
+def test_stack_effects_reject_unbalanced_programs(tmp_path, source):
+    with pytest.raises(quantum.StackEffectError):
+        quantum.check_stack_effects(quantum.load_program_cached(write_program(tmp_path, source), False, False))
+
+
+def test_stack_effects_give_maximum_depth(tmp_path):
+    prg = quantum.load_program_cached(write_program(tmp_path, '1 2 3 + + 4 5 6 7 + + + + dump\n'), False, False)
+    depths, max_depth, _ = quantum.check_stack_effects(prg)
+    assert max_depth == 5
+    assert depths[:4] == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_profiled_matches_reference(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--profile') == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_profile_counts_executed_operations(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    collapsed_path = str(tmp_path / 'stacks.txt')
+    result = run_quantum('sim', '--no-cache', f'--profile-out={collapsed_path}', path)
+    executed = quantum.count_executed_operations(quantum.load_program_cached(path, True, False))
+    assert f'[PROFILE] {executed} operations executed'.encode() in result.stderr
+    with open(collapsed_path) as f:
+        lines = f.read().splitlines()
+    assert lines and all(line.startswith('main;') and line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+@pytest.mark.parametrize('engine', [[], ['-O0'], ['--profile'], ['--profile', '-O0']])
+@pytest.mark.parametrize('seed', range(8))
+def test_int64_matches_compiled_program(tmp_path, seed, engine):
+    path = write_program(tmp_path, random_program(seed))
+    levels = [option for option in engine if option == '-O0']
+    assert simulate(path, '--int64', *engine) == compile_and_run(path, *levels)
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_int64_threaded_code_matches_static(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert run_in_process(lambda prg, output: quantum.simulate_program(prg, output, int64=True), path) == \
+        run_in_process(lambda prg, output: simulate_static(prg, output, True), path)
+
+
+@pytest.mark.parametrize('engine', ['--reference', '--transpile', '--jit'])
+def test_int64_is_rejected_by_other_engines(tmp_path, engine):
+    result = run_quantum('sim', '--no-cache', '--int64', engine, write_program(tmp_path, '1 dump\n'))
+    assert result.returncode == 1
+    assert b'`--int64` is supported only by the threaded-code simulators' in result.stdout
+
+
+@pytest.mark.parametrize('threshold', [0, 1, 3, quantum.JIT_THRESHOLD])
+@pytest.mark.parametrize('seed', range(10))
+def test_jit_matches_reference(tmp_path, seed, threshold):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--jit', f'--jit-threshold={threshold}') == simulate(path, '--reference')
+
+
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_jit_matches_reference_on_examples(path):
+    assert simulate(path, '--jit', '--jit-threshold=1') == simulate(path, '--reference')
+
+
+def test_jit_compiles_hot_loops(tmp_path):
+    path = write_program(tmp_path, '0 while clone 10 < do 0 while clone 3 < do 1 + end drop 1 + end dump '
+                                   '0 while clone 2 < do 1 + end dump\n')
+    result = run_quantum('sim', '--no-cache', '--jit-stats', '--jit-threshold=5', path)
+    assert result.stdout == b'10\n2\n'
+    assert b'[JIT] 2 of 3 loops compiled after 5 iterations' in result.stderr
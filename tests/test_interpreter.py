@@ -0,0 +1,109 @@
+import asyncio
+import io
+
+import pytest
+
+import quantum
+from helpers import write_program
+
+# Without optimizations: 5 operations before the loop, 8 for every one of the 3 iterations, 5 for the last check and
+# the `drop`
+LOOP_SOURCE = '1 2 + dump 0 while clone 3 < do 1 + end drop\n'
+LOOP_STEPS = 35
+EXIT_SOURCE = '1 dump 3 1 syscall1 2 dump\n'
+
+
+def interpreter(tmp_path, source: str, optimize: bool = False, **kwargs) -> quantum.Interpreter:
+    prg = quantum.load_program_cached(write_program(tmp_path, source), optimize, False)
+    return quantum.Interpreter(prg, **kwargs)
+
+
+def test_run_returns_output_and_exit_code(tmp_path):
+    vm = interpreter(tmp_path, EXIT_SOURCE)
+    out = io.BytesIO()
+    assert vm.run(stdout=out) == 3
+    assert out.getvalue() == b'1\n'
+
+
+def test_runs_start_from_zeroed_memory(tmp_path):
+    vm = interpreter(tmp_path, 'mem load dump mem 7 save\n')
+    for _ in range(2):
+        out = io.BytesIO()
+        assert vm.run(stdout=out) == 0
+        assert out.getvalue() == b'0\n'
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_steps_count_executed_operations(tmp_path, optimize):
+    vm = interpreter(tmp_path, LOOP_SOURCE, optimize)
+    vm.run()
+    assert vm.steps == quantum.count_executed_operations(vm.prg)
+
+
+def test_steps_of_a_run_ending_mid_slice(tmp_path):
+    vm = interpreter(tmp_path, LOOP_SOURCE)
+    vm.run()
+    assert vm.steps == LOOP_STEPS
+
+
+def test_steps_of_a_run_ending_with_exit(tmp_path):
+    vm = interpreter(tmp_path, EXIT_SOURCE)
+    vm.run()
+    assert vm.steps == 5
+
+
+def test_budget_fits_the_exact_step_count(tmp_path):
+    vm = interpreter(tmp_path, LOOP_SOURCE, max_steps=LOOP_STEPS)
+    assert vm.run() == 0
+    vm = interpreter(tmp_path, LOOP_SOURCE, max_steps=LOOP_STEPS - 1)
+    with pytest.raises(quantum.BudgetExceeded):
+        vm.run()
+
+
+def test_endless_program_exceeds_time_budget(tmp_path):
+    vm = interpreter(tmp_path, '1 while clone do end\n', timeout=0.05)
+    with pytest.raises(quantum.BudgetExceeded):
+        vm.run()
+
+
+@pytest.mark.parametrize('slice_size', [1, 2, 7, LOOP_STEPS, LOOP_STEPS + 1, 1000])
+def test_steps_of_a_run_in_slices(tmp_path, slice_size):
+    vm = interpreter(tmp_path, LOOP_SOURCE)
+    out = io.BytesIO()
+    vm.start(stdout=out)
+    slices = 1
+    while not vm.resume(slice_size):
+        assert vm.steps == slices * slice_size
+        slices += 1
+    assert vm.steps == LOOP_STEPS
+    assert (vm.exit_code, out.getvalue()) == (0, b'3\n')
+    assert vm.resume(slice_size)
+    assert vm.steps == LOOP_STEPS
+
+
+def test_scheduler_interleaves_programs(tmp_path):
+    vms = [interpreter(tmp_path, f'0 while clone 5 < do clone {index} + dump 1 + end drop {index} 1 syscall1\n')
+           for index in range(3)]
+    sinks = [io.BytesIO() for _ in vms]
+    scheduler = quantum.Scheduler(slice_size=3, max_running=2)
+
+    async def run_all():
+        return await asyncio.gather(*[scheduler.run(vm, stdout=sink) for vm, sink in zip(vms, sinks)])
+    assert asyncio.run(run_all()) == [0, 1, 2]
+    assert [sink.getvalue() for sink in sinks] == [b''.join(b'%d\n' % (value + index) for value in range(5))
+                                                   for index in range(3)]
+
+
+def test_runs_of_file_backed_memory_start_from_zeroed_memory(tmp_path):
+    image = tmp_path / 'image'
+    image.write_bytes(bytes([5]) * 4096)
+    prg = quantum.load_program_cached(write_program(tmp_path, 'mem load dump mem 7 save\n'), True, False)
+    with open(str(image), 'r+b') as f:
+        vm = quantum.Interpreter(prg, memory=quantum.allocate_memory(4096, fileno=f.fileno()))
+        outputs = []
+        for _ in range(3):
+            out = io.BytesIO()
+            assert vm.run(stdout=out) == 0
+            outputs.append(out.getvalue())
+    assert outputs == [b'0\n', b'0\n', b'0\n']
+    assert image.read_bytes() == bytes([5]) * 4096
@@ -0,0 +1,52 @@
+import io
+
+import pytest
+
+import quantum
+from helpers import random_program, write_program
+
+numpy = pytest.importorskip('numpy')
+
+LANES = 5
+LANE_MEMORY = 4096
+
+
+def simulate_lane(prg, image) -> tuple:
+    """ Output, exit code and final memory of one lane simulated alone with the `--int64` semantics """
+    memory = quantum.allocate_memory(LANE_MEMORY)
+    memory[:] = image.tobytes()
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    code = 0
+    try:
+        quantum.simulate_program(prg, quantum.OutputBuffer(stdout=stdout, stderr=stderr), memory, int64=True)
+    except quantum.ProgramExit as err:
+        code = err.code
+    return stdout.getvalue(), stderr.getvalue(), code, memory[:]
+
+
+def assert_lanes_match(prg, seed: int) -> None:
+    images = numpy.random.default_rng(seed).integers(0, 256, size=(LANES, LANE_MEMORY), dtype=numpy.uint8)
+    memory = images.copy()
+    stdouts, stderrs, exit_codes = quantum.simulate_lanes(prg, memory)
+    for lane in range(LANES):
+        expected = simulate_lane(prg, images[lane])
+        assert (stdouts[lane], stderrs[lane], exit_codes[lane], memory[lane].tobytes()) == expected
+
+
+@pytest.mark.parametrize('source, expected', [
+    ('-1 1 shr dump', b'9223372036854775807\n'),
+    ('-8 66 shr dump', b'4611686018427387902\n'),
+    ('1 64 shl dump', b'1\n'),
+    ('1 100 shl dump', b'68719476736\n'),
+    ('9223372036854775807 1 + dump', b'-9223372036854775808\n'),
+])
+def test_lanes_wrap_like_compiled_program(tmp_path, source, expected):
+    prg = quantum.load_program_cached(write_program(tmp_path, source + '\n'), False, False)
+    stdouts, _, _ = quantum.simulate_lanes(prg, numpy.zeros((LANES, LANE_MEMORY), dtype=numpy.uint8))
+    assert stdouts == [expected] * LANES
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_lanes_match_int64_simulation(tmp_path, seed):
+    prg = quantum.load_program_cached(write_program(tmp_path, random_program(seed)), True, False)
+    assert_lanes_match(prg, seed)
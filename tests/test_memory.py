@@ -0,0 +1,45 @@
+import pytest
+
+import quantum
+from helpers import EXAMPLES, random_program, run_quantum, simulate, write_program
+
+ENGINES = [[], ['-O0'], ['--reference'], ['--profile'], ['--jit']]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('source, location, address', [
+    ('1 dump\nmem 100 + load dump\n', '1:10', 100),
+    ('1 dump\nmem 1 - 7 save\n', '1:10', -1),
+    ('1 dump\nmem 57 + load64 dump\n', '1:9', 57),
+    ('1 dump\nmem 60 + mem 10 memset\n', '1:16', 60),
+])
+def test_checked_memory_reports_location(tmp_path, engine, source, location, address):
+    path = write_program(tmp_path, source)
+    result = run_quantum('sim', '--no-cache', '--checked', '--mem-size=64', *engine, path)
+    assert (result.returncode, result.stdout.splitlines()[0]) == (1, b'1')
+    assert f'{path}:{location}: memory access out of bounds at address {address}'.encode() in result.stderr
+
+
+def test_checked_memory_accepts_last_bytes(tmp_path):
+    path = write_program(tmp_path, 'mem 56 + 1 save64 mem 56 + load64 dump mem 63 + load dump\n')
+    assert simulate(path, '--checked', '--mem-size=64') == (b'1\n0\n', 0)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_checked_memory_keeps_output(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--checked', '--mem-size=100') == simulate(path)
+
+
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_checked_memory_keeps_output_of_examples(path):
+    assert simulate(path, '--checked') == simulate(path)
+
+
+def test_checked_memory_bounds():
+    memory = quantum.allocate_memory(16, True)
+    memory[15] = 1
+    assert memory[8:16] == b'\0' * 7 + b'\1'
+    for access in [lambda: memory[16], lambda: memory[-1], lambda: memory[10:17]]:
+        with pytest.raises(quantum.MemoryAccessError):
+            access()
@@ -0,0 +1,62 @@
+import pytest
+
+import quantum
+from helpers import compile_and_run, random_program, simulate, write_program
+
+# Constants whose folding would differ between the unbounded integers of the simulators and the 64-bit arithmetic of
+# `--int64` and the compiled program: overflows, shift amounts of 64 and more, and `shr` of negative values
+WRAPPING_SOURCES = [
+    '-1 1 shr dump',
+    '-8 2 shr dump',
+    '1 64 shl dump',
+    '1 100 shl dump',
+    '3 -1 shl dump',
+    '9223372036854775807 1 + 0 < dump',
+    '-9223372036854775808 1 - dump',
+    '9223372036854775807 1 + dump',
+    'mem 9223372036854775807 + 9223372036854775807 + 2 + dump',
+    '5 9223372036854775807 + 9223372036854775807 + dump',
+]
+
+
+@pytest.mark.parametrize('source', WRAPPING_SOURCES)
+def test_folding_matches_compiled_program(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert compile_and_run(path, '-O1') == compile_and_run(path, '-O0')
+
+
+@pytest.mark.parametrize('source', WRAPPING_SOURCES)
+def test_folding_matches_int64_simulation(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert simulate(path, '--int64', '-O1') == simulate(path, '--int64', '-O0')
+
+
+@pytest.mark.parametrize('source', WRAPPING_SOURCES)
+def test_folding_matches_unbounded_simulation(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert simulate(path, '-O1') == simulate(path, '-O0') == simulate(path, '--reference', '-O0')
+
+
+def fuse(*ops) -> list:
+    replacement = quantum.fuse_operations([quantum.Operation(op_type, ('-', 1, 1), value=value)
+                                           for op_type, value in ops])
+    return replacement and [(op.type, op.value) for op in replacement]
+
+
+def test_folding_keeps_values_in_64_bits():
+    assert fuse((quantum.OP_PUSH, 5), (quantum.OP_PUSH, 3), (quantum.OP_SHL, None)) == [(quantum.OP_PUSH, 40)]
+    assert fuse((quantum.OP_PUSH, 8), (quantum.OP_PUSH, 1), (quantum.OP_SHR, None)) == [(quantum.OP_PUSH, 4)]
+    assert fuse((quantum.OP_PUSH, 1), (quantum.OP_PUSH, 64), (quantum.OP_SHL, None)) is None
+    assert fuse((quantum.OP_PUSH, 1), (quantum.OP_PUSH, -1), (quantum.OP_SHL, None)) is None
+    assert fuse((quantum.OP_PUSH, -8), (quantum.OP_PUSH, 1), (quantum.OP_SHR, None)) is None
+    assert fuse((quantum.OP_PUSH, 2 ** 62), (quantum.OP_PUSH, 2), (quantum.OP_SHL, None)) is None
+    assert fuse((quantum.OP_PUSH, 2 ** 63), (quantum.OP_PUSH, 0), (quantum.OP_EQ, None)) is None
+    assert fuse((quantum.OP_PUSH, 2 ** 63 - 1), (quantum.OP_ADD_CONST, 1)) is None
+    assert fuse((quantum.OP_PUSH, 2 ** 63 - 2), (quantum.OP_ADD_CONST, 1)) == [(quantum.OP_PUSH, 2 ** 63 - 1)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_optimizer_keeps_output(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--int64', '-O1') == simulate(path, '--int64', '-O0')
+    assert simulate(path, '-O1') == simulate(path, '-O0')
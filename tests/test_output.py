@@ -0,0 +1,67 @@
+import io
+
+import pytest
+
+import quantum
+from helpers import compile_and_run, random_program, run_quantum, simulate, write_program
+
+# Writes `ABC` to stdout and `BC` to stderr between the dumps
+MIXED_SOURCE = 'mem 65 save mem 1 + 66 save mem 2 + 67 save 1 dump 1 mem 3 4 syscall3 2 dump ' \
+               '2 mem 1 + 2 4 syscall3 3 dump\n'
+
+
+class Sink:
+    """ Sink recording the writes of one stream into a log shared by the streams """
+
+    def __init__(self, log: list, name: str):
+        self.log = log
+        self.name = name
+
+    def write(self, data: bytes) -> None:
+        self.log.append((self.name, data))
+
+
+def test_buffer_keeps_order_of_streams():
+    log = []
+    output = quantum.OutputBuffer(stdout=Sink(log, 'out'), stderr=Sink(log, 'err'))
+    output.dump(1)
+    output.write(1, b'a')
+    output.write(2, b'b')
+    output.dump(2)
+    assert log == [('out', b'1\na'), ('err', b'b')]
+    output.flush()
+    assert log[-1] == ('out', b'2\n')
+
+
+def test_buffer_flushes_when_full():
+    sink = io.BytesIO()
+    output = quantum.OutputBuffer(4, stdout=sink)
+    output.dump(12)
+    assert sink.getvalue() == b''
+    output.dump(345)
+    assert sink.getvalue() == b'12\n345\n'
+
+
+@pytest.mark.parametrize('options', [[], ['--unbuffered'], ['--output-buffer=1'], ['--output-buffer=5']])
+def test_simulated_output_keeps_order(tmp_path, options):
+    path = write_program(tmp_path, MIXED_SOURCE)
+    result = run_quantum('sim', '--no-cache', *options, path)
+    assert (result.stdout, result.stderr) == (b'1\nABC2\n3\n', b'BC')
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_unbuffered_matches_buffered(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--unbuffered') == simulate(path, '--output-buffer=3') == simulate(path)
+
+
+@pytest.mark.parametrize('options', [['--buffered-output'], ['--output-buffer=1'], ['--output-buffer=5']])
+def test_compiled_buffered_output_keeps_order(tmp_path, options):
+    path = write_program(tmp_path, MIXED_SOURCE + '4 dump 9 1 syscall1 5 dump\n')
+    assert compile_and_run(path, *options) == compile_and_run(path) == (b'1\nABC2\n3\n4\n', 9)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_compiled_buffered_output_matches_simulation(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert compile_and_run(path, '--buffered-output') == simulate(path, '--int64')
@@ -0,0 +1,25 @@
+import pytest
+
+import quantum
+from helpers import random_program, simulate, write_program
+
+
+def test_program_columns_keep_operations(tmp_path):
+    prg = quantum.load_program_cached(write_program(tmp_path, random_program(0)), True, False)
+    ops = list(prg)
+    rebuilt = quantum.Program.from_operations(ops)
+    assert [(op.type, op.value, op.jump, op.loc) for op in rebuilt] == [(op.type, op.value, op.jump, op.loc)
+                                                                         for op in ops]
+
+
+@pytest.mark.parametrize('source', ['18446744073709551616 1 + dump', '0 if 1 dump else 2 dump end 3 dump',
+                                    'mem 1 + 300 save mem 1 + load dump'])
+def test_reference_reads_wide_values_and_jumps(tmp_path, source):
+    path = write_program(tmp_path, source + '\n')
+    assert simulate(path, '--reference', '-O0') == simulate(path, '-O0')
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_reference_matches_threaded_code(tmp_path, seed):
+    path = write_program(tmp_path, random_program(seed))
+    assert simulate(path, '--reference') == simulate(path)